@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+
+# bench_metrics times the processing pipeline on synthetic incidents: layer
+# filtering, splitting by period, alert and cluster normalization, the
+# alerts/clusters reports, and reading and writing each cache format. The
+# incidents have the shape of the PagerDuty payload in test_incidents, with
+# summaries and services drawn from the kinds the normalization rules are
+# written for. Results can be written as JSON, and compared with an earlier
+# run to spot regressions between revisions.
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import metrics
+
+from test_metrics import test_incidents
+
+default_sizes = [1000, 10000, 100000]
+default_runs = 3
+default_days = 28
+
+# Benchmarks slower than this, relative to the compared run, are flagged
+regression_threshold = 1.1
+
+# Summaries are drawn from these templates, with these relative weights
+summary_templates = [
+    (45, "[SRE] {alert} {severity} ({n})"),
+    (10, "[OHSS-{ticket}] {alert} {severity} ({n})"),
+    (10, "{alert} {severity} ({n})"),
+    (15, "[SL Sent] {cluster} has gone missing"),
+    (
+        8,
+        "docker.ping failed on {node}-compute.internal : PROBLEM for "
+        "{node}-compute.internal",
+    ),
+    (
+        5,
+        "[Heal] Filesystem: /dev/mapper/rootvg-var has less than 10% free disk "
+        "space on {node}: PROBLEM for {node}",
+    ),
+    (
+        7,
+        "[FIRING:1] ClusterProvisioningDelay - production CCS - hive{ticket} "
+        "hive-controllers hive ({cluster} managed-byoc ProvisionFailed metrics "
+        "production openshift-v4.7.13 hive aws high srep)",
+    ),
+]
+
+# Services are named after their cluster, apart from these shared ones
+service_templates = [
+    (70, "osd-{cluster}"),
+    (15, "{cluster}-hive-cluster"),
+    (5, "prod-deadmanssnitch"),
+    (5, "Zabbix Service"),
+    (5, "app-sre-alertmanager"),
+]
+
+alert_words = [
+    "Kube",
+    "Pod",
+    "Node",
+    "Etcd",
+    "Upgrade",
+    "Config",
+    "Sync",
+    "Failure",
+    "Console",
+    "Router",
+    "Prometheus",
+    "Remote",
+    "Write",
+    "Behind",
+    "DNS",
+    "Errors",
+    "API",
+    "Down",
+    "Disk",
+    "Pressure",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=default_sizes,
+        help="Numbers of incidents to benchmark with "
+        f"(default: {' '.join(str(s) for s in default_sizes)})",
+    )
+    parser.add_argument(
+        "-n",
+        "--runs",
+        type=int,
+        default=default_runs,
+        help=f"Timed runs of each benchmark (default: {default_runs})",
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmarks",
+        nargs="+",
+        choices=benchmarks.keys(),
+        default=list(benchmarks.keys()),
+        help="Benchmarks to run (default: all)",
+    )
+    parser.add_argument(
+        "-o", "--output", type=Path, help="Write the results as JSON to this file"
+    )
+    parser.add_argument(
+        "--compare",
+        type=Path,
+        help="Compare with the JSON results of an earlier run",
+    )
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        incidents = synthetic_incidents(size)
+        for name in args.benchmarks:
+            timings = benchmarks[name](incidents, args.runs)
+            if timings is None:
+                print(f"[WARNING] Skipping {name}; not available here")
+                continue
+
+            results.append(
+                {
+                    "benchmark": name,
+                    "size": size,
+                    "runs": len(timings),
+                    "min_s": round(min(timings), 6),
+                    "median_s": round(statistics.median(timings), 6),
+                    "per_incident_us": round(min(timings) / size * 1e6, 3),
+                }
+            )
+            print_result(results[-1])
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "created_at": datetime.utcnow().strftime(metrics.pd_time_format),
+        "results": results,
+    }
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+
+    if args.compare:
+        print("")
+        print_comparison(json.loads(args.compare.read_text()), report)
+
+
+# synthetic_incidents returns count incidents spread over the days before
+# today, oldest first. Alert names and clusters follow a long-tailed
+# distribution, as a few noisy alerts and clusters make up most incidents.
+def synthetic_incidents(count, days=default_days, seed=0):
+    rng = random.Random(seed)
+    template = test_incidents[0]
+
+    alerts = [
+        "".join(rng.sample(alert_words, rng.randint(2, 4))) + rng.choice(["SRE", ""])
+        for _ in range(200)
+    ]
+    clusters = [
+        f"cluster-{n}.{rng.choice(['abcd', 'efgh', 'ijkl'])}.p1.openshiftapps.com"
+        for n in range(max(50, count // 200))
+    ]
+    alert_weights = [1 / (rank + 1) for rank in range(len(alerts))]
+    cluster_weights = [1 / (rank + 1) for rank in range(len(clusters))]
+
+    summary_weights, summaries = zip(*summary_templates)
+    service_weights, services = zip(*service_templates)
+
+    start = metrics.helpers.today() - timedelta(days=days)
+    offsets = sorted(rng.uniform(0, days * 86400) for _ in range(count))
+
+    incidents = []
+    for n, offset in enumerate(offsets):
+        cluster = rng.choices(clusters, cluster_weights)[0]
+        fields = {
+            "alert": rng.choices(alerts, alert_weights)[0],
+            "severity": rng.choice(["CRITICAL", "WARNING"]),
+            "n": rng.randint(1, 3),
+            "ticket": rng.randint(10000, 99999),
+            "cluster": cluster,
+            "node": f"{cluster.split('.')[0]}-master-{rng.randint(0, 2)}",
+        }
+        summary = rng.choices(summaries, summary_weights)[0].format(**fields)
+        created_at = (start + timedelta(seconds=offset)).strftime(
+            metrics.pd_time_format
+        )
+
+        incidents.append(
+            dict(
+                template,
+                id=f"SYNTH{n:07d}",
+                incident_number=n,
+                title=summary,
+                summary=f"[#{n}] {summary}",
+                description=summary,
+                created_at=created_at,
+                last_status_change_at=created_at,
+                status=rng.choices(
+                    ["resolved", "acknowledged", "triggered"], [90, 5, 5]
+                )[0],
+                urgency="high",
+                service=dict(
+                    template["service"],
+                    summary=rng.choices(services, service_weights)[0].format(**fields),
+                ),
+            )
+        )
+
+    return incidents
+
+
+# time_runs times a function over a number of runs, calling setup (untimed)
+# before each one
+def time_runs(func, runs, setup=None):
+    timings = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def clear_normalization_caches():
+    metrics.parse_description_for_alerts.cache_clear()
+    metrics.parse_description_for_cluster.cache_clear()
+
+
+def bench_is_in_layer(incidents, runs):
+    layers = [4, 5]
+
+    def run():
+        for i in incidents:
+            metrics.is_in_layer(i["created_at"], layers)
+
+    return time_runs(run, runs)
+
+
+def bench_incident_records(incidents, runs):
+    def run():
+        for i in incidents:
+            metrics.Incident.from_pagerduty(i)
+
+    return time_runs(run, runs, setup=clear_normalization_caches)
+
+
+def bench_split_incidents_by_period(incidents, runs):
+    records = [metrics.Incident.from_pagerduty(i) for i in incidents]
+
+    return time_runs(
+        lambda: metrics.split_incidents_by_period(records, default_days // 2), runs
+    )
+
+
+def bench_parse_description_for_alerts(incidents, runs):
+    summaries = [i["summary"] for i in incidents]
+
+    def run():
+        for summary in summaries:
+            metrics.parse_description_for_alerts(summary)
+
+    return time_runs(run, runs, setup=clear_normalization_caches)
+
+
+def bench_parse_description_for_cluster(incidents, runs):
+    services = [i["service"]["summary"] for i in incidents]
+
+    def run():
+        for service in services:
+            metrics.parse_description_for_cluster(service)
+
+    return time_runs(run, runs, setup=clear_normalization_caches)
+
+
+def bench_alerts(incidents, runs):
+    records = [metrics.Incident.from_pagerduty(i) for i in incidents]
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            metrics.alerts(records, metrics.default_result_count)
+
+    return time_runs(run, runs)
+
+
+def bench_clusters(incidents, runs):
+    records = [metrics.Incident.from_pagerduty(i) for i in incidents]
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            metrics.clusters(records, metrics.default_result_count)
+
+    return time_runs(run, runs)
+
+
+# cache_benchmarks returns write and read benchmarks for a cache format
+def cache_benchmarks(cache_format):
+    def cache_file(d):
+        if cache_format == "sqlite":
+            return Path(d).joinpath("incident-cache.sqlite3")
+
+        return Path(d).joinpath(f"incident-cache.{cache_format}")
+
+    def available():
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                metrics.write_incidents_to_cache([], cache_file(d), False)
+        except SystemExit:
+            return False
+        return True
+
+    def bench_write(incidents, runs):
+        if available() is False:
+            return None
+
+        with tempfile.TemporaryDirectory() as d:
+            path = cache_file(d)
+            return time_runs(
+                lambda: metrics.write_incidents_to_cache(incidents, path, False),
+                runs,
+                setup=lambda: path.unlink(missing_ok=True),
+            )
+
+    def bench_read(incidents, runs):
+        if available() is False:
+            return None
+
+        with tempfile.TemporaryDirectory() as d:
+            path = cache_file(d)
+            metrics.write_incidents_to_cache(incidents, path, False)
+            return time_runs(
+                lambda: metrics.read_incidents_from_cache(path, False), runs
+            )
+
+    return {
+        f"write_cache_{cache_format}": bench_write,
+        f"read_cache_{cache_format}": bench_read,
+    }
+
+
+benchmarks = {
+    "is_in_layer": bench_is_in_layer,
+    "incident_records": bench_incident_records,
+    "split_incidents_by_period": bench_split_incidents_by_period,
+    "parse_description_for_alerts": bench_parse_description_for_alerts,
+    "parse_description_for_cluster": bench_parse_description_for_cluster,
+    "alerts": bench_alerts,
+    "clusters": bench_clusters,
+}
+# Segment caches are made of JSON Lines files, so jsonl covers them
+for cache_format in metrics.cache_formats:
+    if cache_format != "segments":
+        benchmarks.update(cache_benchmarks(cache_format))
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result):
+    print(
+        f"{result['benchmark']:<32}{result['size']:>9}"
+        f"{result['min_s']:>12.4f}s{result['per_incident_us']:>10.2f}us/incident"
+    )
+
+
+# print_comparison prints the change in the fastest time of each benchmark
+# run by both reports, flagging regressions
+def print_comparison(before, after):
+    before_results = {
+        (r["benchmark"], r["size"]): r["min_s"] for r in before["results"]
+    }
+
+    print(f"Compared with {before.get('revision') or 'earlier run'}:")
+    for r in after["results"]:
+        key = (r["benchmark"], r["size"])
+        if key not in before_results or before_results[key] == 0:
+            continue
+
+        ratio = r["min_s"] / before_results[key]
+        flag = "  REGRESSION" if ratio > regression_threshold else ""
+        print(f"{r['benchmark']:<32}{r['size']:>9}{ratio:>10.2f}x{flag}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# bench_startup measures how long metrics takes to start and answer, for
+# each way it can be built: run as a script, the --onefile binary (with or
+# without staticx), and the --onedir build. Each build is timed showing
+# --help, answering a report from a fresh cache, and downloading incidents
+# from a local stand-in for the PagerDuty API, so results are reproducible
+# and need no token or network access.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import timedelta
+from pathlib import Path
+
+import metrics
+
+from bench_metrics import synthetic_incidents
+from fake_pagerduty import FakePagerDutyAPI
+
+default_runs = 10
+default_incident_count = 2000
+
+# Builds and the command that runs each; builds that have not been made
+# are skipped
+builds = {
+    "script": [sys.executable, "metrics.py"],
+    "onefile": ["dist/metrics"],
+    "onefile-staticx": ["dist/metrics_app"],
+    "onedir": ["dist/onedir/metrics/metrics"],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n",
+        "--runs",
+        type=int,
+        default=default_runs,
+        help=f"Timed runs of each command (default: {default_runs})",
+    )
+    parser.add_argument(
+        "-i",
+        "--incidents",
+        type=int,
+        default=default_incident_count,
+        help=f"Incidents in the cache and API (default: {default_incident_count})",
+    )
+    parser.add_argument(
+        "-b",
+        "--builds",
+        nargs="+",
+        choices=builds.keys(),
+        default=list(builds.keys()),
+        help="Builds to compare (default: all that exist)",
+    )
+    parser.add_argument(
+        "-o", "--output", type=Path, help="Also write the results as JSON to this file"
+    )
+    args = parser.parse_args()
+
+    incidents = synthetic_incidents(args.incidents)
+
+    with tempfile.TemporaryDirectory() as d, FakePagerDutyAPI(incidents) as api:
+        config_file = Path(d).joinpath("pd.yml")
+        config_file.write_text("---\nauthtoken: benchmark\nteam_ids: []\n")
+
+        cache_file = Path(d).joinpath("incident-cache.jsonl")
+        metrics.write_incidents_to_cache(incidents, cache_file, False)
+        metrics.write_cache_metadata(
+            incidents,
+            cache_file,
+            metrics.helpers.today() - timedelta(days=28),
+            [],
+            False,
+        )
+
+        scenarios = {
+            "help": ["--help"],
+            "cache-hit": [
+                "all",
+                "--days",
+                "14",
+                "--config_file",
+                str(config_file),
+                "--cache-file",
+                str(cache_file),
+            ],
+            "download": [
+                "download",
+                "--days",
+                "14",
+                "--config_file",
+                str(config_file),
+                "--cache-file",
+                str(Path(d).joinpath("download.jsonl")),
+            ],
+        }
+        env = dict(os.environ, PD_API_URL=api.url)
+
+        results = []
+        for build in args.builds:
+            if Path(builds[build][-1]).exists() is False:
+                print(f"[WARNING] Skipping {build}; {builds[build][-1]} not found")
+                continue
+
+            for scenario, scenario_args in scenarios.items():
+                timings = time_command(builds[build] + scenario_args, env, args.runs)
+                results.append(
+                    {
+                        "build": build,
+                        "scenario": scenario,
+                        "runs": args.runs,
+                        "min_ms": round(min(timings) * 1000, 1),
+                        "median_ms": round(statistics.median(timings) * 1000, 1),
+                        "mean_ms": round(statistics.mean(timings) * 1000, 1),
+                    }
+                )
+
+    print_results(results)
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+
+
+# time_command runs a command once to warm the page cache, then returns the
+# wall clock time of each timed run
+def time_command(command, env, runs):
+    subprocess.run(command, env=env, check=True, capture_output=True)
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, check=True, capture_output=True)
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def print_results(results):
+    print("BUILD\tSCENARIO\tMIN_MS\tMEDIAN_MS\tMEAN_MS")
+    for r in results:
+        print(
+            f"{r['build']}\t{r['scenario']}\t{r['min_ms']}\t"
+            f"{r['median_ms']}\t{r['mean_ms']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
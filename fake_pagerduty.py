@@ -0,0 +1,86 @@
+# fake_pagerduty provides a local stand-in for the PagerDuty API, shared by
+# the tests and the startup benchmark so neither needs a token or network
+# access.
+
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# FakePagerDutyAPI serves a list of incidents from a local HTTP server,
+# paginated and filtered by since/until the way the PagerDuty API does,
+# and the alerts of each incident by id
+class FakePagerDutyAPI:
+    def __init__(self, incidents, rate_limited=0, alerts=None):
+        self.incidents = incidents
+        self.alerts = alerts or {}
+        self.requests = []
+        self.alert_requests = []
+        # The first requests are refused with 429, asking to retry right away
+        self.rate_limited = rate_limited
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.endswith("/alerts"):
+                    incident_id = url.path.split("/")[-2]
+                    api.alert_requests.append(incident_id)
+                    self.send_json({"alerts": api.alerts.get(incident_id, [])})
+                    return
+
+                query = parse_qs(url.query)
+                api.requests.append(query)
+                if len(api.requests) <= api.rate_limited:
+                    self.send_response(429)
+                    self.send_header("Retry-After", "0")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                self.send_json(api.list_incidents(query))
+
+            def send_json(self, body):
+                data = json.dumps(body).encode("utf-8")
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def list_incidents(self, query):
+        since = query.get("since", [""])[0]
+        until = query.get("until", ["9999"])[0]
+        offset = int(query.get("offset", ["0"])[0])
+        limit = int(query.get("limit", ["100"])[0])
+
+        team_ids = set(query.get("team_ids[]", []))
+
+        matching = [
+            i
+            for i in self.incidents
+            if since <= i["created_at"] <= until
+            and (not team_ids or team_ids & {t["id"] for t in i["teams"]})
+        ]
+        return {
+            "incidents": matching[offset : offset + limit],
+            "more": offset + limit < len(matching),
+            "total": len(matching),
+        }
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,21 +1,88 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import calendar
+import gzip
+import hashlib
+import heapq
+import math
+import multiprocessing
 import os
+import queue
 import re
+import resource
 import json
-import yaml
+import sqlite3
+import sys
+import threading
+import time
 
 from collections import Counter
-from datetime import date, datetime, timedelta
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing, contextmanager, redirect_stdout
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
-from pdpyras import APISession, PDClientError
+from urllib.parse import parse_qs, urlencode, urlparse
 
 default_config_file = Path.home().joinpath(".config", "pagerduty", "pd.yml")
+# The team ids and normalization rules read from the config file are kept
+# here, so runs after the first do not parse it again until it changes
+default_config_cache_file = Path.home().joinpath(
+    ".cache", "toil-review-metrics", "config.json"
+)
 
 default_result_count = 5
 default_days_count = 7
+default_concurrency = 1
+
+# The serve subcommand listens on this Unix socket by default, and
+# refreshes its incidents this often (in seconds)
+default_server_socket = Path.home().joinpath(
+    ".cache", "toil-review-metrics", "metrics.sock"
+)
+default_refresh_interval = 300
+
+# Reports compare the current period with the previous one; trend reports
+# cover this many periods by default
+default_period_count = 2
+default_trend_periods = 8
 pd_time_format = "%Y-%m-%dT%H:%M:%SZ"
+# The PagerDuty API, which can be overridden to point at a local stand-in
+# (eg: for the startup benchmark)
+pd_api_url = os.getenv("PD_API_URL", "https://api.pagerduty.com")
+pd_page_size = 100
+# The API allows 960 requests a minute for each token; requests are paced
+# to this rate (per second) by default, shared by every thread
+default_request_rate = 16.0
+# Requests in flight at once, at most; fewer while the API is pushing back
+max_request_concurrency = 16
+# Rate-limited requests are retried this many times, waiting as long as the
+# API asks, before the session's own backoff takes over
+max_rate_limit_retries = 8
+# Requests slower than this many times the fastest recent ones are taken
+# as a sign the API is struggling, and concurrency is reduced
+latency_slowdown_factor = 4
+request_rate = default_request_rate
+# The API refuses offset + limit beyond this for a single query
+pd_iteration_limit = 10000
+
+# fetch_slice_modes are the ways the fetch window can be split up when
+# downloading with --concurrency greater than 1
+fetch_slice_modes = ["day", "adaptive"]
+default_fetch_slice_mode = "day"
+# adaptive slices aim for about this many incidents (5 pages) each
+adaptive_slice_target = 500
+
+# query_plans are the ways a download can be planned when only some layers
+# are requested: one wide query for every layer (which keeps the cache
+# usable for any layers), a query per day for just the requested shifts,
+# or whichever of the two needs fewer requests
+query_plans = ["wide", "auto", "shifts"]
+default_query_plan = "wide"
 
 pd_layers = {
     1: "22:30",
@@ -25,39 +92,621 @@ pd_layers = {
     5: "18:00",
 }
 
+# default_alert_rules are the (pattern, replacement) pairs applied in order
+# to an incident summary to get the alert name
+default_alert_rules = [
+    # Clean SRE-added '[SOMETHING]' prefixes, with optional dash
+    (r"\[.*\]\s(-\s)?", ""),
+    # Combine "CRITICAL (1)" and "CRITICAL (2)" alerts
+    (r"\s(CRITICAL|WARNING)\s\(\d*\)$", ""),
+    # Combine all ClusterHasGoneMissing alerts
+    (r".*has\sgone\smissing$", "ClusterHasGoneMissing"),
+    # Zabbix-style (?) alerts
+    (r"\son\s.*\s\:\s.*$", ""),
+]
+
+# default_alert_match_rules select the relevant part of the alert name,
+# if they match
+default_alert_match_rules = [
+    r"^ClusterProvisioningDelay",
+]
+
+# default_cluster_rules are the (pattern, replacement) pairs applied in
+# order to a service summary to get the cluster name
+default_cluster_rules = [
+    # Clean SRE-added '[SOMETHING]' prefixes
+    (r"\[.*\]\s", ""),
+    # ClusterHasGoneMissing
+    (r"\shas\sgone\smissing", ""),
+    # docker.ping failed
+    (r"docker.ping\sfailed\son\s", ""),
+    (r"-compute.*$", ""),
+    # ClusterProvisioningDelay
+    (r"ClusterProvisioningDelay\s.*\shive\s\(", ""),
+    (r"\sProvisionFailed.*$", ""),
+    # Disk Free
+    (r"Filesystem.*free\sdisk\sspace\son\s", ""),
+    (r":\sPROBLEM\s.*$", ""),
+    # Strip leading 'osd-'
+    (r"^osd-", ""),
+    # Strip trailing '-hive-cluster'
+    (r"-hive-cluster$", ""),
+]
+
+# Number of distinct summaries to memoize normalized results for
+normalization_cache_size = 4096
+
+# Normalizing at least this many incidents is spread over a pool of worker
+# processes, one per CPU; below it, starting the pool costs more than it
+# saves. Each worker is given chunks of at least this many incidents.
+parallel_normalization_threshold = 20000
+normalization_chunk_size = 2000
+
+# Services whose summary does not contain a cluster name
+cluster_excluded_services = [
+    "prod-deadmanssnitch",
+    "Zabbix Service",
+    "app-sre-alertmanager",
+]
+
+# aggregate_columns are the incident fields a report can be broken down
+# by, alone or crossed with each other (eg: "alert:cluster"). Every
+# dimension of a report is counted in the same single pass.
+aggregate_columns = {
+    "alert": lambda i: i.alert,
+    "cluster": lambda i: i.cluster,
+    "service": lambda i: i.service,
+    "layer": lambda i: i.layer,
+    "day": lambda i: epoch_day(i.created_at // 86400),
+}
+
+# store_columns are the SQL expressions for the aggregate columns in the
+# incident store
+store_columns = {
+    "alert": "alert",
+    "cluster": "cluster",
+    "service": "service",
+    "layer": "layer",
+    "day": "date(created_at, 'unixepoch')",
+}
+
+# Breakdowns by these columns are listed in order, rather than by count
+ordered_columns = ["layer", "day"]
+
+# Headings for columns that are not just their upper-cased name
+aggregate_headings = {"alert": "INCIDENT"}
+
+# With --approximate, the values of each breakdown are counted in a sketch
+# tracking at most this many of them, instead of counting every value
+sketch_size = None
+
+# cache_formats are the supported cache file formats: JSON Lines holding
+# only the fields the reports use (optionally gzip or zstd compressed), the
+# raw PagerDuty JSON list, an SQLite incident store queried directly, or a
+# directory of JSON Lines segments, one per UTC day
+cache_formats = ["jsonl", "jsonl.gz", "jsonl.zst", "json", "sqlite", "segments"]
+default_cache_format = "jsonl"
+
+# projected_suffixes are the file suffixes of JSON Lines caches
+projected_suffixes = [".jsonl", ".jsonl.gz", ".jsonl.zst"]
+
+# rollup_columns are the aggregate columns daily rollups hold counts for;
+# reports that break down by anything else read every incident
+rollup_columns = ["alert", "cluster", "service"]
+# rollup_version is part of the digest rollups are checked against, to
+# rebuild them when the way they are counted changes
+rollup_version = 1
+# store_version is part of the digest the incident store is checked
+# against, to derive its columns again when they change
+store_version = 1
+
+# alert_cluster_keys are the alert detail fields that name the cluster an
+# alert fired on, in order of preference
+alert_cluster_keys = ["cluster", "cluster_name", "cluster_id", "clusterid"]
+# alert_cluster_label matches a cluster label in alert details sent as text,
+# eg: the "firing" summary of an Alertmanager notification
+alert_cluster_label = re.compile(r"\bcluster(?:_name|_id)?\s*[=:]\s*\"?([\w.-]+)")
+# Alerts are fetched for this many incidents at a time, and the clusters
+# found are saved after each batch
+alert_fetch_batch_size = 100
+
+# segment_metadata_name is the file in a segment cache directory that records
+# the teams it is for, and how far each day segment was downloaded
+segment_metadata_name = "segments.meta.json"
+
+# cache_fields are the incident fields kept in JSON Lines caches
+cache_fields = [
+    "id",
+    "created_at",
+    "last_status_change_at",
+    "urgency",
+    "status",
+    "summary",
+]
+
 # class helpers provides a wrapper around datetime.today() to allow for mocking
 class helpers:
     def today():
         return datetime.today()
 
 
+# IncompleteDownloadError is raised when the incidents of a window cannot all
+# be downloaded, as there are more than the API will page through
+class IncompleteDownloadError(Exception):
+    pass
+
+
+# Incident holds the fields of a PagerDuty incident that the reports use,
+# parsed and normalized once when the incident is read. Times are seconds
+# since the epoch, and cluster is None for services without a cluster name.
+class Incident:
+    __slots__ = (
+        "id",
+        "created_at",
+        "last_status_change_at",
+        "layer",
+        "urgency",
+        "status",
+        "summary",
+        "alert",
+        "service",
+        "cluster",
+    )
+
+    def __init__(
+        self,
+        id,
+        created_at,
+        last_status_change_at,
+        urgency,
+        status,
+        summary,
+        service,
+        names=None,
+    ):
+        self.id = id
+        self.created_at = created_at
+        self.last_status_change_at = last_status_change_at
+        self.layer = layer_table[(created_at // 60) % len(layer_table)]
+        self.urgency = urgency
+        self.status = status
+        self.summary = summary
+        self.service = service
+        # The alert and cluster names, unless they were normalized already
+        self.alert, self.cluster = names or normalize_names(summary, service)
+
+    # from_pagerduty builds an Incident from an incident returned by the API,
+    # with its times and names from normalize_rows if they were parsed and
+    # normalized elsewhere
+    @classmethod
+    def from_pagerduty(cls, data, normalized=None):
+        if normalized is None:
+            normalized = normalize_row(
+                data["created_at"],
+                data.get("last_status_change_at"),
+                data["summary"],
+                data["service"]["summary"],
+            )
+        created_at, last_status_change_at, alert, cluster = normalized
+
+        return cls(
+            data["id"],
+            created_at,
+            last_status_change_at,
+            data.get("urgency"),
+            data.get("status"),
+            data["summary"],
+            data["service"]["summary"],
+            (alert, cluster),
+        )
+
+    # in_layers checks if the incident was created in the shift covered
+    # by any of the layers
+    def in_layers(self, layers):
+        return minute_in_layers(
+            (self.created_at // 60) % len(layer_table), self.created_at % 60, layers
+        )
+
+    def __repr__(self):
+        return f"Incident({self.id!r}, {format_epoch(self.created_at)!r}, {self.summary!r})"
+
+
+# IncidentFrame holds Incident records as columns of NumPy arrays, so they
+# can be filtered, split into periods and counted all at once. Times are
+# int64 seconds since the epoch (-1 if there is none), and layer is uint8
+# (0 if there is none). Alert, cluster and service are int32 codes into a
+# table of their distinct values, in the order they first appear (-1 if
+# there is none).
+class IncidentFrame:
+    def __init__(self, incidents):
+        np = import_numpy()
+
+        size = len(incidents)
+        self.size = size
+        self.created_at = np.fromiter(
+            (i.created_at for i in incidents), dtype=np.int64, count=size
+        )
+        self.last_status_change_at = np.fromiter(
+            (
+                -1 if i.last_status_change_at is None else i.last_status_change_at
+                for i in incidents
+            ),
+            dtype=np.int64,
+            count=size,
+        )
+        self.resolved = np.fromiter(
+            (i.status == "resolved" for i in incidents), dtype=bool, count=size
+        )
+        self.layer = np.fromiter(
+            (i.layer or 0 for i in incidents), dtype=np.uint8, count=size
+        )
+
+        self.codes, self.values = {}, {}
+        for column in ["alert", "cluster", "service"]:
+            table = {}
+            self.codes[column] = np.fromiter(
+                (
+                    -1 if value is None else table.setdefault(value, len(table))
+                    for value in (getattr(i, column) for i in incidents)
+                ),
+                dtype=np.int32,
+                count=size,
+            )
+            self.values[column] = list(table)
+
+    def __len__(self):
+        return self.size
+
+    # in_layers returns a mask of the incidents created in the shift covered
+    # by any of the layers, the way Incident.in_layers does
+    def in_layers(self, layers):
+        np = import_numpy()
+
+        layers = list(layers)
+        minute = (self.created_at // 60) % len(layer_table)
+        starts = np.array([layer or 0 for layer in layer_table], dtype=np.uint8)
+        ends = np.array(
+            [layer_ends.get(m) or 0 for m in range(len(layer_table))], dtype=np.uint8
+        )
+
+        return np.isin(starts[minute], layers) | (
+            (self.created_at % 60 == 0) & np.isin(ends[minute], layers)
+        )
+
+    # column returns the codes of an aggregate column, -1 where there is no
+    # value, and a function that returns the value for a code
+    def column(self, column):
+        np = import_numpy()
+
+        if column == "layer":
+            return np.where(self.layer > 0, self.layer, -1), int
+        if column == "day":
+            return self.created_at // 86400, epoch_day
+
+        return self.codes[column], self.values[column].__getitem__
+
+    # count returns the counts of the values of a dimension for the incidents
+    # in the mask, adding them in the order the values first appear, as
+    # aggregate_incidents does. np.unique is used rather than bincount, as
+    # crossed columns can have more combinations than would fit in an array
+    # of counts.
+    def count(self, dimension, mask):
+        np = import_numpy()
+
+        columns = [self.column(column) for column in dimension]
+        keep = mask.copy()
+        for codes, _ in columns:
+            keep &= codes >= 0
+
+        keys = np.stack([codes[keep] for codes, _ in columns], axis=1)
+        unique, first, counts = np.unique(
+            keys, axis=0, return_index=True, return_counts=True
+        )
+
+        result = new_counts()
+        for n in np.argsort(first, kind="stable"):
+            key = tuple(
+                label(int(code)) for (_, label), code in zip(columns, unique[n])
+            )
+            result[key if len(key) > 1 else key[0]] += int(counts[n])
+
+        return result
+
+    # aggregate returns the counts of each dimension for the incidents in
+    # the mask, the way aggregate_incidents does
+    def aggregate(self, dimensions, mask):
+        with profile_stage("aggregation"):
+            return {dimension: self.count(dimension, mask) for dimension in dimensions}
+
+    # resolve_times returns the seconds each resolved incident in the mask
+    # took to resolve, taking its last status change as when it resolved
+    def resolve_times(self, mask):
+        mask = mask & self.resolved & (self.last_status_change_at >= self.created_at)
+
+        return (self.last_status_change_at - self.created_at)[mask]
+
+
+# profile holds the wall time and memory use of each stage of the run, and
+# the API requests, when --profile is given; it is None otherwise
+profile = None
+profile_lock = threading.Lock()
+
+
+# start_profile starts recording stages and API requests
+def start_profile():
+    global profile
+
+    profile = {"started_at": time.perf_counter(), "stages": {}, "requests": []}
+
+
+# peak_memory returns the peak resident memory of the process so far, in
+# bytes. It is cheap enough to read around every stage, unlike tracing
+# allocations, which would slow down the stages being measured.
+def peak_memory():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# profile_stage records the wall time of a stage, the peak memory of the
+# process by the end of it, and how much the stage raised that peak, as a
+# context manager or a function decorator. Stages add up over calls.
+@contextmanager
+def profile_stage(name):
+    if profile is None:
+        yield
+        return
+
+    started, peak_before = time.perf_counter(), peak_memory()
+    try:
+        yield
+    finally:
+        wall, peak = time.perf_counter() - started, peak_memory()
+
+        with profile_lock:
+            stage = profile["stages"].setdefault(
+                name, {"calls": 0, "wall_s": 0.0, "peak_bytes": 0, "growth_bytes": 0}
+            )
+            stage["calls"] += 1
+            stage["wall_s"] += wall
+            stage["peak_bytes"] = max(stage["peak_bytes"], peak)
+            stage["growth_bytes"] += peak - peak_before
+
+
+# profile_request records the latency, size and incident count of an API
+# response, given when the request was started
+def profile_request(kind, started, response, incidents=0):
+    if profile is None:
+        return
+
+    latency = time.perf_counter() - started
+
+    with profile_lock:
+        profile["requests"].append(
+            {
+                "kind": kind,
+                "status": response.status_code,
+                "latency_s": round(latency, 6),
+                "bytes": len(response.content),
+                "incidents": incidents,
+            }
+        )
+
+
+# print_profile prints a table of the stages and API requests to stderr,
+# and writes them as JSON to the output file, if there is one
+def print_profile(output=None):
+    total = time.perf_counter() - profile["started_at"]
+
+    print("\nSTAGE\tCALLS\tWALL_MS\tPEAK_MB\tGROWTH_MB", file=sys.stderr)
+    for name, stage in profile["stages"].items():
+        print(
+            f"{name}\t{stage['calls']}\t{stage['wall_s'] * 1000:.1f}\t"
+            f"{stage['peak_bytes'] / 2**20:.1f}\t{stage['growth_bytes'] / 2**20:.1f}",
+            file=sys.stderr,
+        )
+    print(f"total\t\t{total * 1000:.1f}", file=sys.stderr)
+
+    requests = {}
+    for r in profile["requests"]:
+        requests.setdefault(r["kind"], []).append(r)
+
+    if requests:
+        print(
+            "\nAPI REQUESTS\tCOUNT\tINCIDENTS\tKB\tMEAN_MS\tMAX_MS",
+            file=sys.stderr,
+        )
+    for kind, rs in requests.items():
+        latencies = [r["latency_s"] * 1000 for r in rs]
+        print(
+            f"{kind}\t{len(rs)}\t{sum(r['incidents'] for r in rs)}\t"
+            f"{sum(r['bytes'] for r in rs) / 1024:.1f}\t"
+            f"{sum(latencies) / len(rs):.1f}\t{max(latencies):.1f}",
+            file=sys.stderr,
+        )
+
+    if output:
+        output.write_text(
+            json.dumps(
+                {
+                    "total_s": round(total, 6),
+                    "stages": profile["stages"],
+                    "requests": profile["requests"],
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+
+
 def main():
     parser = argparse.ArgumentParser()
     subparser = parser.add_subparsers(dest="subcommand", required=True)
 
     alerts_parser = subparser.add_parser("alerts", help="retrieve alert metrics")
     populate_args(alerts_parser)
+    populate_client_args(alerts_parser)
 
     clusters_parser = subparser.add_parser("clusters", help="retrieve cluster metrics")
     populate_args(clusters_parser)
+    populate_client_args(clusters_parser)
 
     all_parser = subparser.add_parser("all", help="retrieve all metrics")
     populate_args(all_parser)
+    populate_client_args(all_parser)
 
     download_parser = subparser.add_parser(
         "download", help="download incident data and stop"
     )
     populate_args(download_parser)
 
+    trend_parser = subparser.add_parser(
+        "trend", help="retrieve metrics for several consecutive periods"
+    )
+    populate_args(trend_parser)
+    trend_parser.add_argument(
+        "-p",
+        "--periods",
+        type=int,
+        required=False,
+        default=default_trend_periods,
+        help=f"Number of periods of --days days to include (default: {default_trend_periods})",
+    )
+
+    serve_parser = subparser.add_parser(
+        "serve", help="keep incidents in memory and answer reports from clients"
+    )
+    populate_args(serve_parser)
+    serve_group = serve_parser.add_mutually_exclusive_group()
+    serve_group.add_argument(
+        "--socket",
+        type=Path,
+        required=False,
+        default=default_server_socket,
+        help=f"Unix socket to listen on (default: {default_server_socket})",
+    )
+    serve_group.add_argument(
+        "--port",
+        type=int,
+        required=False,
+        help="Listen for HTTP on this localhost port instead of a Unix socket",
+    )
+    serve_parser.add_argument(
+        "--refresh",
+        type=int,
+        required=False,
+        default=default_refresh_interval,
+        help="Seconds between incremental refreshes of the incidents "
+        f"(default: {default_refresh_interval})",
+    )
+
+    batch_parser = subparser.add_parser(
+        "batch", help="produce every report in a manifest, downloading each team once"
+    )
+    populate_args(batch_parser)
+    batch_parser.add_argument(
+        "-m",
+        "--manifest",
+        type=Path,
+        required=True,
+        help="YAML manifest of the reports to produce",
+    )
+    batch_parser.add_argument(
+        "-o",
+        "--output-dir",
+        type=Path,
+        required=False,
+        default=Path("."),
+        help="Directory to write reports without an output file to "
+        "(default: the current directory)",
+    )
+
     args = parser.parse_args()
 
+    if args.profile:
+        start_profile()
+
+    try:
+        run(args)
+    except IncompleteDownloadError as e:
+        raise SystemExit(f"[ERROR] {e}")
+    finally:
+        if args.profile:
+            print_profile(args.profile_output)
+
+
+# run runs the subcommand with the parsed arguments
+def run(args):
     if args.layers is None:
         args.layers = pd_layers.keys()
 
+    if args.subcommand == "serve":
+        # The server keeps its incidents up to date with incremental syncs
+        args.sync = args.no_cache is False
+
     if args.cache_file is None:
-        args.cache_file = select_cache_file(args.cache_file, args.layers, args.days)
+        args.cache_file = select_cache_file(
+            args.cache_file, args.sync, args.cache_format
+        )
+
+    if args.sync and args.no_cache:
+        args.sync = False
+        print("[WARNING] --sync has no effect with --no-cache; downloading everything")
+
+    if args.stream and args.subcommand in ["trend", "batch"]:
+        args.stream = False
+        print(
+            f"[WARNING] --stream has no effect with {args.subcommand}; "
+            "continuing without it"
+        )
+
+    if args.stream and is_segment_cache(args.cache_file):
+        args.stream = False
+        print(
+            "[WARNING] --stream has no effect with a segment cache; "
+            "continuing without it"
+        )
+
+    if args.stream and args.sync:
+        args.stream = False
+        print("[WARNING] --stream has no effect with --sync; continuing without it")
+
+    if args.alert_clusters and args.subcommand in ["download", "serve", "batch"]:
+        args.alert_clusters = False
+        print(
+            f"[WARNING] --alert-clusters has no effect with {args.subcommand}; "
+            "continuing without it"
+        )
+
+    if args.columnar and args.subcommand not in ["alerts", "clusters", "all", "serve"]:
+        args.columnar = False
+        print(
+            f"[WARNING] --columnar has no effect with {args.subcommand}; "
+            "continuing without it"
+        )
+
+    if args.resolve_times and args.subcommand not in ["alerts", "clusters", "all"]:
+        args.resolve_times = False
+        print(
+            f"[WARNING] --resolve-times has no effect with {args.subcommand}; "
+            "continuing without it"
+        )
 
-    if args.subcommand == "download" and args.no_cache is False:
+    if args.stream and (args.columnar or args.resolve_times):
+        args.stream = False
+        print(
+            "[WARNING] --stream has no effect with --columnar or --resolve-times; "
+            "continuing without it"
+        )
+
+    if args.stream and args.alert_clusters:
+        args.stream = False
+        print(
+            "[WARNING] --stream has no effect with --alert-clusters; "
+            "continuing without it"
+        )
+
+    if args.subcommand == "download" and args.no_cache is False and args.sync is False:
         args.no_cache = True
         print(
             f"[WARNING] --no-cache=True is required for {args.subcommand} subcommand; ",
@@ -65,18 +714,62 @@ def main():
             sep=" ",
         )
 
-    print(
-        f"Including incidents from layers: {', '.join(str(item) for item in args.layers)}"
+    if args.subcommand != "batch":
+        print(
+            f"Including incidents from layers: {', '.join(str(item) for item in args.layers)}"
+        )
+
+    if getattr(args, "server", None):
+        client_report(args)
+        return
+
+    with profile_stage("config"):
+        config = retrieve_config(args.verbose, args.config_file, args.no_cache)
+        set_normalization_rules(compile_normalization_rules(config["normalization"]))
+        api_token = retrieve_token(args.verbose, args.token, args.config_file)
+        team_ids = config["team_ids"]
+    set_request_rate(args.rate_limit)
+    set_sketch_size(args.approximate)
+
+    if args.subcommand == "serve":
+        serve(args, api_token, team_ids)
+        return
+
+    if args.subcommand == "batch":
+        batch_reports(args, api_token, team_ids)
+        return
+
+    if args.stream:
+        stream_report(args, api_token, team_ids)
+        return
+
+    # Reports are made from the incident store or rollups, rather than the
+    # incidents, unless the incidents' clusters come from their alerts or
+    # their resolve times are needed
+    summarized = (
+        args.subcommand != "trend"
+        and args.alert_clusters is False
+        and args.resolve_times is False
+        and (
+            is_incident_store(args.cache_file)
+            or uses_rollups(args.cache_file, args.subcommand, args.breakdown)
+        )
     )
 
     incidents = get_incidents(
         args.days,
         args.layers,
-        retrieve_token(args.verbose, args.token, args.config_file),
-        retrieve_team_ids(args.verbose, args.config_file),
+        api_token,
+        team_ids,
         args.verbose,
         args.cache_file,
         args.no_cache,
+        sync=args.sync,
+        load=summarized is False,
+        periods=args.periods,
+        query_plan=args.query_plan,
+        concurrency=args.concurrency,
+        slice_mode=args.slice,
     )
 
     if incidents is None:
@@ -87,67 +780,902 @@ def main():
         print(f"Incident data saved to {args.cache_file}")
         return
 
-    current_incidents, previous_incidents = split_incidents_by_period(
-        incidents, args.days
-    )
+    if summarized and is_incident_store(args.cache_file):
+        store_report(args)
+        return
 
-    print(
-        f"High incidents in the last {args.days} days before today: {len(current_incidents)}"
-    )
-    print(
-        f"Percent Change from the previous period: {percent_change(len(current_incidents), len(previous_incidents))}%\n"
-    )
+    if summarized:
+        rollup_report(args)
+        return
 
-    debug(
+    if args.alert_clusters:
+        attribute_alert_clusters(
+            incidents,
+            api_token,
+            args.cache_file,
+            args.no_cache,
+            args.concurrency,
+            args.verbose,
+        )
+
+    print_report(
+        incidents,
+        args.subcommand,
+        args.days,
+        args.breakdown,
+        args.count,
         args.verbose,
-        f"Current period incidents ({args.days} days): {len(current_incidents)}",
-        f"Previous period incidents ({args.days} days): {len(previous_incidents)}\n",
+        periods=args.periods,
+        columnar=args.columnar,
+        resolve_times=args.resolve_times,
     )
 
-    if args.subcommand == "alerts":
-        alerts(current_incidents, args.count)
-    elif args.subcommand == "clusters":
-        clusters(current_incidents, args.count)
-    elif args.subcommand == "all":
-        alerts(current_incidents, args.count)
+
+# print_report prints the report for a subcommand: the trend over the
+# periods for trend, otherwise the current period compared with the
+# previous one, broken down by the subcommand's dimensions
+def print_report(
+    incidents,
+    subcommand,
+    days,
+    breakdown,
+    count,
+    verbose,
+    periods=default_period_count,
+    columnar=False,
+    resolve_times=False,
+):
+    dimensions = report_dimensions(subcommand, breakdown)
+
+    if subcommand == "trend":
+        print_trend(
+            split_incidents_into_periods(incidents, days, periods),
+            days,
+            dimensions,
+            count,
+        )
+        return
+
+    if columnar or resolve_times:
+        frame = IncidentFrame(incidents)
+        current = frame.created_at > to_epoch(helpers.today() - timedelta(days=days))
+
+    if columnar:
+        print_period_summary(days, int(current.sum()), int((~current).sum()), verbose)
+        print_aggregation(frame.aggregate(dimensions, current), count)
+    else:
+        current_incidents, previous_incidents = split_incidents_by_period(
+            incidents, days
+        )
+        print_period_summary(
+            days, len(current_incidents), len(previous_incidents), verbose
+        )
+        print_aggregation(aggregate_incidents(current_incidents, dimensions), count)
+
+    if resolve_times:
         print("")
-        clusters(current_incidents, args.count)
+        print_resolve_times(frame, current, count)
 
 
-# Add shared args to the subparsers
-def populate_args(parser):
-    parser.add_argument(
-        "-c",
-        "--count",
-        type=int,
-        required=False,
-        default=default_result_count,
-        help=f"Number of results to display (default: {default_result_count})",
+# report_dimensions returns the dimensions a subcommand reports on, followed
+# by any extra breakdowns that were asked for
+def report_dimensions(subcommand, breakdown=None):
+    dimensions = {
+        "alerts": [("alert",)],
+        "clusters": [("cluster",)],
+        "all": [("alert",), ("cluster",)],
+        "trend": [("alert",), ("cluster",)],
+    }.get(subcommand, [])
+
+    return dimensions + [d for d in breakdown or [] if d not in dimensions]
+
+
+# store_report prints the requested report with queries against the
+# incident store, instead of loading the incidents
+def store_report(args):
+    with closing(open_incident_store(args.cache_file)) as store:
+        current_count, previous_count = store_period_counts(
+            store, args.days, args.layers
+        )
+        print_period_summary(args.days, current_count, previous_count, args.verbose)
+
+        current_since = helpers.today() - timedelta(days=args.days)
+        print_aggregation(
+            {
+                dimension: store_top_counts(
+                    store, dimension, current_since, args.layers, None
+                )
+                for dimension in report_dimensions(args.subcommand, args.breakdown)
+            },
+            args.count,
+        )
+
+
+# attribute_alert_clusters sets the cluster of incidents from services
+# without a cluster name (eg: Zabbix Service) to the cluster named in their
+# alerts. Alerts are fetched concurrently, a batch of incidents at a time,
+# and the cluster found for each incident (or that there was none) is
+# cached by incident id next to the cache file, so each incident's alerts
+# are only fetched once, whichever cache file or window it is read from.
+def attribute_alert_clusters(
+    incidents, api_token, cache_file, no_cache, concurrency, verbose
+):
+    unattributed = [i for i in incidents if i.cluster is None]
+    clusters = {} if no_cache else read_alert_clusters(cache_file, verbose)
+    missing = list(dict.fromkeys(i.id for i in unattributed if i.id not in clusters))
+    debug(
+        verbose,
+        f"{len(unattributed)} incidents without a cluster name; fetching the "
+        f"alerts of {len(missing)}",
     )
-    parser.add_argument(
-        "-l",
-        "--layers",
-        nargs="+",
-        type=int,
-        required=False,
-        choices=pd_layers.keys(),
-        help="Layer (region) to filter",
+
+    # Each worker thread keeps its own session, as for incidents
+    sessions = threading.local()
+
+    def fetch_cluster(incident_id):
+        if not hasattr(sessions, "session"):
+            sessions.session = new_api_session(api_token)
+
+        return alerts_cluster(fetch_incident_alerts(sessions.session, incident_id))
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            for n in range(0, len(missing), alert_fetch_batch_size):
+                batch = missing[n : n + alert_fetch_batch_size]
+                clusters.update(zip(batch, executor.map(fetch_cluster, batch)))
+                # The file is shared by every run; --no-cache neither reads
+                # nor replaces it
+                if no_cache is False:
+                    write_alert_clusters(cache_file, clusters, verbose)
+
+    for i in unattributed:
+        i.cluster = clusters.get(i.id)
+
+    return incidents
+
+
+# alerts_cluster returns the cluster named in the body of the first alert
+# that names one, or None
+def alerts_cluster(alerts):
+    for alert in alerts:
+        cluster = find_cluster(alert.get("body"))
+        if cluster:
+            return cluster
+
+    return None
+
+
+# find_cluster returns the cluster named in alert details, looking for the
+# alert_cluster_keys however deeply the details are nested, and for a
+# cluster label in details sent as text
+def find_cluster(details):
+    if isinstance(details, str):
+        match = alert_cluster_label.search(details)
+        return match.group(1) if match else None
+
+    if isinstance(details, dict):
+        for key in alert_cluster_keys:
+            if isinstance(details.get(key), str) and details[key]:
+                return details[key]
+        values = details.values()
+    elif isinstance(details, list):
+        values = details
+    else:
+        return None
+
+    for value in values:
+        cluster = find_cluster(value)
+        if cluster:
+            return cluster
+
+    return None
+
+
+# alert_clusters_file returns the file the clusters found in alerts are
+# cached in; it is shared by every cache file in the directory
+def alert_clusters_file(cache_file):
+    return cache_file.with_name("alert-clusters.json")
+
+
+# read_alert_clusters reads the clusters found in alerts, by incident id
+def read_alert_clusters(cache_file, verbose):
+    path = alert_clusters_file(cache_file)
+    if path.exists() is False:
+        debug(verbose, f'Alert clusters "{path}" do not exist')
+        return {}
+
+    with path.open() as f:
+        return json.load(f)
+
+
+# write_alert_clusters saves the clusters found in alerts, by incident id
+def write_alert_clusters(cache_file, clusters, verbose):
+    path = alert_clusters_file(cache_file)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    debug(verbose, f"Writing alert clusters: {path}")
+    partial_file = path.with_name(f".partial-{path.name}")
+    with partial_file.open(mode="w+", encoding="utf-8") as f:
+        json.dump(clusters, f)
+    partial_file.replace(path)
+
+
+# rollup_report prints the requested report from a segment cache. Days that
+# are complete and fall entirely within one period are counted from their
+# rollups; only the incidents of the other days (today, and the days the
+# periods start on) are read and normalized.
+def rollup_report(args):
+    window_since = helpers.today() - timedelta(days=args.days * 2)
+    cutoff = helpers.today() - timedelta(days=args.days)
+    dimensions = report_dimensions(args.subcommand, args.breakdown)
+    aggregation = {dimension: new_counts() for dimension in dimensions}
+    counts = {"current": 0, "previous": 0}
+    segments = read_segment_metadata(args.cache_file, args.verbose).get("segments", {})
+    digest = rollup_digest()
+
+    incidents, rolled_up = [], 0
+    for day in segment_days(window_since):
+        if day > cutoff:
+            period = "current"
+        elif day >= window_since and day + timedelta(days=1) <= cutoff:
+            period = "previous"
+        else:
+            period = None
+
+        if (
+            period is None
+            or is_segment_complete(args.cache_file, segments, day) is False
+        ):
+            incidents.extend(
+                read_incidents_from_cache(
+                    segment_file(args.cache_file, day), args.verbose
+                )
+            )
+            continue
+
+        counts[period] += add_rollup(
+            read_rollup(args.cache_file, day, digest, args.verbose),
+            day,
+            args.layers,
+            aggregation if period == "current" else None,
+        )
+        rolled_up += 1
+
+    debug(
+        args.verbose,
+        f"Counted {rolled_up} days from rollups, and {len(incidents)} "
+        "incidents from other days",
     )
-    parser.add_argument(
-        "-d",
-        "--days",
-        type=int,
-        required=False,
-        default=default_days_count,
-        help=f"Number of previous days to include (default: {default_days_count})",
+
+    current, previous = split_incidents_by_period(
+        filter_incidents(incidents, args.layers, window_since), args.days
     )
-    parser.add_argument(
-        "-v",
-        "--verbose",
-        action="store_true",
-        required=False,
-        default=False,
-        help="Enable verbose output",
+    counts["current"] += len(current)
+    counts["previous"] += len(previous)
+    aggregate_incidents(current, dimensions, aggregation)
+
+    print_period_summary(args.days, counts["current"], counts["previous"], args.verbose)
+    print_aggregation(aggregation, args.count)
+
+
+# stream_report counts incidents page by page as they are downloaded and
+# written to the cache (or read back from it), instead of collecting them
+# first, so memory use stays flat however long the window is. Running
+# totals are shown while later pages are still downloading.
+def stream_report(args, api_token, team_ids):
+    window_since = helpers.today() - timedelta(days=args.days * 2)
+    cutoff = to_epoch(helpers.today() - timedelta(days=args.days))
+    counts = {"current": 0, "previous": 0}
+    dimensions = report_dimensions(args.subcommand, args.breakdown)
+    aggregation = {dimension: new_counts() for dimension in dimensions}
+    report = (
+        args.subcommand != "download" and is_incident_store(args.cache_file) is False
+    )
+
+    def count(page):
+        current = []
+        for i in filter_incidents(page, args.layers, window_since):
+            if i.created_at <= cutoff:
+                counts["previous"] += 1
+            else:
+                current.append(i)
+
+        counts["current"] += len(current)
+        aggregate_incidents(current, dimensions, aggregation)
+
+    if should_read_from_cache(
+        args.no_cache,
+        args.cache_file,
+        window_since,
+        team_ids,
+        args.verbose,
+        args.layers,
+    ):
+        debug(args.verbose, f"Cache hit")
+        if report:
+            for page in iter_cache_pages(args.cache_file, args.verbose):
+                count(page)
+
+    else:
+        debug(args.verbose, f"Cache miss; streaming data from PagerDuty API")
+        metadata = read_cache_metadata(args.cache_file, args.verbose)
+        if metadata.get("team_ids") != sorted(team_ids):
+            metadata = {}
+
+        seen, downloaded, watermarks = set(), 0, {}
+        try:
+            windows, covered_layers = plan_incident_queries(
+                api_token,
+                team_ids,
+                window_since,
+                helpers.today(),
+                args.layers,
+                args.query_plan,
+                args.verbose,
+            )
+            with cache_writer(args.cache_file, args.verbose) as write:
+                for page in stream_incident_pages(
+                    args.days,
+                    api_token,
+                    team_ids,
+                    args.verbose,
+                    args.concurrency,
+                    args.slice,
+                    windows=windows,
+                ):
+                    # Slices overlap at their boundaries
+                    page = [
+                        i
+                        for i in page
+                        if i["id"] not in seen and i["urgency"] == "high"
+                    ]
+                    seen.update(i["id"] for i in page)
+
+                    with profile_stage("cache write"):
+                        write(page)
+                    update_watermarks(watermarks, page)
+                    downloaded += len(page)
+
+                    if report:
+                        count(page)
+                        print(
+                            f"[PROGRESS] {downloaded} incidents downloaded; "
+                            f"{counts['current']} in the last {args.days} days so far",
+                            file=sys.stderr,
+                        )
+
+        except import_pdpyras().PDClientError as e:
+            if e.response:
+                if e.response.status_code == 404:
+                    print("User not found")
+                    return
+                elif e.response.status_code == 401:
+                    raise e
+            else:
+                raise e
+
+        write_cache_metadata(
+            [],
+            args.cache_file,
+            cache_since(args.cache_file, metadata, window_since),
+            team_ids,
+            args.verbose,
+            watermarks=None if is_incident_store(args.cache_file) else watermarks,
+            layers=covered_layers,
+        )
+        debug(args.verbose, f"Found {downloaded} incidents")
+
+    if args.subcommand == "download":
+        print(f"Incident data saved to {args.cache_file}")
+        return
+
+    if is_incident_store(args.cache_file):
+        store_report(args)
+        return
+
+    print_period_summary(args.days, counts["current"], counts["previous"], args.verbose)
+
+    print_aggregation(aggregation, args.count)
+
+
+# print_period_summary prints the incident count for the current period,
+# and the change from the previous period
+def print_period_summary(days, current_count, previous_count, verbose):
+    print(f"High incidents in the last {days} days before today: {current_count}")
+    print(
+        f"Percent Change from the previous period: {percent_change(current_count, previous_count)}%\n"
+    )
+
+    debug(
+        verbose,
+        f"Current period incidents ({days} days): {current_count}",
+        f"Previous period incidents ({days} days): {previous_count}\n",
+    )
+
+
+# serve keeps the incidents for the layers and window in memory, answering
+# report requests from clients (see client_report) over a Unix socket or
+# localhost HTTP. The incidents are refreshed with an incremental sync every
+# --refresh seconds; reports are remembered until the next refresh.
+def serve(args, api_token, team_ids):
+    state = {"incidents": [], "reports": {}}
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def refresh():
+        incidents = get_incidents(
+            args.days,
+            args.layers,
+            api_token,
+            team_ids,
+            args.verbose,
+            args.cache_file,
+            args.no_cache,
+            sync=args.sync,
+            query_plan=args.query_plan,
+            concurrency=args.concurrency,
+            slice_mode=args.slice,
+        )
+        incidents = incidents or []
+        if args.columnar:
+            incidents = IncidentFrame(incidents)
+        with lock:
+            state["incidents"] = incidents
+            state["reports"] = {}
+        debug(args.verbose, f"Serving {len(incidents)} incidents")
+
+    def refresh_periodically():
+        while stopped.wait(args.refresh) is False:
+            try:
+                refresh()
+            except Exception as e:
+                print(f"[WARNING] Refresh failed, serving older data: {e}")
+
+    def report(query):
+        request = report_request(query, args.days, args.layers)
+        # Reports are kept until the next refresh, and for the day they
+        # cover, so repeated requests are only computed once
+        key = (helpers.today().date(), *request.values())
+        with lock:
+            if key not in state["reports"]:
+                state["reports"][key] = incident_report(state["incidents"], **request)
+            return state["reports"][key]
+
+    refresh()
+    threading.Thread(target=refresh_periodically, daemon=True).start()
+
+    if args.port is None:
+        args.socket.parent.mkdir(parents=True, exist_ok=True)
+        args.socket.unlink(missing_ok=True)
+        server = report_server(args.socket, report, args.verbose)
+        print(f"Serving reports on {args.socket}")
+    else:
+        server = report_server(args.port, report, args.verbose)
+        print(f"Serving reports on http://localhost:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopped.set()
+        server.server_close()
+        if args.port is None:
+            args.socket.unlink(missing_ok=True)
+
+
+# batch_reports produces every report in the manifest. The incidents of
+# each distinct team are downloaded (or read from the cache) once, for the
+# longest window any report needs, with the teams downloading concurrently.
+# Each report is then made from the normalized incidents of its teams, and
+# written to its own output file.
+def batch_reports(args, api_token, team_ids):
+    reports = read_manifest(args, team_ids)
+    if not reports:
+        print(f"No reports found in {args.manifest}")
+        return
+
+    # Reports without teams are for all of the user's teams
+    windows = {}
+    for report in reports:
+        for team_id in report["team_ids"] or [None]:
+            windows[team_id] = max(
+                windows.get(team_id, 0), report["days"] * report["periods"]
+            )
+
+    def fetch(team_id):
+        return get_incidents(
+            windows[team_id],
+            pd_layers.keys(),
+            api_token,
+            [] if team_id is None else [team_id],
+            args.verbose,
+            team_cache_file(args.cache_file, team_id),
+            args.no_cache,
+            sync=args.sync,
+            periods=1,
+            concurrency=args.concurrency,
+            slice_mode=args.slice,
+        )
+
+    with ThreadPoolExecutor(
+        max_workers=min(len(windows), max_request_concurrency)
+    ) as executor:
+        team_incidents = dict(zip(windows, executor.map(fetch, windows)))
+
+    for report in reports:
+        window_since = to_epoch(
+            helpers.today() - timedelta(days=report["days"] * report["periods"])
+        )
+        incidents = {}
+        for team_id in report["team_ids"] or [None]:
+            for i in team_incidents[team_id] or []:
+                if i.created_at >= window_since and i.in_layers(report["layers"]):
+                    incidents.setdefault(i.id, i)
+
+        output = report["output"] or args.output_dir.joinpath(f"{report['name']}.txt")
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with output.open("w") as f, redirect_stdout(f):
+            print(
+                "Including incidents from layers: "
+                f"{', '.join(str(layer) for layer in report['layers'])}"
+            )
+            print_report(
+                sorted(incidents.values(), key=lambda i: i.created_at),
+                report["subcommand"],
+                report["days"],
+                report["breakdown"],
+                report["count"],
+                args.verbose,
+                periods=report["periods"],
+            )
+
+        print(f"Report {report['name']} saved to {output}")
+
+
+# read_manifest reads the report definitions from the batch manifest. The
+# command line --days, --layers and --count are the defaults for reports
+# that do not set them, and the config file's team ids for reports without
+# team_ids or a config_file of their own to read them from.
+#
+# The format of the manifest is:
+#
+# reports:
+#   - name: platform
+#     team_ids: [TEAMID1, TEAMID2]
+#     subcommand: all
+#     layers: [4, 5]
+#     days: 7
+#   - name: platform-trend
+#     config_file: ~/.config/pagerduty/platform.yml
+#     subcommand: trend
+#     periods: 12
+#     breakdown: ["alert:cluster"]
+#     output: trends/platform.txt
+#
+def read_manifest(args, team_ids):
+    debug(args.verbose, f"Reading batch manifest: {args.manifest}")
+    reports = []
+    for entry in (read_config(args.manifest) or {}).get("reports") or []:
+        name = entry.get("name")
+        if not name:
+            raise SystemExit("Every report in the manifest needs a name")
+
+        subcommand = entry.get("subcommand", "all")
+        if subcommand not in ["alerts", "clusters", "all", "trend"]:
+            raise SystemExit(f"Report {name}: unknown subcommand {subcommand}")
+
+        layers = list(entry.get("layers", args.layers))
+        if not set(layers) <= set(pd_layers):
+            raise SystemExit(f"Report {name}: unknown layers {layers}")
+
+        if "team_ids" in entry:
+            report_team_ids = entry["team_ids"]
+        elif "config_file" in entry:
+            report_team_ids = retrieve_team_ids(
+                args.verbose, Path(entry["config_file"]).expanduser()
+            )
+        else:
+            report_team_ids = team_ids
+
+        try:
+            breakdown = [parse_dimension(b) for b in entry.get("breakdown", [])]
+        except argparse.ArgumentTypeError as e:
+            raise SystemExit(f"Report {name}: {e}")
+
+        reports.append(
+            {
+                "name": name,
+                "subcommand": subcommand,
+                "team_ids": sorted(report_team_ids),
+                "layers": layers,
+                "days": int(entry.get("days", args.days)),
+                "periods": int(
+                    entry.get(
+                        "periods",
+                        default_trend_periods
+                        if subcommand == "trend"
+                        else default_period_count,
+                    )
+                ),
+                "count": int(entry.get("count", args.count)),
+                "breakdown": breakdown,
+                "output": Path(entry["output"]) if entry.get("output") else None,
+            }
+        )
+
+    return reports
+
+
+# team_cache_file returns the cache file for one team's incidents in batch
+# mode, named after the team, so teams do not overwrite each other's cache
+def team_cache_file(cache_file, team_id):
+    if team_id is None:
+        return cache_file
+
+    stem, separator, suffix = cache_file.name.partition(".")
+    return cache_file.with_name(f"{stem}_{team_id}{separator}{suffix}")
+
+
+# report_request parses and checks the query of a report request against
+# the window and layers the server holds
+def report_request(query, server_days, server_layers):
+    subcommand = query.get("subcommand", ["all"])[0]
+    if subcommand not in ["alerts", "clusters", "all"]:
+        raise ValueError(f"Unknown report: {subcommand}")
+
+    days = int(query.get("days", [default_days_count])[0])
+    if not 0 < days <= server_days:
+        raise ValueError(f"The server holds at most {server_days} days")
+
+    layers = tuple(int(layer) for layer in query.get("layers", server_layers))
+    if not set(layers) <= set(server_layers):
+        raise ValueError(
+            "The server holds layers "
+            f"{', '.join(str(layer) for layer in server_layers)}"
+        )
+
+    return {
+        "subcommand": subcommand,
+        "days": days,
+        "layers": layers,
+        "count": int(query.get("count", [default_result_count])[0]),
+        "breakdown": tuple(parse_dimension(b) for b in query.get("breakdown", [])),
+    }
+
+
+# incident_report returns the period counts and aggregation a report
+# prints, in a form that can be sent to a client as JSON. The incidents can
+# be an IncidentFrame, to filter and count them all at once.
+def incident_report(incidents, subcommand, days, layers, count, breakdown):
+    window_since = to_epoch(helpers.today() - timedelta(days=days * 2))
+    dimensions = report_dimensions(subcommand, list(breakdown))
+
+    if isinstance(incidents, IncidentFrame):
+        frame = incidents
+        window = (frame.created_at >= window_since) & frame.in_layers(layers)
+        current = window & (
+            frame.created_at > to_epoch(helpers.today() - timedelta(days=days))
+        )
+        current_count = int(current.sum())
+        previous_count = int(window.sum()) - current_count
+        aggregation = frame.aggregate(dimensions, current)
+    else:
+        current, previous = split_incidents_by_period(
+            [
+                i
+                for i in incidents
+                if i.created_at >= window_since and i.in_layers(layers)
+            ],
+            days,
+        )
+        current_count, previous_count = len(current), len(previous)
+        aggregation = aggregate_incidents(current, dimensions)
+
+    return {
+        "current": current_count,
+        "previous": previous_count,
+        "aggregation": [
+            aggregation_report(dimension, counts, count)
+            for dimension, counts in aggregation.items()
+        ],
+    }
+
+
+# aggregation_report returns the rows of a dimension for a client, with the
+# error bound of each count if they were counted approximately
+def aggregation_report(dimension, counts, count):
+    rows = aggregation_rows(dimension, counts, count)
+    report = {"dimension": dimension, "counts": rows}
+    if isinstance(counts, TopKSketch):
+        report["errors"] = [counts.error(k) for k, _ in rows]
+
+    return report
+
+
+# client_report asks a server started with the serve subcommand for a
+# report, and prints it, instead of loading the incidents itself
+def client_report(args):
+    query = urlencode(
+        {
+            "subcommand": args.subcommand,
+            "days": args.days,
+            "layers": list(args.layers),
+            "count": args.count,
+            "breakdown": [":".join(b) for b in args.breakdown or []],
+        },
+        doseq=True,
+    )
+
+    report = request_report(args.server, f"/report?{query}")
+    if "error" in report:
+        raise SystemExit(f"Server error: {report['error']}")
+
+    aggregation, errors = {}, {}
+    for a in report["aggregation"]:
+        dimension = tuple(a["dimension"])
+        keys = [tuple(k) if isinstance(k, list) else k for k, _ in a["counts"]]
+        aggregation[dimension] = [(k, v) for k, (_, v) in zip(keys, a["counts"])]
+        if "errors" in a:
+            errors[dimension] = dict(zip(keys, a["errors"]))
+
+    print_period_summary(args.days, report["current"], report["previous"], args.verbose)
+    print_aggregation(aggregation, args.count, errors)
+
+
+# report_server returns a server answering GET /report requests with the
+# report function's result as JSON, on a Unix socket path or a localhost
+# port. The HTTP modules are imported here, as only serve needs them.
+def report_server(address, report, verbose):
+    import socketserver
+
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class ReportRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/report":
+                self.send_report(404, {"error": f"Not found: {url.path}"})
+                return
+
+            try:
+                self.send_report(200, report(parse_qs(url.query)))
+            except (ValueError, argparse.ArgumentTypeError) as e:
+                self.send_report(400, {"error": str(e)})
+
+        def send_report(self, status, body):
+            body = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            debug(verbose, format % args)
+
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if isinstance(address, int):
+        return ThreadingHTTPServer(("localhost", address), ReportRequestHandler)
+
+    return UnixHTTPServer(str(address), ReportRequestHandler)
+
+
+# request_report sends a GET request to a report server, given the path of
+# its Unix socket or its http:// URL, and returns the JSON response
+def request_report(server, path):
+    import http.client
+    import socket
+
+    class UnixHTTPConnection(http.client.HTTPConnection):
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(server)
+
+    if server.startswith("http://"):
+        url = urlparse(server)
+        connection = http.client.HTTPConnection(url.hostname, url.port)
+    else:
+        connection = UnixHTTPConnection("localhost")
+
+    try:
+        connection.request("GET", path)
+        return json.load(connection.getresponse())
+    finally:
+        connection.close()
+
+
+# Add client args to the report subparsers
+def populate_client_args(parser):
+    parser.add_argument(
+        "--server",
+        type=str,
+        required=False,
+        help="Ask a server started with the serve subcommand for the report: "
+        "the path of its Unix socket, or its http://localhost:PORT URL",
+    )
+
+
+# Add shared args to the subparsers
+def populate_args(parser):
+    parser.add_argument(
+        "-c",
+        "--count",
+        type=int,
+        required=False,
+        default=default_result_count,
+        help=f"Number of results to display (default: {default_result_count})",
+    )
+    parser.add_argument(
+        "-l",
+        "--layers",
+        nargs="+",
+        type=int,
+        required=False,
+        choices=pd_layers.keys(),
+        help="Layer (region) to filter",
+    )
+    parser.add_argument(
+        "-d",
+        "--days",
+        type=int,
+        required=False,
+        default=default_days_count,
+        help=f"Number of previous days to include (default: {default_days_count})",
+    )
+    parser.add_argument(
+        "-b",
+        "--breakdown",
+        nargs="+",
+        type=parse_dimension,
+        required=False,
+        help="Extra breakdowns of the current period, by "
+        f"{', '.join(aggregate_columns)}, or columns crossed with ':' "
+        "(eg: alert:cluster)",
+    )
+    parser.add_argument(
+        "--approximate",
+        type=int,
+        required=False,
+        metavar="SIZE",
+        help="Count the top values approximately, in fixed memory, tracking at "
+        "most SIZE values per breakdown, and show the error bound of each count",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Enable verbose output",
+    )
+    parser.add_argument(
+        "-j",
+        "--concurrency",
+        type=int,
+        required=False,
+        default=default_concurrency,
+        help="Number of time slices to download in parallel "
+        f"(default: {default_concurrency})",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        required=False,
+        default=default_request_rate,
+        help="Requests per second to the PagerDuty API, shared by all threads "
+        f"(default: {default_request_rate:g})",
+    )
+    parser.add_argument(
+        "--slice",
+        type=str,
+        required=False,
+        choices=fetch_slice_modes,
+        default=default_fetch_slice_mode,
+        help="How to split the download window when --concurrency is greater "
+        f"than 1 (default: {default_fetch_slice_mode})",
     )
 
     auth_group = parser.add_mutually_exclusive_group()
@@ -163,162 +1691,1748 @@ def populate_args(parser):
         "-t", "--token", type=str, required=False, help="PagerDuty API token"
     )
 
-    cache_group = parser.add_mutually_exclusive_group()
-    cache_group.add_argument(
-        "--no-cache",
-        action="store_true",
-        required=False,
-        default=False,
-        help="Disable caching",
-    )
-    cache_group.add_argument(
-        "--cache-file",
-        type=lambda p: Path(p).absolute(),
-        required=False,
-        help="Path to alternative cache file, Pagerduty-formatted",
-    )
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument(
+        "--no-cache",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Disable caching",
+    )
+    cache_group.add_argument(
+        "--cache-file",
+        type=lambda p: Path(p).absolute(),
+        required=False,
+        help="Path to alternative cache file; its format follows its suffix: "
+        "projected JSON Lines (.jsonl, optionally .gz or .zst), an incident "
+        "store (.sqlite3), a segment cache directory (.segments), or "
+        "otherwise a JSON list of PagerDuty incidents",
+    )
+    parser.add_argument(
+        "--cache-format",
+        type=str,
+        required=False,
+        choices=cache_formats,
+        default=default_cache_format,
+        help=f"Format of the default cache file (default: {default_cache_format})",
+    )
+    parser.add_argument(
+        "--query-plan",
+        type=str,
+        required=False,
+        choices=query_plans,
+        default=default_query_plan,
+        help="How to download incidents when only some layers are requested: "
+        "one wide query, queries for just their shifts, or whichever needs "
+        f"fewer requests (default: {default_query_plan})",
+    )
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Filter, split and count the incidents as NumPy arrays "
+        "(requires numpy)",
+    )
+    parser.add_argument(
+        "--resolve-times",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Also show how long the incidents of the current period took to "
+        "resolve, overall and for the top alerts (requires numpy)",
+    )
+    parser.add_argument(
+        "--alert-clusters",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Attribute incidents of services without a cluster name to the "
+        "cluster named in their alerts, fetching each incident's alerts once",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Count incidents page by page as they are downloaded, "
+        "showing running totals",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Update the cache with only new or changed incidents",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Print the time and peak memory of each stage, and the API "
+        "requests, to stderr",
+    )
+    parser.add_argument(
+        "--profile-output",
+        type=Path,
+        required=False,
+        help="Also write the --profile results as JSON to this file",
+    )
+    parser.set_defaults(periods=default_period_count)
+
+    return parser
+
+
+# cache_to_file wraps get_incidents and writes the results to a cache file,
+# or returns caches results if appropriate. The cache holds every incident
+# for the teams, and the requested layers are filtered out as it is read.
+# With load=False, an incident store is only brought up to date, and the
+# incidents are not read back out of it.
+def cache_to_file(get_incidents_func):
+    def decorator(
+        days,
+        layers,
+        api_token,
+        team_ids,
+        verbose,
+        cache_file,
+        no_cache,
+        sync=False,
+        load=True,
+        query_plan=default_query_plan,
+        periods=default_period_count,
+        **kwargs,
+    ):
+        window_since = helpers.today() - timedelta(days=days * periods)
+
+        # A segment cache is assembled day by day, fetching only the days
+        # it is missing; it is always incremental, so --sync changes nothing
+        if is_segment_cache(cache_file):
+
+            # fetch_day downloads the incidents of one day's window, or
+            # returns None if they could not all be downloaded
+            def fetch_day(window):
+                try:
+                    return get_incidents_func(
+                        days,
+                        api_token,
+                        team_ids,
+                        verbose,
+                        since=window[0],
+                        windows=[window],
+                        strict=True,
+                        **kwargs,
+                    )
+                except IncompleteDownloadError as e:
+                    print(f"[WARNING] {e}")
+                except import_pdpyras().PDClientError as e:
+                    if e.response is not None and e.response.status_code == 401:
+                        raise e
+                    print(
+                        "[WARNING] Could not download the incidents from "
+                        f"{format_pd_time(window[0])}: {e}"
+                    )
+
+                return None
+
+            # fetch_days downloads each day's window concurrently, returning
+            # the incidents of each, or None for those that failed
+            def fetch_days(windows):
+                concurrency = max(kwargs.get("concurrency", default_concurrency), 1)
+                with profile_stage("fetch"), ThreadPoolExecutor(
+                    max_workers=concurrency
+                ) as executor:
+                    return list(executor.map(fetch_day, windows))
+
+            return filter_incidents(
+                read_segment_cache(
+                    fetch_days,
+                    cache_file,
+                    window_since,
+                    team_ids,
+                    no_cache,
+                    verbose,
+                    load,
+                ),
+                layers,
+                window_since,
+            )
+
+        metadata = read_cache_metadata(cache_file, verbose)
+
+        # fetch downloads the incidents since the given time, following the
+        # query plan, and returns them with the layers they cover
+        def fetch(since):
+            with profile_stage("fetch"):
+                windows, covered_layers = plan_incident_queries(
+                    api_token,
+                    team_ids,
+                    since,
+                    helpers.today(),
+                    layers,
+                    query_plan,
+                    verbose,
+                )
+                incidents = get_incidents_func(
+                    days,
+                    api_token,
+                    team_ids,
+                    verbose,
+                    since=since,
+                    windows=windows,
+                    **kwargs,
+                )
+            return incidents, covered_layers
+
+        # Fetch only what changed since the last sync, and merge it in
+        if sync and no_cache is False and cache_file.exists():
+            if is_incident_store(cache_file):
+                cached = read_incidents_from_cache(cache_file, verbose, open_only=True)
+            else:
+                cached = read_incidents_from_cache(cache_file, verbose)
+            if metadata.get("team_ids") != sorted(team_ids):
+                debug(verbose, "Cache is for different teams, syncing everything")
+                cached, metadata = [], {}
+            elif cache_covers_layers(metadata, layers) is False:
+                debug(verbose, "Cache is for different layers, syncing everything")
+                metadata = {}
+
+            since = sync_since(cached, metadata, window_since)
+            debug(verbose, f"Syncing incidents created since {format_pd_time(since)}")
+
+            incidents, covered_layers = fetch(since)
+            debug(verbose, f"Sync found {len(incidents)} new or changed incidents")
+
+            # Older incidents only cover the layers the cache already did
+            if metadata:
+                covered_layers = combine_covered_layers(
+                    metadata.get("layers"), covered_layers
+                )
+
+            if is_incident_store(cache_file) is False:
+                window_start = format_pd_time(window_since)
+                incidents = [
+                    i
+                    for i in merge_incidents(cached, incidents)
+                    if i["created_at"] >= window_start
+                ]
+
+            write_incidents_to_cache(incidents, cache_file, verbose)
+            write_cache_metadata(
+                incidents,
+                cache_file,
+                cache_since(cache_file, metadata, window_since),
+                team_ids,
+                verbose,
+                layers=covered_layers,
+            )
+
+            if is_incident_store(cache_file):
+                return read_filtered_incidents(
+                    cache_file, layers, window_since, load, verbose
+                )
+
+            return filter_incidents(incidents, layers, window_since)
+
+        # Just read incidents from cache file if appropriate
+        if should_read_from_cache(
+            no_cache, cache_file, window_since, team_ids, verbose, layers
+        ):
+            debug(verbose, f"Cache hit")
+            return read_filtered_incidents(
+                cache_file, layers, window_since, load, verbose
+            )
+
+        # Retrieve data from PagerDuty API
+        # with the get_incidents function
+        debug(verbose, f"Cache miss; retrieving data from PagerDuty API")
+        incidents, covered_layers = fetch(window_since)
+
+        if metadata.get("team_ids") != sorted(team_ids):
+            metadata = {}
+
+        # An incident store keeps what it had, which only covers the layers
+        # it already did
+        if is_incident_store(cache_file) and metadata:
+            covered_layers = combine_covered_layers(
+                metadata.get("layers"), covered_layers
+            )
+
+        write_incidents_to_cache(incidents, cache_file, verbose)
+        write_cache_metadata(
+            incidents,
+            cache_file,
+            cache_since(cache_file, metadata, window_since),
+            team_ids,
+            verbose,
+            layers=covered_layers,
+        )
+
+        if is_incident_store(cache_file) and load is False:
+            return []
+
+        return filter_incidents(incidents, layers, window_since)
+
+    return decorator
+
+
+# read_filtered_incidents reads the incidents in the requested layers and
+# window back out of the cache, unless load is False for an incident store
+def read_filtered_incidents(cache_file, layers, since, load, verbose):
+    if is_incident_store(cache_file) and load is False:
+        return []
+
+    incidents = read_incidents_from_cache(cache_file, verbose)
+    debug(verbose, f"Read {len(incidents)} items from cache")
+
+    return filter_incidents(incidents, layers, since)
+
+
+# filter_incidents returns Incident records for the incidents created in
+# the requested layers, since the start of the window
+def filter_incidents(incidents, layers, since):
+    window_start = format_pd_time(since)
+
+    with profile_stage("layer filtering"):
+        incidents = [
+            i
+            for i in incidents
+            if i["created_at"] >= window_start and is_in_layer(i["created_at"], layers)
+        ]
+
+    with profile_stage("normalization"):
+        return normalize_incidents(incidents)
+
+
+# normalize_incidents returns Incident records for the incidents. Large
+# lists are split into chunks whose times are parsed and names normalized
+# in a pool of worker processes, one per CPU; the results come back in
+# order, so the records are the same as when they are built one by one.
+def normalize_incidents(incidents):
+    workers = normalization_workers()
+    if len(incidents) < parallel_normalization_threshold or workers <= 1:
+        return [Incident.from_pagerduty(i) for i in incidents]
+
+    # Only the fields being parsed are sent to the workers
+    rows = [
+        (
+            i["created_at"],
+            i.get("last_status_change_at"),
+            i["summary"],
+            i["service"]["summary"],
+        )
+        for i in incidents
+    ]
+    size = max(normalization_chunk_size, math.ceil(len(rows) / (workers * 4)))
+    chunks = [rows[n : n + size] for n in range(0, len(rows), size)]
+
+    # Workers are spawned rather than forked, as forking a process with
+    # other threads running (eg: serve's) can deadlock on locks they hold,
+    # and are given the rules in use
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(chunks)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=set_normalization_rules,
+        initargs=(dict(normalization_rules),),
+    ) as executor:
+        normalized = chain.from_iterable(executor.map(normalize_rows, chunks))
+
+        return [
+            Incident.from_pagerduty(i, row) for i, row in zip(incidents, normalized)
+        ]
+
+
+# normalize_rows parses and normalizes a chunk of rows in a worker process
+def normalize_rows(rows):
+    return [normalize_row(*row) for row in rows]
+
+
+# normalize_row returns the creation and last status change times of an
+# incident as seconds since the epoch, and its alert and cluster names
+def normalize_row(created_at, last_status_change_at, summary, service):
+    return (
+        parse_pd_time(created_at),
+        parse_pd_time(last_status_change_at) if last_status_change_at else None,
+        *normalize_names(summary, service),
+    )
+
+
+# normalize_names returns the alert name for an incident summary, and the
+# cluster name for its service, or None for services without a cluster
+def normalize_names(summary, service):
+    return (
+        parse_description_for_alerts(summary),
+        None
+        if service in cluster_excluded_services
+        else parse_description_for_cluster(service),
+    )
+
+
+# normalization_workers returns the number of CPUs this process can use
+def normalization_workers():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# select_cache_file returns the file name based on the
+# provided cache_file input argument, or a default if None;
+# synced caches, incident stores and segment caches are updated in place,
+# so they are not named by date
+def select_cache_file(cache_file, sync=False, cache_format=default_cache_format):
+
+    prefix_string = "incident-cache"
+    date_string = "sync" if sync else str(helpers.today().date())
+
+    cache_file_name = f"{prefix_string}_{date_string}.{cache_format}"
+    if cache_format == "sqlite":
+        cache_file_name = f"{prefix_string}.sqlite3"
+    elif cache_format == "segments":
+        cache_file_name = f"{prefix_string}.segments"
+
+    file = (
+        Path(cache_file).absolute()
+        if cache_file
+        else Path.home().joinpath(".cache", "toil-review-metrics", cache_file_name)
+    )
+
+    return file
+
+
+# should_read_from_cache returns True if the cache file exists and the
+# --no-cache flag is set, and the cache file is not stale (older than a day)
+# and covers the requested window and layers for the same teams
+def should_read_from_cache(no_cache, cache_file, since, team_ids, verbose, layers=()):
+    # Never read from cache if --no-cache is set
+    if no_cache is True:
+        debug(verbose, f"-no-cache flag set, not reading from cache")
+        return False
+
+    # Can't read from cache if cache file doesn't exist
+    if cache_file.exists() is False:
+        debug(
+            verbose, f'Cache file "{cache_file}" does not exist, not reading from cache'
+        )
+        return False
+
+    # Don't read from cache if cache file is older than 1 day
+    cache_file_mtime = datetime.fromtimestamp(cache_file.stat().st_mtime)
+
+    if cache_file_mtime < (datetime.now() - timedelta(days=1)):
+        debug(
+            verbose,
+            f'Cache file "{cache_file}" is stale ({cache_file_mtime}), '
+            f"not reading from cache",
+        )
+        return False
+
+    # Custom cache files without metadata are used as they are
+    metadata = read_cache_metadata(cache_file, verbose)
+    if not metadata:
+        return True
+
+    if metadata.get("team_ids") != sorted(team_ids):
+        debug(verbose, f'Cache file "{cache_file}" is for different teams')
+        return False
+
+    if cache_covers_layers(metadata, layers) is False:
+        debug(
+            verbose,
+            f'Cache file "{cache_file}" only covers layers {metadata["layers"]}',
+        )
+        return False
+
+    if metadata.get("since") is None or metadata["since"] > format_pd_time(since):
+        debug(
+            verbose,
+            f'Cache file "{cache_file}" starts at {metadata.get("since")}, '
+            f"after the requested window; not reading from cache",
+        )
+        return False
+
+    return True
+
+
+# read_incidents_from_cache reads incidents from the cache file; with
+# open_only, only the incidents that are not resolved yet
+@profile_stage("cache read")
+def read_incidents_from_cache(cache_file, verbose, open_only=False):
+    debug(verbose, f"Getting incidents from cache file: {cache_file}")
+    if is_incident_store(cache_file):
+        with closing(open_incident_store(cache_file)) as store:
+            return read_incidents_from_store(store, open_only)
+
+    if is_projected_cache(cache_file):
+        with open_projected_cache(cache_file, "rt") as f:
+            incidents = [json.loads(line) for line in f if line.strip()]
+    else:
+        with cache_file.open() as f:
+            incidents = json.load(f)
+
+    if open_only:
+        return [i for i in incidents if i.get("status") != "resolved"]
+
+    return incidents
+
+
+# write_incidents_to_cache writes incidents to the cache file; an incident
+# store keeps the incidents it already has, and updates them by id
+@profile_stage("cache write")
+def write_incidents_to_cache(incidents, cache_file, verbose):
+    with cache_writer(cache_file, verbose) as write:
+        write(incidents)
+
+
+# cache_writer opens the cache file for writing, and yields a function that
+# appends a list of incidents to it, so incidents can be written as they
+# are downloaded. Files are written next to the cache and moved into place
+# once complete, so an interrupted download never leaves a partial cache.
+@contextmanager
+def cache_writer(cache_file, verbose):
+    cache_dir = cache_file.parents[0]
+
+    if cache_dir.exists() is False:
+        debug(verbose, f"Creating cache directory: {cache_dir}")
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+    debug(verbose, f"Writing cache file: {cache_file}")
+    if is_incident_store(cache_file):
+        with closing(open_incident_store(cache_file)) as store:
+            yield lambda incidents: upsert_incidents(store, incidents)
+        return
+
+    partial_file = cache_file.with_name(f".partial-{cache_file.name}")
+
+    try:
+        if is_projected_cache(cache_file):
+            with open_projected_cache(partial_file, "wt") as f:
+
+                def write(incidents):
+                    for i in incidents:
+                        f.write(json.dumps(project_incident(i), separators=(",", ":")))
+                        f.write("\n")
+
+                yield write
+
+        else:
+            with partial_file.open(mode="w+", newline="", encoding="utf-8") as f:
+                separator = ""
+
+                def write(incidents):
+                    nonlocal separator
+                    for i in incidents:
+                        f.write(separator)
+                        json.dump(i, f)
+                        separator = ", "
+
+                f.write("[")
+                yield write
+                f.write("]")
+
+    except BaseException:
+        partial_file.unlink(missing_ok=True)
+        raise
+
+    partial_file.replace(cache_file)
+
+
+# iter_cache_pages yields the incidents in the cache file a page at a time,
+# without reading the whole of a JSON Lines cache or incident store at once
+def iter_cache_pages(cache_file, verbose):
+    debug(verbose, f"Getting incidents from cache file: {cache_file}")
+    if is_incident_store(cache_file):
+        with closing(open_incident_store(cache_file)) as store:
+            rows = store.execute("SELECT data FROM incidents ORDER BY created_at")
+            while True:
+                page = rows.fetchmany(pd_page_size)
+                if not page:
+                    return
+                yield [json.loads(row[0]) for row in page]
+
+    if is_projected_cache(cache_file) is False:
+        yield read_incidents_from_cache(cache_file, verbose)
+        return
+
+    with open_projected_cache(cache_file, "rt") as f:
+        page = []
+        for line in f:
+            if line.strip():
+                page.append(json.loads(line))
+            if len(page) == pd_page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+
+# is_projected_cache returns True if the cache file is a JSON Lines cache
+# of projected incidents, rather than the raw PagerDuty JSON list
+def is_projected_cache(cache_file):
+    return any(cache_file.name.endswith(suffix) for suffix in projected_suffixes)
+
+
+# open_projected_cache opens a JSON Lines cache file as text, compressed
+# according to its suffix. zstd needs the optional zstandard package.
+def open_projected_cache(cache_file, mode):
+    if cache_file.name.endswith(".gz"):
+        return gzip.open(cache_file, mode, encoding="utf-8")
+
+    if cache_file.name.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise SystemExit(
+                "The zstandard package is required for .jsonl.zst cache files; "
+                "install it, or use --cache-format jsonl.gz"
+            )
+        return zstandard.open(cache_file, mode, encoding="utf-8")
+
+    return cache_file.open(mode=mode, newline="", encoding="utf-8")
+
+
+# project_incident returns only the incident fields the reports use
+def project_incident(incident):
+    projected = {k: incident.get(k) for k in cache_fields}
+    projected["service"] = {"summary": incident["service"]["summary"]}
+
+    return projected
+
+
+# cache_metadata_file returns the file next to the cache that records the
+# window and teams the cache covers, and how far it has been synced
+def cache_metadata_file(cache_file):
+    return cache_file.with_name(f"{cache_file.name}.meta.json")
+
+
+# read_cache_metadata reads the metadata for the cache file, if any
+def read_cache_metadata(cache_file, verbose):
+    metadata_file = cache_metadata_file(cache_file)
+    if metadata_file.exists() is False:
+        debug(verbose, f'Cache metadata "{metadata_file}" does not exist')
+        return {}
+
+    with metadata_file.open() as f:
+        metadata = json.load(f)
+
+    debug(verbose, f"Cache metadata: {metadata}")
+    return metadata
+
+
+# write_cache_metadata records the window, teams and layers (None for all
+# of them) the cache covers, and
+# the newest created_at and last_status_change_at in the cache, as the
+# watermarks for the next sync
+def write_cache_metadata(
+    incidents, cache_file, since, team_ids, verbose, watermarks=None, layers=None
+):
+    metadata = {
+        "since": format_pd_time(since),
+        "until": format_pd_time(helpers.today()),
+        "team_ids": sorted(team_ids),
+        "layers": sorted(layers) if layers is not None else None,
+        **(watermarks or cache_watermarks(incidents, cache_file)),
+    }
+
+    debug(verbose, f"Writing cache metadata: {metadata}")
+    with cache_metadata_file(cache_file).open(mode="w+", encoding="utf-8") as f:
+        json.dump(metadata, f)
+
+
+# cache_watermarks returns the newest created_at and last_status_change_at
+# of the incidents written to the cache; an incident store is asked for
+# its own, since it holds more than was just written
+def cache_watermarks(incidents, cache_file):
+    if is_incident_store(cache_file):
+        with closing(open_incident_store(cache_file)) as store:
+            return store_watermarks(store)
+
+    return incident_watermarks(incidents)
+
+
+# incident_watermarks returns the newest created_at and last_status_change_at
+# of the incidents
+def incident_watermarks(incidents):
+    return {
+        "created_at": max((i["created_at"] for i in incidents), default=None),
+        "last_status_change_at": max(
+            (i.get("last_status_change_at") or i["created_at"] for i in incidents),
+            default=None,
+        ),
+    }
+
+
+# cache_covers_layers returns True if the cache metadata covers all of the
+# requested layers; caches without a record of their layers cover all
+def cache_covers_layers(metadata, layers):
+    if metadata.get("layers") is None:
+        return True
+
+    return set(layers) <= set(metadata["layers"])
+
+
+# combine_covered_layers returns the layers covered by a cache made of two
+# downloads covering each set of layers (None for all of them)
+def combine_covered_layers(layers, other_layers):
+    if layers is None:
+        return other_layers
+    if other_layers is None:
+        return layers
+
+    return sorted(set(layers) & set(other_layers))
+
+
+# update_watermarks raises the created_at and last_status_change_at
+# watermarks to cover a page of incidents
+def update_watermarks(watermarks, incidents):
+    for key, page_max in incident_watermarks(incidents).items():
+        if page_max and (watermarks.get(key) is None or page_max > watermarks[key]):
+            watermarks[key] = page_max
+
+    return watermarks
+
+
+# cache_since returns the start of the window the cache covers after it is
+# written. An incident store keeps older incidents, so its window extends
+# back as far as the previous one did, as long as the two overlap.
+def cache_since(cache_file, metadata, window_since):
+    if is_incident_store(cache_file) is False or not metadata.get("since"):
+        return window_since
+
+    if metadata["until"] < format_pd_time(window_since):
+        return window_since
+
+    return min(datetime.strptime(metadata["since"], pd_time_format), window_since)
+
+
+# sync_since returns the point a sync has to fetch from: the created_at
+# watermark, or the oldest cached incident that is not resolved yet, since
+# those can still change. Never earlier than the start of the window, and
+# the whole window if the cache does not cover it yet.
+def sync_since(incidents, metadata, window_since):
+    if not metadata.get("created_at"):
+        return window_since
+
+    if metadata.get("since") is None or metadata["since"] > format_pd_time(
+        window_since
+    ):
+        return window_since
+
+    since = datetime.strptime(metadata["created_at"], pd_time_format)
+    for i in incidents:
+        if i.get("status") != "resolved":
+            since = min(since, datetime.strptime(i["created_at"], pd_time_format))
+
+    return max(since, window_since)
+
+
+# is_segment_cache returns True if the cache file is a directory of day
+# segments rather than a single file
+def is_segment_cache(cache_file):
+    return cache_file.suffix == ".segments"
+
+
+# read_segment_cache returns the incidents created since the start of the
+# window from the day segments in the cache directory. Segments for days
+# that have ended, downloaded after the day was over and with every
+# incident resolved, can no longer change and are read as they are. Only
+# the other days, today and any with open incidents or without a segment,
+# are downloaded again with fetch_days, a window per day, and their
+# segments replaced. Days that fail to download keep their old segment, and
+# are downloaded again next time. With load=False, the segments are only
+# brought up to date.
+def read_segment_cache(
+    fetch_days,
+    cache_file,
+    window_since,
+    team_ids,
+    no_cache,
+    verbose,
+    load=True,
+):
+    metadata = read_segment_metadata(cache_file, verbose)
+    if no_cache or metadata.get("team_ids") != sorted(team_ids):
+        metadata = {"team_ids": sorted(team_ids), "segments": {}}
+
+    days = segment_days(window_since)
+    stale_days = [
+        day
+        for day in days
+        if is_segment_complete(cache_file, metadata["segments"], day) is False
+    ]
+    debug(
+        verbose,
+        f"Segment cache has {len(days) - len(stale_days)} of {len(days)} days; "
+        f"downloading {len(stale_days)}",
+    )
+
+    if stale_days:
+        until = utc_now()
+        downloads = fetch_days(segment_windows(stale_days, until))
+
+        for day, incidents in zip(stale_days, downloads):
+            if incidents is None:
+                continue
+
+            # Incidents on the boundary between two days are fetched with
+            # both, and belong to the day they were created on
+            segment = [i for i in incidents if i["created_at"][:10] == str(day.date())]
+            write_incidents_to_cache(segment, segment_file(cache_file, day), verbose)
+            rollup_file(cache_file, day).unlink(missing_ok=True)
+            metadata["segments"][str(day.date())] = {
+                "until": format_pd_time(min(day + timedelta(days=1), until)),
+                "count": len(segment),
+                "open": sum(1 for i in segment if i.get("status") != "resolved"),
+            }
+
+        write_segment_metadata(cache_file, metadata, verbose)
+
+    if load is False:
+        return []
+
+    incidents = []
+    for day in days:
+        incidents.extend(
+            read_incidents_from_cache(segment_file(cache_file, day), verbose)
+        )
+    debug(verbose, f"Read {len(incidents)} items from {len(days)} day segments")
+
+    return incidents
+
+
+# segment_days returns the start of each UTC day from the one the window
+# starts on, up to and including today in UTC
+def segment_days(window_since):
+    day = datetime.combine(window_since.date(), datetime.min.time())
+    until = utc_now()
+
+    days = []
+    while day <= until:
+        days.append(day)
+        day += timedelta(days=1)
+
+    return days
+
+
+# utc_now returns the current time in UTC, as a naive datetime like the
+# segment days. Whether a day has ended, and how far it was downloaded,
+# has to be decided in UTC, as PagerDuty times are; helpers.today() is
+# local time, unless it carries a time zone.
+def utc_now():
+    return helpers.today().astimezone(timezone.utc).replace(tzinfo=None)
+
+
+# segment_file returns the JSON Lines file holding the incidents created on
+# the given day
+def segment_file(cache_file, day):
+    return cache_file.joinpath(f"{day.date()}.jsonl")
+
+
+# is_segment_complete returns True if the segment for the day was downloaded
+# after the day ended, and none of its incidents can still change
+def is_segment_complete(cache_file, segments, day):
+    segment = segments.get(str(day.date()))
+    if segment is None or segment_file(cache_file, day).exists() is False:
+        return False
+
+    return segment["open"] == 0 and segment["until"] >= format_pd_time(
+        day + timedelta(days=1)
+    )
+
+
+# segment_windows returns the window to download each day in. Every day is
+# a window of its own, so a day that fails to download fails alone.
+def segment_windows(days, until):
+    return [(day, min(day + timedelta(days=1), until)) for day in days]
+
+
+# rollup_file returns the file holding the counts of the incidents created
+# on the given day
+def rollup_file(cache_file, day):
+    return cache_file.joinpath(f"{day.date()}.rollup.json")
+
+
+# read_rollup returns the rollup of a complete day, building it from the
+# day's segment if there is none yet, or if it was counted with other
+# normalization rules
+@profile_stage("rollups")
+def read_rollup(cache_file, day, digest, verbose):
+    path = rollup_file(cache_file, day)
+    if path.exists():
+        with path.open() as f:
+            rollup = json.load(f)
+        if rollup.get("digest") == digest:
+            return rollup
+        debug(verbose, f'Rollup "{path}" is out of date, rebuilding it')
+
+    incidents = [
+        Incident.from_pagerduty(i)
+        for i in read_incidents_from_cache(segment_file(cache_file, day), verbose)
+    ]
+    rollup = build_rollup(incidents, digest)
+
+    partial_file = path.with_name(f".partial-{path.name}")
+    with partial_file.open(mode="w+", encoding="utf-8") as f:
+        json.dump(rollup, f)
+    partial_file.replace(path)
+
+    return rollup
+
+
+# build_rollup counts the incidents, and their values of each rollup
+# column, grouped by the layers they are in. Incidents on the minute a
+# shift ends on are in two layers, and are grouped under both, eg: "4,5".
+def build_rollup(incidents, digest):
+    groups = {}
+    for i in incidents:
+        key = ",".join(
+            str(layer) for layer in sorted(pd_layers) if i.in_layers([layer])
+        )
+        group = groups.setdefault(
+            key, {"count": 0, **{column: Counter() for column in rollup_columns}}
+        )
+        group["count"] += 1
+        for column in rollup_columns:
+            value = aggregate_columns[column](i)
+            if value is not None:
+                group[column][value] += 1
+
+    return {"digest": digest, "layers": groups}
+
+
+# add_rollup adds the counts of a day's rollup for incidents in the layers
+# to the aggregation, if one is given, and returns how many incidents that is
+def add_rollup(rollup, day, layers, aggregation=None):
+    layers = set(layers)
+    total = 0
+    for key, group in rollup["layers"].items():
+        if layers.isdisjoint(int(layer) for layer in key.split(",") if layer):
+            continue
+
+        total += group["count"]
+        for dimension, counts in (aggregation or {}).items():
+            if dimension == ("day",):
+                counts[str(day.date())] += group["count"]
+                continue
+            for value, count in group[dimension[0]].items():
+                counts[value] += count
+
+    return total
+
+
+# rollup_digest returns a digest of everything rollups are counted with:
+# the normalization rules and the layers, and the rollup format
+def rollup_digest():
+    return normalization_digest(version=rollup_version)
+
+
+# normalization_digest returns a digest of the normalization rules and the
+# layers, which decide the alert, cluster and layer of each incident
+def normalization_digest(**extra):
+    rules = {
+        "alerts": [(p.pattern, r) for p, r, _ in normalization_rules["alerts"]],
+        "alerts_match": [p.pattern for p, _ in normalization_rules["alerts_match"]],
+        "clusters": [(p.pattern, r) for p, r, _ in normalization_rules["clusters"]],
+        "layers": sorted(pd_layers.items()),
+        **extra,
+    }
+
+    return hashlib.sha256(json.dumps(rules).encode("utf-8")).hexdigest()
+
+
+# uses_rollups returns True if the report can be made from daily rollups:
+# a segment cache, and breakdowns of the columns rollups hold, or by day
+def uses_rollups(cache_file, subcommand, breakdown):
+    if is_segment_cache(cache_file) is False:
+        return False
+    if subcommand not in ["alerts", "clusters", "all"]:
+        return False
+
+    return all(
+        len(dimension) == 1 and dimension[0] in rollup_columns + ["day"]
+        for dimension in report_dimensions(subcommand, breakdown)
+    )
+
+
+# read_segment_metadata reads the metadata of the segment cache, if any
+def read_segment_metadata(cache_file, verbose):
+    metadata_file = cache_file.joinpath(segment_metadata_name)
+    if metadata_file.exists() is False:
+        debug(verbose, f'Segment metadata "{metadata_file}" does not exist')
+        return {}
+
+    with metadata_file.open() as f:
+        return json.load(f)
+
+
+# write_segment_metadata records the teams the segment cache is for, and
+# for each day segment how far it was downloaded, and how many of its
+# incidents there are and how many are still open
+def write_segment_metadata(cache_file, metadata, verbose):
+    metadata_file = cache_file.joinpath(segment_metadata_name)
+
+    debug(verbose, f"Writing segment metadata: {metadata_file}")
+    with metadata_file.open(mode="w+", encoding="utf-8") as f:
+        json.dump(metadata, f)
+
+
+# is_incident_store returns True if the cache file is an SQLite
+# incident store rather than a JSON list
+def is_incident_store(cache_file):
+    return cache_file.suffix in [".sqlite3", ".sqlite", ".db"]
+
+
+# open_incident_store opens the SQLite incident store, creating the table
+# and indexes if needed. Alongside the raw incident, each row holds the
+# derived columns the reports filter and group by. These are derived again
+# from the raw incidents if the store was written with other normalization
+# rules or layers.
+def open_incident_store(cache_file):
+    store = sqlite3.connect(str(cache_file))
+    store.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS incidents (
+            id TEXT PRIMARY KEY,
+            created_at INTEGER NOT NULL,
+            last_status_change_at INTEGER,
+            layer INTEGER,
+            urgency TEXT,
+            status TEXT,
+            alert TEXT,
+            cluster TEXT,
+            service TEXT,
+            data TEXT NOT NULL,
+            end_layer INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        """
+    )
+
+    # Stores written before end_layer was added get it, empty until their
+    # rows are derived again below
+    columns = [row[1] for row in store.execute("PRAGMA table_info(incidents)")]
+    if "end_layer" not in columns:
+        with store:
+            store.execute("ALTER TABLE incidents ADD COLUMN end_layer INTEGER")
+
+    store.executescript(
+        """
+        CREATE INDEX IF NOT EXISTS incidents_created_at
+            ON incidents (created_at);
+        CREATE INDEX IF NOT EXISTS incidents_layer_created_at
+            ON incidents (layer, created_at);
+        CREATE INDEX IF NOT EXISTS incidents_end_layer_created_at
+            ON incidents (end_layer, created_at);
+        CREATE INDEX IF NOT EXISTS incidents_alert ON incidents (alert);
+        CREATE INDEX IF NOT EXISTS incidents_cluster ON incidents (cluster);
+        CREATE INDEX IF NOT EXISTS incidents_service ON incidents (service);
+        """
+    )
+
+    digest = normalization_digest(store=store_version)
+    row = store.execute("SELECT value FROM metadata WHERE key = 'digest'").fetchone()
+    if row is None or row[0] != digest:
+        upsert_incidents(store, read_incidents_from_store(store))
+        with store:
+            store.execute(
+                "INSERT OR REPLACE INTO metadata VALUES ('digest', ?)", (digest,)
+            )
+
+    return store
+
+
+# upsert_incidents inserts incidents into the store, replacing any
+# incident with the same id. end_layer is the layer whose shift ends on the
+# minute the incident was created, if any, as an incident on the boundary
+# is in that layer too.
+def upsert_incidents(store, incidents):
+    rows = []
+    for data in incidents:
+        i = Incident.from_pagerduty(data)
+        rows.append(
+            (
+                i.id,
+                i.created_at,
+                i.last_status_change_at,
+                i.layer,
+                i.urgency,
+                i.status,
+                i.alert,
+                i.cluster,
+                i.service,
+                json.dumps(data),
+                layer_ends.get((i.created_at // 60) % len(layer_table)),
+            )
+        )
+
+    with store:
+        store.executemany(
+            "INSERT OR REPLACE INTO incidents (id, created_at, "
+            "last_status_change_at, layer, urgency, status, alert, cluster, "
+            "service, data, end_layer) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+
+# read_incidents_from_store returns the raw incidents in the store, in
+# creation order; with open_only, only those that are not resolved yet
+def read_incidents_from_store(store, open_only=False):
+    query = "SELECT data FROM incidents"
+    if open_only:
+        query += " WHERE status IS NOT 'resolved'"
+
+    return [json.loads(row[0]) for row in store.execute(query + " ORDER BY created_at")]
+
+
+# store_watermarks returns the newest created_at and last_status_change_at
+# in the store
+def store_watermarks(store):
+    created_at, last_status_change_at = store.execute(
+        "SELECT MAX(created_at), MAX(COALESCE(last_status_change_at, created_at)) "
+        "FROM incidents"
+    ).fetchone()
+
+    return {
+        "created_at": format_epoch(created_at),
+        "last_status_change_at": format_epoch(last_status_change_at),
+    }
+
+
+# store_period_counts returns the number of incidents in the layers for the
+# current period, and for the period of the same length before it
+@profile_stage("store queries")
+def store_period_counts(store, days, layers):
+    cutoff = to_epoch(helpers.today() - timedelta(days=days))
+    since = to_epoch(helpers.today() - timedelta(days=days * 2))
+    in_layers, layer_params = store_layer_filter(layers)
+
+    return store.execute(
+        "SELECT "
+        "COALESCE(SUM(created_at > ?), 0), COALESCE(SUM(created_at <= ?), 0) "
+        "FROM incidents "
+        f"WHERE created_at >= ? AND {in_layers}",
+        (cutoff, cutoff, since, *layer_params),
+    ).fetchone()
+
+
+# store_layer_filter returns the SQL condition, and its parameters, for
+# incidents in the shift covered by any of the layers, the way
+# Incident.in_layers decides it: the layer it starts in, or the layer
+# ending on its minute if it was created on the boundary exactly
+def store_layer_filter(layers):
+    layers = list(layers)
+    placeholders = ", ".join("?" for _ in layers)
+
+    return (
+        f"(layer IN ({placeholders}) "
+        f"OR (created_at % 60 = 0 AND end_layer IN ({placeholders})))",
+        layers + layers,
+    )
+
+
+# store_top_counts returns the most common values of an aggregate column,
+# or combination of columns, for incidents in the layers created after
+# since; all of them if count is None
+@profile_stage("store queries")
+def store_top_counts(store, dimension, since, layers, count):
+    if isinstance(dimension, str):
+        dimension = (dimension,)
+
+    for column in dimension:
+        if column not in store_columns:
+            raise ValueError(f"Unknown incident store column: {column}")
+
+    columns = ", ".join(store_columns[column] for column in dimension)
+    not_null = " AND ".join(f"{store_columns[c]} IS NOT NULL" for c in dimension)
+    in_layers, layer_params = store_layer_filter(layers)
+
+    rows = store.execute(
+        f"SELECT {columns}, COUNT(*) AS total FROM incidents "
+        f"WHERE created_at > ? AND {in_layers} AND {not_null} "
+        f"GROUP BY {columns} ORDER BY total DESC, MIN(created_at) LIMIT ?",
+        (to_epoch(since), *layer_params, -1 if count is None else count),
+    ).fetchall()
+
+    if len(dimension) == 1:
+        return [(row[0], row[1]) for row in rows]
+
+    return [(tuple(row[:-1]), row[-1]) for row in rows]
+
+
+# get_incidents downloads the high urgency incidents of the window. With
+# strict, API errors are raised, rather than reported and what was
+# downloaded so far returned.
+@cache_to_file
+def get_incidents(
+    num_days,
+    api_token,
+    team_ids,
+    verbose,
+    cache_file=None,
+    no_cache=True,
+    concurrency=default_concurrency,
+    slice_mode=default_fetch_slice_mode,
+    since=None,
+    windows=None,
+    strict=False,
+):
+    incidents = []
+
+    try:
+        for page in stream_incident_pages(
+            num_days,
+            api_token,
+            team_ids,
+            verbose,
+            concurrency,
+            slice_mode,
+            since,
+            windows,
+        ):
+            incidents.extend(page)
+
+        incidents = [i for i in merge_incidents(incidents) if i["urgency"] == "high"]
+
+        debug(verbose, f"Found {len(incidents)} incidents")
+
+    except import_pdpyras().PDClientError as e:
+        if strict:
+            raise e
+        if e.response:
+            if e.response.status_code == 404:
+                print("User not found")
+            elif e.response.status_code == 401:
+                raise e
+        else:
+            raise e
+
+    return incidents
+
+
+# stream_incident_pages yields pages of incidents as they are downloaded.
+# The window is split into slices that are downloaded concurrently, so
+# pages arrive in no particular order, and incidents on the boundary
+# between two slices can arrive twice.
+def stream_incident_pages(
+    num_days,
+    api_token,
+    team_ids,
+    verbose,
+    concurrency=default_concurrency,
+    slice_mode=default_fetch_slice_mode,
+    since=None,
+    windows=None,
+):
+    until = helpers.today()
+    if since is None:
+        since = until - timedelta(days=num_days * 2)
+
+    request_params = incident_request_params(team_ids)
+
+    debug(verbose, f"Requesting incidents")
+    debug(verbose, f"Request parameters: {request_params}")
+
+    # Windows from a query plan are downloaded as they are
+    if windows is not None:
+        pass
+    elif concurrency <= 1:
+        windows = [(since, until)]
+    else:
+        if slice_mode == "adaptive":
+            slice_length = adaptive_slice_length(
+                new_api_session(api_token), request_params, since, until
+            )
+        else:
+            slice_length = timedelta(days=1)
+        windows = split_time_window(since, until, slice_length)
+
+    debug(
+        verbose,
+        f"Downloading {len(windows)} slice(s) with concurrency {concurrency}",
+    )
+
+    # A bounded queue keeps the workers at most a few pages ahead of
+    # whatever is consuming them
+    pages = queue.Queue(maxsize=max(concurrency, 1) * 2)
+    stopped = threading.Event()
+
+    # Each worker thread keeps its own session, so connections are
+    # reused between the slices that thread downloads
+    sessions = threading.local()
+
+    def fetch_slice(window):
+        if not hasattr(sessions, "session"):
+            sessions.session = new_api_session(api_token)
+
+        start = time.monotonic()
+        slice_params = dict(
+            request_params,
+            since=format_pd_time(window[0]),
+            until=format_pd_time(window[1]),
+        )
+
+        count = 0
+        for page in fetch_incident_pages(sessions.session, slice_params):
+            while stopped.is_set() is False:
+                try:
+                    pages.put(page, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if stopped.is_set():
+                return count
+            count += 1
+
+        debug(
+            verbose,
+            f"Slice {slice_params['since']} - {slice_params['until']}: "
+            f"{count} page(s) in {time.monotonic() - start:.2f}s",
+        )
+        return count
+
+    executor = ThreadPoolExecutor(max_workers=max(concurrency, 1))
+    futures = [executor.submit(fetch_slice, window) for window in windows]
+
+    try:
+        while True:
+            try:
+                yield pages.get(timeout=0.1)
+            except queue.Empty:
+                # Fail fast if any slice failed, rather than waiting for
+                # the rest of the slices to finish
+                for f in futures:
+                    if f.done() and f.exception():
+                        raise f.exception()
+
+                if all(f.done() for f in futures) and pages.empty():
+                    break
+
+        debug(
+            verbose,
+            f"Fetched {sum(f.result() for f in futures)} page(s) in total",
+        )
+
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True)
+
+
+# import_pdpyras imports pdpyras on first use. It brings in requests and
+# urllib3, which take longer to import than the rest of the script, and
+# are not needed when reports are answered from the cache.
+def import_pdpyras():
+    import pdpyras
+
+    return pdpyras
+
+
+# new_api_session returns a PagerDuty API session for the token. Every
+# session for a token sends its requests through the same governor, and
+# shares its pool of HTTP connections.
+def new_api_session(api_token):
+    api_token = str(api_token)
+    session = import_pdpyras().APISession(api_token)
+    session.url = pd_api_url
+
+    adapter = governed_adapter(request_governor(api_token, request_rate))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# RequestGovernor paces the requests for a token across all threads: a
+# token bucket holds them to the request rate, and the number in flight is
+# limited by a concurrency limit that adapts to the API, halving on each
+# rate-limited (429) response or slowing down when responses get much
+# slower, and growing back slowly while requests succeed. A 429 response
+# pauses every request for as long as its Retry-After header asks.
+class RequestGovernor:
+    def __init__(self, rate, max_concurrency=max_request_concurrency):
+        self.rate = rate
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.active = 0
+        self.tokens = 1.0
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.fastest = None
+        self.rate_limited = 0
+        self.condition = threading.Condition()
+
+    # acquire waits until the request can be sent
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    max(self.rate, 1.0),
+                    self.tokens + (now - self.refilled_at) * self.rate,
+                )
+                self.refilled_at = now
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.active >= int(self.limit):
+                    wait = None
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.active += 1
+                    return
+
+                self.condition.wait(wait)
+
+    # release adapts the concurrency limit to a response, and lets waiting
+    # requests go ahead
+    def release(self, status, latency):
+        with self.condition:
+            self.active -= 1
+            if status is None:
+                # The request failed before there was a response
+                pass
+            elif status == 429:
+                self.rate_limited += 1
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.fastest = min(self.fastest or latency, latency)
+                # Let the fastest time drift up, so it follows the API
+                self.fastest *= 1.01
+                if latency > self.fastest * latency_slowdown_factor:
+                    self.limit = max(1.0, self.limit - 1)
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    # pause holds back every request for a number of seconds
+    def pause(self, seconds):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # send sends a request with the send function, retrying rate-limited
+    # requests after the time the API asks for
+    def send(self, send):
+        for attempt in range(max_rate_limit_retries + 1):
+            self.acquire()
+            started = time.perf_counter()
+            response = None
+            try:
+                response = send()
+            finally:
+                self.release(
+                    response.status_code if response is not None else None,
+                    time.perf_counter() - started,
+                )
+
+            if response.status_code != 429 or attempt == max_rate_limit_retries:
+                return response
+
+            profile_request("rate limited", started, response)
+            # Read the response, so its connection goes back to the pool
+            response.content
+            self.pause(retry_after(response, attempt))
+
+
+# retry_after returns the number of seconds a rate-limited response asks to
+# wait before retrying, or an exponential backoff if it does not say
+def retry_after(response, attempt):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return min(2**attempt, 60)
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    from email.utils import parsedate_to_datetime
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(retry_at.timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return min(2**attempt, 60)
+
 
-    return parser
+# request_governor returns the governor for a token's requests, so that
+# every session and thread using the token shares it
+@lru_cache(maxsize=None)
+def request_governor(api_token, rate):
+    return RequestGovernor(rate)
 
 
-# cache_to_file wraps get_incidents and writes the results to a cache file,
-# or returns caches results if appropriate
-def cache_to_file(get_incidents_func):
-    def decorator(days, layers, api_token, team_ids, verbose, cache_file, no_cache):
+# governed_adapter returns an HTTP adapter that sends requests through the
+# governor. The adapter's connection pool is shared by every session it is
+# mounted on, so connections are reused between threads and sessions.
+@lru_cache(maxsize=None)
+def governed_adapter(governor):
+    from requests.adapters import HTTPAdapter
 
-        # Just read incidents from cache file if appropriate
-        if should_read_from_cache(no_cache, cache_file, verbose):
-            incidents = read_incidents_from_cache(cache_file, verbose)
-            debug(verbose, f"Cache hit; {len(incidents)} items")
+    class GovernedAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            return governor.send(
+                lambda: super(GovernedAdapter, self).send(request, **kwargs)
+            )
 
-            return incidents
+    return GovernedAdapter(pool_maxsize=max_request_concurrency)
 
-        # Retrieve data from PagerDuty API
-        # with the get_incidents function
-        debug(verbose, f"Cache miss; retrieving data from PagerDuty API")
-        incidents = get_incidents_func(days, layers, api_token, team_ids, verbose)
 
-        write_incidents_to_cache(incidents, cache_file, verbose)
+# set_request_rate sets the rate that requests to the API are paced to
+def set_request_rate(rate):
+    global request_rate
 
-        return incidents
+    if rate <= 0:
+        raise SystemExit("--rate-limit needs to be more than 0 requests per second")
 
-    return decorator
+    request_rate = rate
 
 
-# select_cache_file returns the file name based on the
-# provided cache_file input argument, or a default if None
-def select_cache_file(cache_file, layers, days):
+# fetch_incident_pages yields each page of incidents matching the request
+# parameters, following the API's offset pagination. It raises
+# IncompleteDownloadError rather than stop short at the API's paging limit.
+def fetch_incident_pages(session, params):
+    offset = 0
+    more = True
+    while more:
+        if offset + pd_page_size > pd_iteration_limit:
+            raise IncompleteDownloadError(
+                f"More than {pd_iteration_limit} incidents between "
+                f"{params.get('since')} and {params.get('until')}; the API does "
+                "not page beyond that. Try a higher --concurrency, or "
+                "--slice adaptive"
+            )
 
-    prefix_string = "incident-cache"
-    date_string = str(helpers.today().date())
-    layer_string = "-".join(str(item) for item in layers)
-    days_string = f"{days}-day"
+        page_params = dict(params, limit=pd_page_size, offset=offset)
+        started = time.perf_counter()
+        response = session.get("incidents", params=page_params)
+        if not response.ok:
+            profile_request("incidents", started, response)
+            raise import_pdpyras().PDClientError(
+                f"HTTP error status ({response.status_code}) while listing incidents",
+                response=response,
+            )
 
-    cache_file_name = f"{prefix_string}_{date_string}_{layer_string}_{days_string}.json"
+        body = response.json()
+        profile_request("incidents", started, response, len(body["incidents"]))
+        yield body["incidents"]
 
-    file = (
-        Path(cache_file).absolute()
-        if cache_file
-        else Path.home().joinpath(".cache", "toil-review-metrics", cache_file_name)
+        more = body.get("more", False)
+        offset += len(body["incidents"])
+
+
+# fetch_incident_alerts returns the alerts of an incident, following the
+# API's offset pagination; none if the incident no longer exists
+def fetch_incident_alerts(session, incident_id):
+    alerts, offset, more = [], 0, True
+    while more:
+        params = {"limit": pd_page_size, "offset": offset}
+        started = time.perf_counter()
+        response = session.get(f"incidents/{incident_id}/alerts", params=params)
+        profile_request("alerts", started, response)
+        if response.status_code == 404:
+            return []
+        if not response.ok:
+            raise import_pdpyras().PDClientError(
+                f"HTTP error status ({response.status_code}) while listing alerts",
+                response=response,
+            )
+
+        body = response.json()
+        alerts.extend(body["alerts"])
+        more = body.get("more", False)
+        offset += len(body["alerts"])
+
+    return alerts
+
+
+# adaptive_slice_length sizes download slices from the number of incidents
+# in the window, so busy windows are split finer than quiet ones
+def adaptive_slice_length(session, params, since, until):
+    total = count_incidents(session, params, since, until)
+    slices = max(1, math.ceil(total / adaptive_slice_target))
+
+    return max((until - since) / slices, timedelta(hours=1))
+
+
+# count_incidents asks the API for the number of incidents matching the
+# request parameters between since and until, with a single request
+def count_incidents(session, params, since, until):
+    probe_params = dict(
+        params,
+        since=format_pd_time(since),
+        until=format_pd_time(until),
+        limit=1,
+        total="true",
     )
+    started = time.perf_counter()
+    response = session.get("incidents", params=probe_params)
+    profile_request("count", started, response)
+    if not response.ok:
+        raise import_pdpyras().PDClientError(
+            f"HTTP error status ({response.status_code}) while counting incidents",
+            response=response,
+        )
 
-    return file
+    return response.json().get("total") or 0
 
 
-# should_read_from_cache returns True if the cache file exists and the
-# --no-cache flag is set, and the cache file is not stale (older than a day)
-def should_read_from_cache(no_cache, cache_file, verbose):
-    # Never read from cache if --no-cache is set
-    if no_cache is True:
-        debug(verbose, f"-no-cache flag set, not reading from cache")
-        return False
+# incident_request_params returns the API parameters for the teams'
+# high-urgency incidents
+def incident_request_params(team_ids):
+    return {
+        "urgencies[]": ["high"],
+        "team_ids[]": team_ids,
+    }
 
-    # Can't read from cache if cache file doesn't exist
-    if cache_file.exists() is False:
+
+# plan_incident_queries decides how to download the incidents between since
+# and until when only some layers are wanted. It returns the windows to
+# query (None for the default slicing of the whole window) and the layers
+# the download will cover (None for all of them).
+def plan_incident_queries(api_token, team_ids, since, until, layers, plan, verbose):
+    if plan == "wide" or set(layers) >= set(pd_layers):
+        return None, None
+
+    windows = shift_windows(since, until, layers)
+    if plan == "shifts":
         debug(
-            verbose, f'Cache file "{cache_file}" does not exist, not reading from cache'
+            verbose,
+            f"Query plan: {len(windows)} shift queries for layers "
+            f"{sorted(layers)}, as requested",
         )
-        return False
+        return windows, sorted(layers)
 
-    # Don't read from cache if cache file is older than 1 day
-    cache_file_mtime = datetime.fromtimestamp(cache_file.stat().st_mtime)
+    # Estimate requests assuming incidents are spread evenly over the day;
+    # every query costs at least one request, even when it is empty
+    total = count_incidents(
+        new_api_session(api_token), incident_request_params(team_ids), since, until
+    )
+    window_seconds = max((until - since).total_seconds(), 1)
+    wide_requests = max(1, math.ceil(total / pd_page_size))
+    shift_requests = sum(
+        max(
+            1,
+            math.ceil(
+                total * (end - start).total_seconds() / window_seconds / pd_page_size
+            ),
+        )
+        for start, end in windows
+    )
 
-    if cache_file_mtime < (datetime.now() - timedelta(days=1)):
+    if shift_requests < wide_requests:
         debug(
             verbose,
-            f'Cache file "{cache_file}" is stale ({cache_file_mtime}), '
-            f"not reading from cache",
+            f"Query plan: {len(windows)} shift queries for layers "
+            f"{sorted(layers)} (~{shift_requests} requests), rather than one wide "
+            f"query (~{wide_requests} requests) for {total} incidents",
         )
-        return False
+        return windows, sorted(layers)
 
-    return True
+    debug(
+        verbose,
+        f"Query plan: one wide query (~{wide_requests} requests) for {total} "
+        f"incidents, rather than {len(windows)} shift queries for layers "
+        f"{sorted(layers)} (~{shift_requests} requests)",
+    )
+    return None, None
 
 
-# read_incidents_from_cache reads incidents from the cache file
-def read_incidents_from_cache(cache_file, verbose):
-    debug(verbose, f"Getting incidents from cache file: {cache_file}")
-    with cache_file.open() as f:
-        return json.load(f)
+# shift_windows returns the since/until windows covering just the shifts of
+# the requested layers on each day between since and until. Adjacent
+# layers are combined into one window.
+def shift_windows(since, until, layers):
+    groups = []
+    for layer in sorted(layers):
+        previous = [p for p in pd_layers if next_layer(p) == layer][0]
+        if previous in layers:
+            continue
 
+        last = layer
+        while next_layer(last) in layers and next_layer(last) != layer:
+            last = next_layer(last)
 
-# write_incidents_to_cache writes incidents to the cache file
-def write_incidents_to_cache(incidents, cache_file, verbose):
-    cache_dir = cache_file.parents[0]
+        start = minute_of_day(pd_layers[layer])
+        end = minute_of_day(pd_layers[next_layer(last)])
+        groups.append((start, (end - start) % (24 * 60) or 24 * 60))
 
-    if cache_dir.exists() is False:
-        debug(verbose, f"Creating cache directory: {cache_dir}")
-        cache_dir.mkdir(parents=True, exist_ok=True)
+    windows = []
+    day = datetime.combine(since.date() - timedelta(days=1), datetime.min.time())
+    while day <= until:
+        for start, duration in groups:
+            window_start = max(day + timedelta(minutes=start), since)
+            window_end = min(day + timedelta(minutes=start + duration), until)
+            if window_start < window_end:
+                windows.append((window_start, window_end))
+        day += timedelta(days=1)
 
-    debug(verbose, f"Writing cache file: {cache_file}")
-    with cache_file.open(mode="w+", newline="", encoding="utf-8") as f:
-        json.dump(incidents, f)
+    return sorted(windows)
 
 
-@cache_to_file
-def get_incidents(
-    num_days, layers, api_token, team_ids, verbose, cache_file=None, no_cache=True
-):
-    # TODO: COMBINE REQUESTS INTO ONE AND PARSE
-    request_params = {
-        "urgencies[]": ["high"],
-        "team_ids[]": team_ids,
-        "since": helpers.today() - timedelta(days=num_days * 2),
-        "until": helpers.today(),
-    }
+# split_time_window splits the since/until window into consecutive
+# sub-windows no longer than slice_length
+def split_time_window(since, until, slice_length):
+    windows = []
+    start = since
+    while start < until:
+        end = min(start + slice_length, until)
+        windows.append((start, end))
+        start = end
 
-    session = APISession(api_token)
+    return windows
 
-    try:
-        request_params.update(request_params)
-        debug(verbose, f"Requesting incidents")
-        debug(verbose, f"Request parameters: {request_params}")
 
-        incidents = [
-            i
-            for i in session.list_all("incidents", params=request_params)
-            if (is_in_layer(i["created_at"], layers) and (i["urgency"] == "high"))
-        ]
+# merge_incidents combines lists of incidents, dropping duplicate ids;
+# later lists win, and the result is ordered by creation time
+def merge_incidents(*incident_lists):
+    merged = {}
+    for incident_list in incident_lists:
+        for i in incident_list:
+            merged[i["id"]] = i
 
-        debug(verbose, f"Found {len(incidents)} incidents")
+    return sorted(merged.values(), key=lambda i: i["created_at"])
 
-    except PDClientError as e:
-        if e.response:
-            if e.response.status_code == 404:
-                print("User not found")
-            elif e.response.status_code == 401:
-                raise e
-        else:
-            raise e
 
-    return incidents
+# format_pd_time formats a datetime the way the PagerDuty API expects
+def format_pd_time(time_value):
+    return time_value.strftime(pd_time_format)
+
 
+# parse_pd_time returns the PagerDuty timestamp as seconds since the epoch
+def parse_pd_time(time_string):
+    return calendar.timegm(time.strptime(time_string, pd_time_format))
 
+
+# to_epoch returns a datetime as seconds since the epoch, treating it as
+# UTC the way PagerDuty timestamps are compared against it
+def to_epoch(time_value):
+    return calendar.timegm(time_value.timetuple())
+
+
+# epoch_day formats a day number (days since the epoch) as a date
+@lru_cache(maxsize=None)
+def epoch_day(day):
+    return time.strftime("%Y-%m-%d", time.gmtime(day * 86400))
+
+
+# format_epoch formats seconds since the epoch as a PagerDuty timestamp
+def format_epoch(epoch):
+    if epoch is None:
+        return None
+
+    return time.strftime(pd_time_format, time.gmtime(epoch))
+
+
+@profile_stage("periods")
 def split_incidents_by_period(incidents, days):
+    cutoff = to_epoch(helpers.today() - timedelta(days=days))
+
     current, previous = [], []
     for i in incidents:
-        if datetime.strptime(i["created_at"], pd_time_format) > (
-            helpers.today() - timedelta(days=days)
-        ):
+        if i.created_at > cutoff:
             current.append(i)
         else:
             previous.append(i)
@@ -326,102 +3440,522 @@ def split_incidents_by_period(incidents, days):
     return current, previous
 
 
+# split_incidents_into_periods splits the incidents into consecutive
+# periods of days before today, oldest first, returning the start of each
+# period with its incidents. The period boundaries are found by bisecting
+# the sorted creation times, rather than scanning once per period.
+@profile_stage("periods")
+def split_incidents_into_periods(incidents, days, periods):
+    incidents = sorted(incidents, key=lambda i: i.created_at)
+    created = [i.created_at for i in incidents]
+
+    starts = [helpers.today() - timedelta(days=days * n) for n in range(periods, 0, -1)]
+    bounds = [bisect.bisect_right(created, to_epoch(start)) for start in starts]
+    bounds.append(len(incidents))
+
+    return [
+        (start, incidents[bounds[n] : bounds[n + 1]]) for n, start in enumerate(starts)
+    ]
+
+
+# print_trend prints the incident count for each period, with the change
+# from the period before it, then the counts of each dimension's values
+# per period. Each dimension lists the top values of every period, and
+# the change in count over the last period.
+def print_trend(periods, days, dimensions, count):
+    print(f"High incidents per {days} day period before today:")
+    print("COUNT\tCHANGE\tPERIOD")
+    previous = None
+    for start, incidents in periods:
+        change = "" if previous is None else period_change(len(incidents), previous)
+        print(f"{len(incidents)}\t{change}\t{start.strftime('%Y-%m-%d')}")
+        previous = len(incidents)
+
+    aggregations = [
+        aggregate_incidents(incidents, dimensions) for _, incidents in periods
+    ]
+    for dimension in dimensions:
+        counts = [aggregation[dimension] for aggregation in aggregations]
+
+        if any(column in ordered_columns for column in dimension):
+            keys = sorted(set().union(*counts))
+        else:
+            top, totals = set(), new_counts()
+            for c in counts:
+                top.update(k for k, _ in c.most_common(count))
+                totals += c
+            keys = [k for k, _ in totals.most_common() if k in top]
+
+        print("")
+        print(
+            "\t".join(start.strftime("%m-%d") for start, _ in periods)
+            + f"\tDELTA\t{dimension_heading(dimension)}"
+        )
+        for k in keys:
+            row = [c[k] for c in counts]
+            delta = row[-1] - row[-2] if len(row) > 1 else 0
+            print("\t".join(str(v) for v in row) + f"\t{delta:+d}\t{format_key(k)}")
+
+
+# period_change formats the percent change between two period counts
+def period_change(current, previous):
+    if previous == 0:
+        return "n/a"
+
+    return f"{round(((current - previous) / previous) * 100, 2)}%"
+
+
 # alerts prints a dict of top alerts and the count of each
 def alerts(incidents, count):
-    alert_list = [parse_description_for_alerts(item["summary"]) for item in incidents]
-
-    print("COUNT\tINCIDENT")
-    for k, v in Counter(alert_list).most_common(count):
-        print(f"{v}\t{k}")
+    print_aggregation(aggregate_incidents(incidents, [("alert",)]), count)
 
 
 # clusters prints a dict of top alerting clusters and the count of each
 def clusters(incidents, count):
-    cluster_list = [
-        parse_description_for_cluster(item["service"]["summary"])
-        for item in incidents
-        if item["service"]["summary"] != "prod-deadmanssnitch"
-        and item["service"]["summary"] != "Zabbix Service"
-        and item["service"]["summary"] != "app-sre-alertmanager"
+    print_aggregation(aggregate_incidents(incidents, [("cluster",)]), count)
+
+
+# aggregate_incidents counts the incidents by each of the dimensions in a
+# single pass, where a dimension is a tuple of aggregate columns. Counts
+# are added to an existing aggregation if one is given, so incidents can
+# be aggregated a page at a time. Incidents without a value for one of a
+# dimension's columns (eg: services without a cluster) are not counted in
+# that dimension.
+@profile_stage("aggregation")
+def aggregate_incidents(incidents, dimensions, aggregation=None):
+    if aggregation is None:
+        aggregation = {dimension: new_counts() for dimension in dimensions}
+
+    columns = [
+        (column, aggregate_columns[column])
+        for column in {column for dimension in dimensions for column in dimension}
     ]
 
-    print("COUNT\tCLUSTER")
-    for k, v in Counter(cluster_list).most_common(count):
+    for i in incidents:
+        values = {column: get_value(i) for column, get_value in columns}
+        for dimension in dimensions:
+            key = tuple(values[column] for column in dimension)
+            if None in key:
+                continue
+            aggregation[dimension][key if len(key) > 1 else key[0]] += 1
+
+    return aggregation
+
+
+# new_counts returns an empty count of a dimension's values: a Counter, or
+# a TopKSketch with --approximate
+def new_counts():
+    if sketch_size is None:
+        return Counter()
+
+    return TopKSketch(sketch_size)
+
+
+# set_sketch_size sets the number of values the sketches of --approximate
+# track, or None to count every value exactly
+def set_sketch_size(size):
+    global sketch_size
+
+    if size is not None and size < 1:
+        raise SystemExit("--approximate needs to track at least 1 value")
+
+    sketch_size = size
+
+
+# TopKSketch counts the most common values in fixed memory, with the
+# Space-Saving algorithm: at most size values are tracked, and a new value
+# replaces the least counted one, taking over its count as its error. A
+# count is never less than the true count, and never more than the true
+# count plus its error, and any value counted more than the total over
+# size is tracked. Sketches of separate incidents (eg: shards, teams or
+# days) are merged with +. Otherwise it reads like a Counter.
+class TopKSketch(Mapping):
+    def __init__(self, size):
+        self.size = size
+        self.counts = {}
+        self.errors = {}
+        # A min-heap of (count, value), with stale entries left behind as
+        # counts grow; it is rebuilt once it holds too many of them
+        self.heap = []
+
+    def __getitem__(self, value):
+        return self.counts.get(value, 0)
+
+    def __setitem__(self, value, count):
+        self.add(value, count - self[value])
+
+    def __contains__(self, value):
+        return value in self.counts
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def __len__(self):
+        return len(self.counts)
+
+    # add counts a value, replacing the least counted value if the sketch
+    # is full
+    def add(self, value, count=1):
+        if value not in self.counts:
+            error = 0
+            if len(self.counts) >= self.size:
+                error = self.floor()
+                evicted = heapq.heappop(self.heap)[1]
+                del self.counts[evicted]
+                del self.errors[evicted]
+            self.counts[value] = error
+            self.errors[value] = error
+
+        self.counts[value] += count
+        heapq.heappush(self.heap, (self.counts[value], value))
+
+        if len(self.heap) > self.size * 4:
+            self.rebuild()
+
+    # floor returns the count of the least counted value once the sketch is
+    # full, which bounds the count of any value that is not tracked
+    def floor(self):
+        if len(self.counts) < self.size:
+            return 0
+
+        while self.heap[0][0] != self.counts.get(self.heap[0][1]):
+            heapq.heappop(self.heap)
+
+        return self.heap[0][0]
+
+    # error returns how much the count of a value may be over its true count
+    def error(self, value):
+        return self.errors.get(value, self.floor())
+
+    def most_common(self, n=None):
+        if n is None:
+            return sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)
+
+        return heapq.nlargest(n, self.counts.items(), key=lambda kv: kv[1])
+
+    def rebuild(self):
+        self.heap = [(count, value) for value, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    # __add__ merges two sketches of separate incidents. A value one of them
+    # does not track may have been counted up to its floor there, so that
+    # is added to both its count and its error, and the most counted values
+    # are kept.
+    def __add__(self, other):
+        floor, other_floor = self.floor(), other.floor()
+        merged = TopKSketch(max(self.size, other.size))
+
+        estimates = [
+            (
+                self.counts.get(value, floor) + other.counts.get(value, other_floor),
+                self.errors.get(value, floor) + other.errors.get(value, other_floor),
+                value,
+            )
+            for value in {**self.counts, **other.counts}
+        ]
+        for count, error, value in heapq.nlargest(
+            merged.size, estimates, key=lambda e: e[0]
+        ):
+            merged.counts[value] = count
+            merged.errors[value] = error
+        merged.rebuild()
+
+        return merged
+
+
+# print_aggregation prints the counts for each dimension of an aggregation:
+# the most common values, or every value in order for ordered columns.
+# Approximate counts are followed by their error bound, from the sketch, or
+# from errors, the bounds a server sent for each dimension's values.
+def print_aggregation(aggregation, count, errors=None):
+    for n, (dimension, counts) in enumerate(aggregation.items()):
+        if n > 0:
+            print("")
+
+        rows = aggregation_rows(dimension, counts, count)
+        if isinstance(counts, TopKSketch):
+            error = counts.error
+        elif errors and dimension in errors:
+            error = errors[dimension].get
+        else:
+            error = None
+
+        if error:
+            print_counts(
+                f"ERROR\t{dimension_heading(dimension)}",
+                [(f"{error(k)}\t{format_key(k)}", v) for k, v in rows],
+            )
+            continue
+
+        print_counts(
+            dimension_heading(dimension),
+            [(format_key(k), v) for k, v in rows],
+        )
+
+
+# print_resolve_times prints how long the resolved incidents in the mask
+# took to resolve, in hours: the median, 90th percentile and longest, for
+# all of them and for the alerts that were resolved most often
+def print_resolve_times(frame, mask, count):
+    np = import_numpy()
+
+    resolved = mask & frame.resolved
+    rows = [("(all)", frame.resolve_times(mask))]
+    for alert, _ in frame.count(("alert",), resolved).most_common(count):
+        code = frame.values["alert"].index(alert)
+        rows.append((alert, frame.resolve_times(mask & (frame.codes["alert"] == code))))
+
+    print("RESOLVED\tMEDIAN_H\tP90_H\tMAX_H\tINCIDENT")
+    for alert, times in rows:
+        if len(times) == 0:
+            print(f"0\t-\t-\t-\t{alert}")
+            continue
+
+        hours = times / 3600
+        print(
+            f"{len(times)}\t{np.median(hours):.1f}\t{np.percentile(hours, 90):.1f}"
+            f"\t{hours.max():.1f}\t{alert}"
+        )
+
+
+# aggregation_rows returns the (value, count) pairs a report lists for a
+# dimension: the most common values, or every value in order for ordered
+# columns
+def aggregation_rows(dimension, counts, count):
+    if isinstance(counts, (Counter, TopKSketch)):
+        counts = counts.most_common()
+    if any(column in ordered_columns for column in dimension):
+        return sorted(counts)
+
+    return counts[:count]
+
+
+# dimension_heading returns the column headings for a dimension
+def dimension_heading(dimension):
+    return "\t".join(aggregate_headings.get(c, c.upper()) for c in dimension)
+
+
+# format_key formats an aggregation key, with crossed columns tab separated
+def format_key(key):
+    return "\t".join(str(k) for k in key) if isinstance(key, tuple) else key
+
+
+# parse_dimension parses a breakdown such as "alert:cluster" into a tuple
+# of aggregate columns
+def parse_dimension(value):
+    dimension = tuple(value.split(":"))
+    for column in dimension:
+        if column not in aggregate_columns:
+            raise argparse.ArgumentTypeError(
+                f"unknown column {column!r} (choose from "
+                f"{', '.join(aggregate_columns)})"
+            )
+
+    return dimension
+
+
+# print_counts prints (value, count) pairs under a COUNT heading
+def print_counts(heading, counts):
+    print(f"COUNT\t{heading}")
+    for k, v in counts:
         print(f"{v}\t{k}")
 
 
 # parse_description_for_alerts parses the description of an incident to
-# remove unique values or extraneous text
+# remove unique values or extraneous text. Summaries repeat a lot, so
+# results are memoized; the cache is cleared when the rules change. Most
+# rules are for one family of alerts, so a rule is only run if the
+# description contains the text any match of it would (see
+# required_literal).
+@lru_cache(maxsize=normalization_cache_size)
 def parse_description_for_alerts(description):
-    strings_to_remove = {
-        # Clean SRE-added '[SOMETHING]' prefixes, with optional dash
-        r"\[.*\]\s(-\s)?": "",
-        # Combine "CRITICAL (1)" and "CRITICAL (2)" alerts
-        r"\s(CRITICAL|WARNING)\s\(\d*\)$": "",
-        # Combine all ClusterHasGoneMissing alerts
-        r".*has\sgone\smissing$": "ClusterHasGoneMissing",
-        # Zabbix-style (?) alerts
-        r"\son\s.*\s\:\s.*$": "",
-    }
-
-    strings_to_match = [
-        r"^ClusterProvisioningDelay",
-    ]
-
     # Removes extraneous information from the description
-    for k, v in strings_to_remove.items():
-        description = re.sub(k, v, description)
+    for pattern, replacement, literal in normalization_rules["alerts"]:
+        if literal in description:
+            description = pattern.sub(replacement, description)
 
     # Selects the relevant information from the description
-    for i in strings_to_match:
-        match = re.compile(i).match(description)
-        description = match.group() if match else description
+    for pattern, literal in normalization_rules["alerts_match"]:
+        if literal in description:
+            match = pattern.match(description)
+            description = match.group() if match else description
 
     return description
 
 
 # parse_description_for_cluster parses the description of an incident to
-# remove unique data and extraneous text
+# remove unique data and extraneous text, skipping rules the same way
+@lru_cache(maxsize=normalization_cache_size)
 def parse_description_for_cluster(description):
-    strings_to_remove = [
-        # Clean SRE-added '[SOMETHING]' prefixes
-        r"\[.*\]\s",
-        # ClusterHasGoneMissing
-        r"\shas\sgone\smissing",
-        # docker.ping failed
-        r"docker.ping\sfailed\son\s",
-        r"-compute.*$",
-        # ClusterProvisioningDelay
-        r"ClusterProvisioningDelay\s.*\shive\s\(",
-        r"\sProvisionFailed.*$",
-        # Disk Free
-        r"Filesystem.*free\sdisk\sspace\son\s",
-        r":\sPROBLEM\s.*$",
-        # Strip leading 'osd-'
-        r"^osd-",
-        # Strip trailing '-hive-cluster'
-        r"-hive-cluster$",
-    ]
-
-    for i in strings_to_remove:
-        description = re.sub(i, "", description)
+    for pattern, replacement, literal in normalization_rules["clusters"]:
+        if literal in description:
+            description = pattern.sub(replacement, description)
 
     return description
 
 
+# compile_normalization_rules compiles the default normalization rules,
+# followed by any extra rules, into the form the parse_description_*
+# functions apply them in: each pattern with the text it requires
+def compile_normalization_rules(extra_rules=None):
+    extra_rules = extra_rules or {}
+
+    return {
+        "alerts": [
+            compile_rule(pattern, replacement)
+            for pattern, replacement in default_alert_rules
+            + extra_rules.get("alerts", [])
+        ],
+        "alerts_match": [
+            compile_rule(pattern)
+            for pattern in default_alert_match_rules
+            + extra_rules.get("alerts_match", [])
+        ],
+        "clusters": [
+            compile_rule(pattern, replacement)
+            for pattern, replacement in default_cluster_rules
+            + extra_rules.get("clusters", [])
+        ],
+    }
+
+
+# compile_rule compiles the pattern of a normalization rule, returning it
+# with the replacement, if the rule has one, and the text it requires
+def compile_rule(pattern, *replacement):
+    pattern = re.compile(pattern)
+
+    return (pattern, *replacement, required_literal(pattern))
+
+
+# required_literal returns the longest text that any match of the pattern
+# contains, so the pattern can be skipped for text without it; "" if it
+# cannot tell. Only literal characters outside of groups and classes, that
+# no quantifier makes optional or repeats, are taken into account, and
+# patterns with top-level alternation, numeric escapes or flags that
+# change what a literal matches have none.
+def required_literal(pattern):
+    if pattern.flags & (re.IGNORECASE | re.VERBOSE):
+        return ""
+
+    source = pattern.pattern
+    runs, run, depth, n = [], "", 0, 0
+    while n < len(source):
+        c = source[n]
+        n += 1
+        atom = None
+
+        if c == "\\":
+            escaped = source[n : n + 1]
+            n += 1
+            if escaped == "" or escaped in "xuUN0123456789":
+                return ""
+            if escaped.isalnum() is False:
+                atom = escaped
+        elif c in "*?+{":
+            # The quantified character is not required
+            run = run[:-1]
+            if c == "{":
+                end = source.find("}", n)
+                n = len(source) if end == -1 else end + 1
+        elif c == "[":
+            n = class_end(source, n)
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            return ""
+        elif c not in ".^$|":
+            atom = c
+
+        if atom is not None and depth == 0:
+            run += atom
+        else:
+            runs.append(run)
+            run = ""
+    runs.append(run)
+
+    return max(runs, key=len)
+
+
+# class_end returns the position just after the character class that
+# starts at the given position (after its "[")
+def class_end(source, n):
+    if source[n : n + 1] == "^":
+        n += 1
+    if source[n : n + 1] == "]":
+        n += 1
+    while n < len(source) and source[n] != "]":
+        n += 2 if source[n] == "\\" else 1
+
+    return n + 1
+
+
+# set_normalization_rules replaces the rules used by the parse_description_*
+# functions, and clears their memoized results
+def set_normalization_rules(rules):
+    normalization_rules.clear()
+    normalization_rules.update(rules)
+    parse_description_for_alerts.cache_clear()
+    parse_description_for_cluster.cache_clear()
+
+
+normalization_rules = compile_normalization_rules()
+
+
 # is_in_layer checks if a datetime is in the shift covered by the layer
 def is_in_layer(time_string, requested_layers):
-    for layer in requested_layers:
-        time_format = "%H:%M"
-        if is_time_between(
-            datetime.strptime(pd_layers[layer], time_format).time(),
-            datetime.strptime(pd_layers[next_layer(layer)], time_format).time(),
-            datetime.strptime(time_string, pd_time_format).time(),
-        ):
-            return True
+    return minute_in_layers(
+        minute_of_day(time_string), int(time_string[17:19]), requested_layers
+    )
+
+
+# minute_in_layers checks if a minute of the day (and second within it) is
+# in the shift covered by any of the layers
+def minute_in_layers(minute, second, requested_layers):
+    if layer_table[minute] in requested_layers:
+        return True
+
+    # Shifts include the minute they end on, so a time exactly on a
+    # boundary is also in the shift that ends there
+    return second == 0 and layer_ends.get(minute) in requested_layers
+
+
+# incident_layer returns the layer whose shift the PagerDuty timestamp falls
+# in. A time exactly on a shift boundary belongs to the shift starting then.
+def incident_layer(time_string):
+    return layer_table[minute_of_day(time_string)]
+
+
+# minute_of_day returns the minute of the day for a PagerDuty timestamp, or
+# a "%H:%M" layer start time
+def minute_of_day(time_string):
+    if "T" in time_string:
+        time_string = time_string[11:16]
+
+    hour, minute = time_string.split(":")
+    return int(hour) * 60 + int(minute)
+
 
-    # If not in any layers, return False
-    return False
+# build_layer_table compiles the layer start times into a lookup of the
+# layer for each minute of the day, and of the layer ending on each
+# boundary minute
+def build_layer_table(layers):
+    table = [None] * 24 * 60
+    ends = {}
+    numbers = sorted(layers)
+    for index, layer in enumerate(numbers):
+        # Each shift runs until the next layer's starts, as in next_layer
+        start = minute_of_day(layers[layer])
+        end = minute_of_day(layers[numbers[(index + 1) % len(numbers)]])
+        ends[end] = layer
+
+        minute = start
+        while minute != end:
+            table[minute] = layer
+            minute = (minute + 1) % len(table)
+
+    return table, ends
 
 
 # is_time_between checks if a time is between two other times
@@ -437,14 +3971,49 @@ def next_layer(layer):
     return layer + 1 if layer < len(pd_layers) else 1
 
 
+layer_table, layer_ends = build_layer_table(pd_layers)
+
+
+# retrieve_normalization_rules gets extra normalization rules from the
+# config file, to be applied after the default rules, eg:
+#
+# normalization:
+#   alerts:
+#     - pattern: '^KubePod.*'
+#       replace: 'KubePodAlerts'
+#   alerts_match:
+#     - '^etcd[A-Za-z]+'
+#   clusters:
+#     - pattern: '\.example\.org$'
+#
+def retrieve_normalization_rules(verbose, config_file):
+    debug(verbose, f"Getting normalization rules from config file: {config_file}")
+    data = read_config(config_file) or {}
+
+    config = data.get("normalization") or {}
+    rules = {
+        "alerts": [
+            [rule["pattern"], rule.get("replace", "")]
+            for rule in config.get("alerts", [])
+        ],
+        "alerts_match": list(config.get("alerts_match", [])),
+        "clusters": [
+            [rule["pattern"], rule.get("replace", "")]
+            for rule in config.get("clusters", [])
+        ],
+    }
+
+    debug(verbose, f"Extra normalization rules: {rules}")
+    return rules
+
+
 # retrieve_team_ids gets the list of team ids from the config file
 def retrieve_team_ids(verbose, config_file):
     debug(verbose, f"Getting team IDs from config file: {config_file}")
-    with open(config_file, "r") as yaml_data:
-        data = yaml.safe_load(yaml_data)
+    data = read_config(config_file)
 
-        if "team_ids" in data.keys():
-            return data["team_ids"]
+    if "team_ids" in data.keys():
+        return data["team_ids"]
 
     return []
 
@@ -460,13 +4029,88 @@ def retrieve_token(verbose, token, config_file):
         return os.getenv("PD_TOKEN")
     else:
         debug(verbose, "Using provided config_file")
-        with open(config_file, "r") as yaml_data:
-            try:
-                data = yaml.safe_load(yaml_data)
-                return data["authtoken"]
+        return ConfigToken(config_file)
+
+
+# ConfigToken stands in for the token in the config file, and reads it only
+# when a session is opened, so reports answered from the cache never parse
+# the config for it
+class ConfigToken:
+    def __init__(self, config_file):
+        self.config_file = config_file
+
+    def __str__(self):
+        try:
+            return read_config(self.config_file)["authtoken"]
+        except import_yaml().YAMLError as err:
+            raise SystemExit(str(err))
+
+
+# retrieve_config returns the team ids and normalization rules in the config
+# file. They are kept in the config cache along with the config file's
+# path, size and modification time, and the file is only parsed again when
+# any of those change.
+def retrieve_config(verbose, config_file, no_cache=False):
+    stat = Path(config_file).stat()
+    key = {
+        "config_file": str(Path(config_file).absolute()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+    cache_file = default_config_cache_file
+    if no_cache is False and cache_file.exists():
+        with cache_file.open() as f:
+            cached = json.load(f)
+        if cached.get("key") == key:
+            debug(verbose, f"Using config cached in {cache_file}")
+            return cached["config"]
+
+    config = {
+        "team_ids": retrieve_team_ids(verbose, config_file),
+        "normalization": retrieve_normalization_rules(verbose, config_file),
+    }
+
+    if no_cache is False:
+        debug(verbose, f"Caching config in {cache_file}")
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        partial_file = cache_file.with_name(f".partial-{cache_file.name}")
+        with partial_file.open(mode="w+", encoding="utf-8") as f:
+            json.dump({"key": key, "config": config}, f)
+        partial_file.replace(cache_file)
+
+    return config
+
+
+# read_config reads the YAML config file. The token, team ids and
+# normalization rules all come from it, so it is only parsed once.
+@lru_cache(maxsize=None)
+def read_config(config_file):
+    with open(config_file, "r") as yaml_data:
+        return import_yaml().safe_load(yaml_data)
+
+
+# import_numpy imports NumPy on first use; it is an optional dependency,
+# only needed for --columnar and --resolve-times
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise SystemExit(
+            "The numpy package is required for --columnar and --resolve-times; "
+            "install it, or leave them out"
+        )
+
+    return numpy
+
+
+# import_yaml imports the YAML parser on first use, as it is not needed
+# when the config is cached, and the token is given another way or
+# reports are answered from the cache
+def import_yaml():
+    import yaml
 
-            except yaml.YAMLError as err:
-                print(err)
+    return yaml
 
 
 def percent_change(current, previous):
@@ -485,4 +4129,6 @@ def debug(verbose, *args):
 
 
 if __name__ == "__main__":
+    # Lets the normalization workers start from a PyInstaller build
+    multiprocessing.freeze_support()
     main()
@@ -1,18 +1,59 @@
 #!/usr/bin/env python3
 
+import argparse
+import importlib.util
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+
+from collections import Counter
+from contextlib import closing, redirect_stderr, redirect_stdout
 from pathlib import Path
-from datetime import date, datetime
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import parse_qs
+
+from unittest.mock import MagicMock, patch
+from unittest import TestCase, skipUnless
 
-from unittest.mock import MagicMock
-from unittest import TestCase
+import metrics
 
+from fake_pagerduty import FakePagerDutyAPI
 from metrics import helpers
 
 from metrics import next_layer, percent_change, is_time_between, is_in_layer
 from metrics import parse_description_for_alerts, parse_description_for_cluster
 from metrics import clusters, alerts
 from metrics import split_incidents_by_period, get_incidents
+from metrics import split_incidents_into_periods
 from metrics import select_cache_file
+from metrics import split_time_window, merge_incidents
+from metrics import sync_since, cache_metadata_file
+from metrics import open_incident_store, upsert_incidents, read_incidents_from_store
+from metrics import store_period_counts, store_top_counts, incident_layer
+from metrics import compile_normalization_rules, set_normalization_rules
+from metrics import normalization_rules, required_literal
+from metrics import retrieve_normalization_rules, build_layer_table
+from metrics import retrieve_config
+from metrics import Incident, normalize_incidents
+from metrics import batch_reports, attribute_alert_clusters, team_cache_file
+from metrics import read_alert_clusters
+from metrics import RequestGovernor, request_governor, retry_after
+from metrics import set_request_rate
+from metrics import aggregate_incidents, report_dimensions, parse_dimension
+from metrics import report_server, client_report
+from metrics import report_request, incident_report, print_period_summary
+from metrics import print_aggregation, TopKSketch, IncidentFrame
+from metrics import print_report, rollup_report
+from metrics import start_profile, profile_stage, profile_request, print_profile
+from metrics import write_incidents_to_cache, read_incidents_from_cache
+from metrics import write_cache_metadata
+from metrics import project_incident, stream_incident_pages, cache_writer
+from metrics import shift_windows, plan_incident_queries, IncompleteDownloadError
 
 test_incidents = [
     {
@@ -83,6 +124,82 @@ test_incidents = [
 ]
 
 
+# make_incident returns a copy of the test incident with the given fields
+def make_incident(**fields):
+    incident = json.loads(json.dumps(test_incidents[0]))
+    incident.update(fields)
+    return incident
+
+
+class TestLazyImports(TestCase):
+    def test_lazy_imports(self):
+        # Importing metrics, as a --server client does, should not pay for
+        # importing the HTTP stack, the YAML parser, or NumPy
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, metrics; "
+                "print(sorted({'numpy', 'pdpyras', 'requests', 'yaml'} & set(sys.modules)))",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        )
+
+        self.assertEqual(result.stdout.strip(), "[]")
+
+    def test_cache_hit_imports(self):
+        # A report answered from a fresh cache never imports the HTTP stack,
+        # nor the YAML parser once the config is cached
+        with tempfile.TemporaryDirectory() as d:
+            config_file = Path(d).joinpath("pd.yml")
+            config_file.write_text("---\nauthtoken: token\nteam_ids: []\n")
+            cache_file = Path(d).joinpath("incident-cache.jsonl")
+            write_incidents_to_cache(test_incidents, cache_file, False)
+            write_cache_metadata(
+                test_incidents,
+                cache_file,
+                helpers.today() - timedelta(days=28),
+                [],
+                False,
+            )
+
+            argv = [
+                "metrics.py",
+                "all",
+                "--days",
+                "14",
+                "--config_file",
+                str(config_file),
+                "--cache-file",
+                str(cache_file),
+            ]
+
+            def imported():
+                result = subprocess.run(
+                    [
+                        sys.executable,
+                        "-c",
+                        f"import sys, metrics; sys.argv = {argv!r}; metrics.main(); "
+                        "print(sorted({'numpy', 'pdpyras', 'requests', 'yaml'} "
+                        "& set(sys.modules)))",
+                    ],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                    cwd=Path(__file__).parent,
+                    env=dict(os.environ, HOME=d),
+                )
+                return result.stdout.strip().splitlines()[-1]
+
+            first, second = imported(), imported()
+
+        self.assertEqual(first, "['yaml']")
+        self.assertEqual(second, "[]")
+
+
 class TestSelectCacheFile(TestCase):
     def test_select_cache_file(self):
 
@@ -96,35 +213,65 @@ class TestSelectCacheFile(TestCase):
             {
                 "name": "test_select_cache_file_custom_01",
                 "cache_file": "/tmp/test",
-                "layers": [1, 2],
-                "days": 1,
+                "sync": False,
                 "expect": (Path("/tmp/test")),
             },
             {
                 "name": "test_select_cache_file_custom_02",
                 "cache_file": None,
-                "layers": [1, 2],
-                "days": 1,
+                "sync": False,
                 "expect": Path(
-                    "/home/user/.cache/toil-review-metrics/incident-cache_2020-01-01_1-2_1-day.json"
+                    "/home/user/.cache/toil-review-metrics/incident-cache_2020-01-01.jsonl"
                 ),
             },
             {
                 "name": "test_select_cache_file_custom_03",
                 "cache_file": None,
-                "layers": [2],
-                "days": 3,
+                "sync": True,
                 "expect": Path(
-                    "/home/user/.cache/toil-review-metrics/incident-cache_2020-01-01_2_3-day.json"
+                    "/home/user/.cache/toil-review-metrics/incident-cache_sync.jsonl"
                 ),
             },
             {
                 "name": "test_select_cache_file_custom_04",
+                "cache_file": "/tmp/test",
+                "sync": True,
+                "expect": (Path("/tmp/test")),
+            },
+            {
+                "name": "test_select_cache_file_custom_05",
+                "cache_file": None,
+                "sync": False,
+                "cache_format": "json",
+                "expect": Path(
+                    "/home/user/.cache/toil-review-metrics/incident-cache_2020-01-01.json"
+                ),
+            },
+            {
+                "name": "test_select_cache_file_custom_06",
                 "cache_file": None,
-                "layers": [5, 1, 2],
-                "days": 3,
+                "sync": False,
+                "cache_format": "jsonl.gz",
                 "expect": Path(
-                    "/home/user/.cache/toil-review-metrics/incident-cache_2020-01-01_5-1-2_3-day.json"
+                    "/home/user/.cache/toil-review-metrics/incident-cache_2020-01-01.jsonl.gz"
+                ),
+            },
+            {
+                "name": "test_select_cache_file_custom_07",
+                "cache_file": None,
+                "sync": False,
+                "cache_format": "sqlite",
+                "expect": Path(
+                    "/home/user/.cache/toil-review-metrics/incident-cache.sqlite3"
+                ),
+            },
+            {
+                "name": "test_select_cache_file_custom_08",
+                "cache_file": None,
+                "sync": True,
+                "cache_format": "segments",
+                "expect": Path(
+                    "/home/user/.cache/toil-review-metrics/incident-cache.segments"
                 ),
             },
         ]
@@ -132,7 +279,9 @@ class TestSelectCacheFile(TestCase):
         for testcase in testcases:
             self.assertEqual(
                 select_cache_file(
-                    testcase["cache_file"], testcase["layers"], testcase["days"]
+                    testcase["cache_file"],
+                    testcase["sync"],
+                    testcase.get("cache_format", "jsonl"),
                 ),
                 testcase["expect"],
                 "{} should be: {}".format(testcase["name"], testcase["expect"]),
@@ -153,10 +302,49 @@ class TestReadIncidentsFromCache(TestCase):
 
 class TestWriteIncidentsToCache(TestCase):
     def test_write_incidents_to_cache(self):
-        # NOTE: TODO
-        # Need to figure out how to test the file writing, cache dir creation
-        # with mocks, and test reading the file
-        pass
+        incidents = [
+            make_incident(id="A", status="resolved"),
+            make_incident(id="B", status="triggered"),
+        ]
+
+        testcases = [
+            {"name": "test_raw", "file_name": "cache.json", "expect": incidents},
+            {
+                "name": "test_projected",
+                "file_name": "cache.jsonl",
+                "expect": [project_incident(i) for i in incidents],
+            },
+            {
+                "name": "test_projected_gzip",
+                "file_name": "cache.jsonl.gz",
+                "expect": [project_incident(i) for i in incidents],
+            },
+        ]
+
+        for testcase in testcases:
+            with tempfile.TemporaryDirectory() as d:
+                # The cache directory is created if needed
+                cache_file = Path(d).joinpath("cache", testcase["file_name"])
+                write_incidents_to_cache(incidents, cache_file, False)
+
+                self.assertEqual(
+                    read_incidents_from_cache(cache_file, False),
+                    testcase["expect"],
+                    "{} should round trip".format(testcase["name"]),
+                )
+                self.assertEqual(
+                    read_incidents_from_cache(cache_file, False, open_only=True),
+                    testcase["expect"][1:],
+                    "{} should only read open incidents".format(testcase["name"]),
+                )
+
+        projected = project_incident(incidents[0])
+        self.assertEqual(projected["service"], {"summary": "Service Summary"})
+        self.assertNotIn("assignments", projected)
+        self.assertEqual(
+            Incident.from_pagerduty(projected).alert,
+            Incident.from_pagerduty(incidents[0]).alert,
+        )
 
 
 class TestCacheToFile(TestCase):
@@ -167,10 +355,1069 @@ class TestCacheToFile(TestCase):
 
 class TestGetIncidents(TestCase):
     def test_get_Incidents(self):
-        # NOTE: TODO
-        # Need to mock a call to the API to get the incidents
-        # And the retrieve_token function
-        pass
+        # One incident per hour over the 2 x 2 day window, all in layer 1-5
+        start = datetime(2022, 2, 20, 0, 0, 0)
+        incidents = [
+            make_incident(
+                id=f"INCIDENT{n}",
+                created_at=(start + timedelta(hours=n)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            )
+            for n in range(96)
+        ]
+
+        testcases = [
+            {"name": "test_serial", "concurrency": 1, "slice_mode": "day"},
+            {"name": "test_parallel_day", "concurrency": 4, "slice_mode": "day"},
+            {
+                "name": "test_parallel_adaptive",
+                "concurrency": 4,
+                "slice_mode": "adaptive",
+            },
+        ]
+
+        for testcase in testcases:
+            with FakePagerDutyAPI(incidents) as api, tempfile.TemporaryDirectory() as d:
+                with patch("metrics.pd_api_url", api.url), patch(
+                    "metrics.pd_page_size", 10
+                ), patch.object(
+                    helpers, "today", return_value=datetime(2022, 2, 24, 0, 0, 0)
+                ):
+                    result = get_incidents(
+                        2,
+                        [1, 2, 3, 4, 5],
+                        "token",
+                        [],
+                        False,
+                        Path(d).joinpath("cache.json"),
+                        True,
+                        concurrency=testcase["concurrency"],
+                        slice_mode=testcase["slice_mode"],
+                    )
+
+            self.assertEqual(
+                [i.id for i in result],
+                [i["id"] for i in incidents],
+                "{} should return every incident once".format(testcase["name"]),
+            )
+
+
+class TestRequestGovernor(TestCase):
+    def test_rate_limited(self):
+        incidents = [make_incident(id=f"INCIDENT{n}") for n in range(5)]
+
+        with FakePagerDutyAPI(incidents, rate_limited=3) as api:
+            with tempfile.TemporaryDirectory() as d, patch(
+                "metrics.pd_api_url", api.url
+            ), patch.object(
+                helpers, "today", return_value=datetime(2022, 2, 24, 0, 0, 0)
+            ):
+                result = get_incidents(
+                    2,
+                    [1, 2, 3, 4, 5],
+                    "rate-limited-token",
+                    [],
+                    False,
+                    Path(d).joinpath("cache.json"),
+                    True,
+                )
+
+        governor = request_governor("rate-limited-token", 16.0)
+        self.assertEqual(len(result), 5)
+        self.assertEqual(governor.rate_limited, 3)
+        # Each 429 halves the concurrency limit, which then grows back slowly
+        self.assertLess(governor.limit, 4)
+
+    def test_request_rate(self):
+        governor = RequestGovernor(rate=50)
+
+        def send():
+            return MagicMock(status_code=200)
+
+        started = datetime.now()
+        for _ in range(6):
+            governor.send(send)
+
+        # The first request goes straight away, the rest are paced
+        self.assertGreaterEqual(datetime.now() - started, timedelta(seconds=0.09))
+
+        # A rate of 0 or less would never let a request through
+        for rate in [0, -1]:
+            with self.assertRaises(SystemExit):
+                set_request_rate(rate)
+
+    def test_retry_after(self):
+        testcases = [
+            {"name": "seconds", "headers": {"Retry-After": "3"}, "expect": 3},
+            {"name": "missing", "headers": {}, "expect": 4},
+            {
+                "name": "date",
+                "headers": {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"},
+                "expect": 0,
+            },
+        ]
+
+        for testcase in testcases:
+            self.assertEqual(
+                retry_after(MagicMock(headers=testcase["headers"]), 2),
+                testcase["expect"],
+                "{} should be: {}".format(testcase["name"], testcase["expect"]),
+            )
+
+
+class TestLayerIndependentCache(TestCase):
+    def test_layer_independent_cache(self):
+        incidents = [
+            # Layer 1 (22:30 - 3:30)
+            make_incident(id="LAYER1", created_at="2022-02-21T23:00:00Z"),
+            # Layer 4 (13:30 - 18:00)
+            make_incident(id="LAYER4", created_at="2022-02-22T14:00:00Z"),
+            # Layer 4, but only inside the 2 x 2 day window
+            make_incident(id="EARLY", created_at="2022-02-19T14:00:00Z"),
+        ]
+
+        with FakePagerDutyAPI(incidents) as api, tempfile.TemporaryDirectory() as d:
+            cache_file = Path(d).joinpath("cache.json")
+            with patch("metrics.pd_api_url", api.url), patch.object(
+                helpers, "today", return_value=datetime(2022, 2, 23, 0, 0, 0)
+            ):
+
+                def get(days, layers):
+                    return [
+                        i.id
+                        for i in get_incidents(
+                            days, layers, "token", [], False, cache_file, False
+                        )
+                    ]
+
+                self.assertEqual(get(2, [4]), ["EARLY", "LAYER4"])
+                requests = len(api.requests)
+
+                # Other layers and shorter windows are served from the cache
+                self.assertEqual(get(2, [1]), ["LAYER1"])
+                self.assertEqual(get(1, [1, 4]), ["LAYER1", "LAYER4"])
+                self.assertEqual(len(api.requests), requests)
+
+                # A longer window than the cache covers is downloaded again
+                get(3, [4])
+                self.assertGreater(len(api.requests), requests)
+
+
+class TestIncidentStore(TestCase):
+    def test_incident_store(self):
+        incidents = [
+            # Previous period
+            make_incident(
+                id="A",
+                created_at="2022-02-19T14:00:00Z",
+                summary="[SL Sent] one.example.org has gone missing",
+            ),
+            # Current period, layers 4 and 1
+            make_incident(
+                id="B",
+                created_at="2022-02-21T14:00:00Z",
+                summary="[SL Sent] one.example.org has gone missing",
+            ),
+            make_incident(
+                id="C",
+                created_at="2022-02-21T23:00:00Z",
+                summary="DNSErrors10MinSRE CRITICAL (1)",
+                service=dict(test_incidents[0]["service"], summary="osd-two"),
+            ),
+            make_incident(
+                id="D",
+                created_at="2022-02-22T14:00:00Z",
+                summary="DNSErrors10MinSRE CRITICAL (2)",
+                service=dict(test_incidents[0]["service"], summary="Zabbix Service"),
+            ),
+        ]
+
+        with tempfile.TemporaryDirectory() as d:
+            with closing(open_incident_store(Path(d).joinpath("s.sqlite3"))) as store:
+                upsert_incidents(store, incidents)
+                # Upserting again updates rows instead of duplicating them
+                upsert_incidents(store, [dict(incidents[3], status="triggered")])
+
+                with patch.object(
+                    helpers, "today", return_value=datetime(2022, 2, 23, 0, 0, 0)
+                ):
+                    period_counts = store_period_counts(store, 2, [1, 4])
+                    layer_4_counts = store_period_counts(store, 2, [4])
+                    since = datetime(2022, 2, 21, 0, 0, 0)
+                    alert_counts = store_top_counts(store, "alert", since, [1, 4], 5)
+                    cluster_counts = store_top_counts(
+                        store, "cluster", since, [1, 4], 5
+                    )
+                    cross_counts = store_top_counts(
+                        store, ("day", "alert"), since, [1, 4], None
+                    )
+
+                stored = read_incidents_from_store(store)
+                open_incidents = read_incidents_from_store(store, open_only=True)
+
+        self.assertEqual(tuple(period_counts), (3, 1))
+        self.assertEqual(tuple(layer_4_counts), (2, 1))
+        self.assertEqual(
+            alert_counts, [("DNSErrors10MinSRE", 2), ("ClusterHasGoneMissing", 1)]
+        )
+        self.assertEqual(cluster_counts, [("Service Summary", 1), ("two", 1)])
+        self.assertEqual(
+            cross_counts,
+            [
+                (("2022-02-21", "ClusterHasGoneMissing"), 1),
+                (("2022-02-21", "DNSErrors10MinSRE"), 1),
+                (("2022-02-22", "DNSErrors10MinSRE"), 1),
+            ],
+        )
+        self.assertEqual([i["id"] for i in stored], ["A", "B", "C", "D"])
+        self.assertEqual([i["id"] for i in open_incidents], ["D"])
+
+    def test_incident_store_shift_boundary(self):
+        # Layer 3 ends and layer 4 starts at 13:30; an incident created on
+        # that second is in both, as is_in_layer counts it
+        incidents = [
+            make_incident(id="BOUNDARY", created_at="2022-02-22T13:30:00Z"),
+            make_incident(id="AFTER", created_at="2022-02-22T13:30:01Z"),
+            make_incident(id="BEFORE", created_at="2022-02-22T13:29:59Z"),
+        ]
+
+        with tempfile.TemporaryDirectory() as d:
+            with closing(open_incident_store(Path(d).joinpath("s.sqlite3"))) as store:
+                upsert_incidents(store, incidents)
+
+                with patch.object(
+                    helpers, "today", return_value=datetime(2022, 2, 23, 0, 0, 0)
+                ):
+                    counts = {
+                        layer: tuple(store_period_counts(store, 2, [layer]))
+                        for layer in [3, 4]
+                    }
+                    top = store_top_counts(
+                        store, "day", datetime(2022, 2, 21), [3], None
+                    )
+
+        self.assertEqual(counts, {3: (2, 0), 4: (2, 0)})
+        self.assertEqual(
+            [is_in_layer(i["created_at"], [3]) for i in incidents],
+            [True, False, True],
+        )
+        self.assertEqual(top, [("2022-02-22", 2)])
+
+    def test_incident_store_rules_change(self):
+        self.addCleanup(set_normalization_rules, compile_normalization_rules())
+
+        with tempfile.TemporaryDirectory() as d:
+            cache_file = Path(d).joinpath("s.sqlite3")
+            with closing(open_incident_store(cache_file)) as store:
+                upsert_incidents(
+                    store,
+                    [
+                        make_incident(
+                            id="A",
+                            created_at="2022-02-21T14:00:00Z",
+                            summary="DNSErrors10MinSRE CRITICAL (1)",
+                        )
+                    ],
+                )
+
+            # Reopening the store with other rules derives the alerts again
+            set_normalization_rules(
+                compile_normalization_rules(
+                    {"alerts": [["DNSErrors10MinSRE", "DNSErrors"]]}
+                )
+            )
+            with closing(open_incident_store(cache_file)) as store:
+                renamed = store_top_counts(
+                    store, "alert", datetime(2022, 2, 21), [1, 2, 3, 4, 5], 5
+                )
+
+        self.assertEqual(renamed, [("DNSErrors", 1)])
+
+
+class TestIncidentLayer(TestCase):
+    def test_incident_layer(self):
+        testcases = [
+            {
+                "name": "test_layer_1",
+                "time_string": "2020-01-01T23:00:00Z",
+                "expect": 1,
+            },
+            {
+                "name": "test_layer_1_after_midnight",
+                "time_string": "2020-01-01T00:00:00Z",
+                "expect": 1,
+            },
+            {
+                "name": "test_layer_2",
+                "time_string": "2020-01-01T04:00:00Z",
+                "expect": 2,
+            },
+            {
+                "name": "test_boundary",
+                "time_string": "2020-01-01T03:30:00Z",
+                "expect": 2,
+            },
+            {
+                "name": "test_layer_5",
+                "time_string": "2020-01-01T22:29:59Z",
+                "expect": 5,
+            },
+        ]
+
+        for testcase in testcases:
+            self.assertEqual(
+                incident_layer(testcase["time_string"]),
+                testcase["expect"],
+                "{} should be: {}".format(testcase["name"], testcase["expect"]),
+            )
+
+
+class TestSyncIncidents(TestCase):
+    def test_sync_incidents(self):
+        incidents = [
+            make_incident(id="OLD", created_at="2022-02-20T01:00:00Z"),
+            make_incident(
+                id="OPEN", created_at="2022-02-21T01:00:00Z", status="triggered"
+            ),
+            make_incident(id="NEWEST", created_at="2022-02-22T01:00:00Z"),
+        ]
+
+        with FakePagerDutyAPI(incidents) as api, tempfile.TemporaryDirectory() as d:
+            cache_file = Path(d).joinpath("cache.json")
+            with patch("metrics.pd_api_url", api.url), patch.object(
+                helpers, "today", return_value=datetime(2022, 2, 23, 0, 0, 0)
+            ):
+
+                def sync():
+                    return get_incidents(
+                        2,
+                        [1, 2, 3, 4, 5],
+                        "token",
+                        [],
+                        False,
+                        cache_file,
+                        False,
+                        sync=True,
+                    )
+
+                sync()
+
+                # The open incident resolves and a new one arrives
+                incidents[1] = dict(incidents[1], status="resolved")
+                incidents.append(
+                    make_incident(id="LATEST", created_at="2022-02-22T12:00:00Z")
+                )
+                result = sync()
+                state = json.loads(cache_metadata_file(cache_file).read_text())
+
+        # The second sync only asks for what could have changed
+        self.assertEqual(api.requests[-1]["since"], ["2022-02-21T01:00:00Z"])
+        self.assertEqual(
+            [(i.id, i.status) for i in result],
+            [
+                ("OLD", "resolved"),
+                ("OPEN", "resolved"),
+                ("NEWEST", "resolved"),
+                ("LATEST", "resolved"),
+            ],
+        )
+        self.assertEqual(state["created_at"], "2022-02-22T12:00:00Z")
+
+
+class TestSegmentCache(TestCase):
+    def test_segment_cache(self):
+        incidents = [
+            make_incident(id="TOO_OLD", created_at="2022-02-17T06:00:00Z"),
+            make_incident(id="EARLIER", created_at="2022-02-18T01:00:00Z"),
+            make_incident(id="OLD", created_at="2022-02-20T01:00:00Z"),
+            make_incident(
+                id="OPEN", created_at="2022-02-21T01:00:00Z", status="triggered"
+            ),
+            make_incident(id="NEWEST", created_at="2022-02-22T01:00:00Z"),
+            make_incident(id="TODAY", created_at="2022-02-23T01:00:00Z"),
+        ]
+
+        with FakePagerDutyAPI(incidents) as api, tempfile.TemporaryDirectory() as d:
+            cache_file = Path(d).joinpath("cache.segments")
+            with patch("metrics.pd_api_url", api.url), patch.object(
+                helpers, "today", return_value=datetime(2022, 2, 23, 12, 0, 0)
+            ):
+
+                def report(days):
+                    return get_incidents(
+                        days,
+                        [1, 2, 3, 4, 5],
+                        "token",
+                        [],
+                        False,
+                        cache_file,
+                        False,
+                        concurrency=1,
+                    )
+
+                first = report(2)
+
+                # The open incident resolves and a new one arrives today
+                incidents[3] = dict(incidents[3], status="resolved")
+                incidents.append(
+                    make_incident(id="LATEST", created_at="2022-02-23T06:00:00Z")
+                )
+                result = report(3)
+                segments = json.loads(
+                    cache_file.joinpath("segments.meta.json").read_text()
+                )["segments"]
+
+        self.assertEqual([i.id for i in first], ["OLD", "OPEN", "NEWEST", "TODAY"])
+
+        # Each day is fetched on its own. The longer window only fetches the
+        # missing days, the day with an open incident, and today.
+        self.assertEqual(
+            [r["since"][0][:10] for r in api.requests],
+            [
+                "2022-02-19",
+                "2022-02-20",
+                "2022-02-21",
+                "2022-02-22",
+                "2022-02-23",
+                "2022-02-17",
+                "2022-02-18",
+                "2022-02-21",
+                "2022-02-23",
+            ],
+        )
+        self.assertEqual(
+            [(i.id, i.status) for i in result],
+            [
+                ("EARLIER", "resolved"),
+                ("OLD", "resolved"),
+                ("OPEN", "resolved"),
+                ("NEWEST", "resolved"),
+                ("TODAY", "resolved"),
+                ("LATEST", "resolved"),
+            ],
+        )
+        self.assertEqual(
+            segments["2022-02-21"],
+            {"until": "2022-02-22T00:00:00Z", "count": 1, "open": 0},
+        )
+        self.assertEqual(segments["2022-02-23"]["until"], "2022-02-23T12:00:00Z")
+
+    def test_segment_cache_east_of_utc(self):
+        incidents = [make_incident(id="EARLY", created_at="2022-02-22T10:00:00Z")]
+
+        with FakePagerDutyAPI(incidents) as api, tempfile.TemporaryDirectory() as d:
+            cache_file = Path(d).joinpath("cache.segments")
+
+            def report(today):
+                with patch.object(helpers, "today", return_value=today):
+                    return get_incidents(
+                        1,
+                        [1, 2, 3, 4, 5],
+                        "token",
+                        [],
+                        False,
+                        cache_file,
+                        False,
+                        concurrency=1,
+                    )
+
+            with patch("metrics.pd_api_url", api.url):
+                # Just after midnight on the 23rd at UTC+10, it is still the
+                # afternoon of the 22nd in UTC, so the 22nd has not ended
+                aest = timezone(timedelta(hours=10))
+                report(datetime(2022, 2, 23, 1, 0, 0, tzinfo=aest))
+                segments = json.loads(
+                    cache_file.joinpath("segments.meta.json").read_text()
+                )["segments"]
+
+                incidents.append(
+                    make_incident(id="LATE", created_at="2022-02-22T20:00:00Z")
+                )
+                result = report(datetime(2022, 2, 23, 12, 0, 0, tzinfo=aest))
+
+        self.assertEqual(segments["2022-02-22"]["until"], "2022-02-22T15:00:00Z")
+        self.assertNotIn("2022-02-23", segments)
+        # So the rest of the 22nd is downloaded once it has ended
+        self.assertEqual([i.id for i in result], ["EARLY", "LATE"])
+
+    def test_segment_cache_failed_download(self):
+        start = datetime(2022, 2, 21, 0, 0, 0)
+        incidents = [
+            make_incident(
+                id=f"INCIDENT{n}",
+                created_at=(start + timedelta(hours=n)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            )
+            for n in range(48)
+        ]
+        # The first day has more incidents than the API will page through
+        incidents.extend(
+            make_incident(
+                id=f"BUSY{n}",
+                created_at=(start + timedelta(minutes=n)).strftime(
+                    "%Y-%m-%dT%H:%M:%SZ"
+                ),
+            )
+            for n in range(40)
+        )
+        incidents.sort(key=lambda i: i["created_at"])
+
+        with FakePagerDutyAPI(incidents) as api, tempfile.TemporaryDirectory() as d:
+            cache_file = Path(d).joinpath("cache.segments")
+
+            def report():
+                return get_incidents(
+                    1,
+                    [1, 2, 3, 4, 5],
+                    "token",
+                    [],
+                    False,
+                    cache_file,
+                    False,
+                    load=False,
+                    concurrency=1,
+                )
+
+            def segments():
+                return json.loads(
+                    cache_file.joinpath("segments.meta.json").read_text()
+                )["segments"]
+
+            with redirect_stdout(io.StringIO()) as out, patch(
+                "metrics.pd_api_url", api.url
+            ), patch("metrics.pd_page_size", 10), patch(
+                "metrics.pd_iteration_limit", 50
+            ), patch.object(
+                helpers, "today", return_value=datetime(2022, 2, 23, 12, 0, 0)
+            ):
+                report()
+                truncated = segments()
+
+                # A day the API cannot be asked about is not written either
+                with patch(
+                    "metrics.fetch_incident_pages",
+                    side_effect=metrics.import_pdpyras().PDClientError(
+                        "Not found", response=MagicMock(status_code=404)
+                    ),
+                ):
+                    report()
+                not_found = segments()
+
+        self.assertIn("[WARNING] More than 50 incidents", out.getvalue())
+        self.assertEqual(sorted(truncated), ["2022-02-22", "2022-02-23"])
+        self.assertEqual(truncated["2022-02-22"]["count"], 24)
+        self.assertEqual(not_found, truncated)
+
+
+class TestRollupReport(TestCase):
+    def test_rollup_report(self):
+        start = datetime(2022, 2, 16, 0, 0, 0)
+        summaries = ["AlertA", "AlertA", "AlertA", "AlertB", "AlertB", "AlertC"]
+        incidents = [
+            make_incident(
+                id=f"INCIDENT{n}",
+                created_at=(start + timedelta(minutes=50 * n)).strftime(
+                    "%Y-%m-%dT%H:%M:%SZ"
+                ),
+                summary=f"{summaries[n % 6]} CRITICAL ({n})",
+            )
+            for n in range(7 * 24 * 60 // 50)
+        ]
+        self.addCleanup(set_normalization_rules, compile_normalization_rules())
+
+        with FakePagerDutyAPI(incidents) as api, tempfile.TemporaryDirectory() as d:
+            args = argparse.Namespace(
+                subcommand="all",
+                days=3,
+                layers=[4, 5],
+                breakdown=[("day",)],
+                count=5,
+                verbose=False,
+                cache_file=Path(d).joinpath("cache.segments"),
+            )
+
+            # reports returns the report from rollups, and from every incident
+            def reports():
+                incidents = get_incidents(
+                    args.days,
+                    args.layers,
+                    "token",
+                    [],
+                    False,
+                    args.cache_file,
+                    False,
+                    load=False,
+                    concurrency=1,
+                )
+                self.assertEqual(incidents, [])
+                with redirect_stdout(io.StringIO()) as rolled_up:
+                    rollup_report(args)
+
+                incidents = get_incidents(
+                    args.days,
+                    args.layers,
+                    "token",
+                    [],
+                    False,
+                    args.cache_file,
+                    False,
+                    concurrency=1,
+                )
+                with redirect_stdout(io.StringIO()) as counted:
+                    print_report(incidents, "all", 3, args.breakdown, 5, False)
+
+                return rolled_up.getvalue(), counted.getvalue()
+
+            with patch("metrics.pd_api_url", api.url), patch.object(
+                helpers, "today", return_value=datetime(2022, 2, 23, 12, 0, 0)
+            ):
+                rolled_up, counted = reports()
+                rollups = sorted(p.name for p in args.cache_file.glob("*.rollup.json"))
+
+                # Changing the rules rebuilds the rollups
+                set_normalization_rules(
+                    compile_normalization_rules({"alerts": [["AlertC", "AlertB"]]})
+                )
+                renamed, renamed_counted = reports()
+
+        self.assertEqual(rolled_up, counted)
+        self.assertIn("COUNT\tINCIDENT\n", rolled_up)
+        # Only complete days entirely within a period are rolled up
+        self.assertEqual(
+            rollups,
+            [
+                "2022-02-18.rollup.json",
+                "2022-02-19.rollup.json",
+                "2022-02-21.rollup.json",
+                "2022-02-22.rollup.json",
+            ],
+        )
+        self.assertEqual(renamed, renamed_counted)
+        self.assertNotIn("AlertC", renamed)
+
+
+class TestAttributeAlertClusters(TestCase):
+    def test_attribute_alert_clusters(self):
+        def service(summary):
+            return dict(test_incidents[0]["service"], summary=summary)
+
+        incidents = [
+            make_incident(id="ZABBIX", service=service("Zabbix Service")),
+            make_incident(id="ALERTMANAGER", service=service("app-sre-alertmanager")),
+            make_incident(id="UNKNOWN", service=service("prod-deadmanssnitch")),
+            make_incident(id="NAMED", service=service("osd-named.example.org")),
+        ]
+        alerts = {
+            "ZABBIX": [
+                {"body": {"details": {"host": "node-1"}}},
+                {"body": {"details": {"host": "node-2", "cluster": "zabbix.example"}}},
+            ],
+            "ALERTMANAGER": [
+                {
+                    "body": {
+                        "cef_details": {
+                            "details": {
+                                "firing": "Labels:\n - alertname = KubeNodeNotReady"
+                                '\n - cluster_id = "am.example"\n'
+                            }
+                        }
+                    }
+                }
+            ],
+            "UNKNOWN": [{"body": {"details": "no cluster here"}}],
+        }
+
+        with FakePagerDutyAPI(
+            [], alerts=alerts
+        ) as api, tempfile.TemporaryDirectory() as d:
+            cache_file = Path(d).joinpath("cache.jsonl")
+            with patch("metrics.pd_api_url", api.url):
+
+                def attribute(no_cache=False):
+                    records = [Incident.from_pagerduty(i) for i in incidents]
+                    attribute_alert_clusters(
+                        records, "token", cache_file, no_cache, 2, False
+                    )
+                    return {i.id: i.cluster for i in records}
+
+                clusters = attribute()
+                self.assertEqual(
+                    sorted(api.alert_requests), ["ALERTMANAGER", "UNKNOWN", "ZABBIX"]
+                )
+
+                # The clusters found are cached, including that there was none
+                self.assertEqual(attribute(), clusters)
+                self.assertEqual(len(api.alert_requests), 3)
+
+                # --no-cache fetches every alert again, but leaves the cached
+                # clusters as they were
+                incidents[0]["id"] = "ZABBIX2"
+                alerts["ZABBIX2"] = alerts["ZABBIX"]
+                self.assertEqual(attribute(no_cache=True)["ZABBIX2"], "zabbix.example")
+                self.assertEqual(len(api.alert_requests), 6)
+                cached = read_alert_clusters(cache_file, False)
+                incidents[0]["id"] = "ZABBIX"
+
+        self.assertEqual(sorted(cached), ["ALERTMANAGER", "UNKNOWN", "ZABBIX"])
+
+        self.assertEqual(
+            clusters,
+            {
+                "ZABBIX": "zabbix.example",
+                "ALERTMANAGER": "am.example",
+                "UNKNOWN": None,
+                "NAMED": "named.example.org",
+            },
+        )
+
+
+class TestSyncSince(TestCase):
+    def test_sync_since(self):
+        window_since = datetime(2022, 1, 1)
+        testcases = [
+            {
+                "name": "test_no_state",
+                "incidents": [],
+                "state": {},
+                "expect": window_since,
+            },
+            {
+                "name": "test_created_at_watermark",
+                "incidents": [
+                    {"created_at": "2022-01-02T00:00:00Z", "status": "resolved"}
+                ],
+                "state": {
+                    "since": "2022-01-01T00:00:00Z",
+                    "created_at": "2022-01-03T00:00:00Z",
+                },
+                "expect": datetime(2022, 1, 3),
+            },
+            {
+                "name": "test_oldest_unresolved",
+                "incidents": [
+                    {"created_at": "2022-01-02T00:00:00Z", "status": "acknowledged"}
+                ],
+                "state": {
+                    "since": "2022-01-01T00:00:00Z",
+                    "created_at": "2022-01-03T00:00:00Z",
+                },
+                "expect": datetime(2022, 1, 2),
+            },
+            {
+                "name": "test_not_before_window",
+                "incidents": [
+                    {"created_at": "2021-12-30T00:00:00Z", "status": "triggered"}
+                ],
+                "state": {
+                    "since": "2022-01-01T00:00:00Z",
+                    "created_at": "2022-01-03T00:00:00Z",
+                },
+                "expect": window_since,
+            },
+        ]
+
+        for testcase in testcases:
+            self.assertEqual(
+                sync_since(testcase["incidents"], testcase["state"], window_since),
+                testcase["expect"],
+                "{} should be: {}".format(testcase["name"], testcase["expect"]),
+            )
+
+
+class TestStreamIncidentPages(TestCase):
+    def test_stream_incident_pages(self):
+        start = datetime(2022, 2, 20, 0, 0, 0)
+        incidents = [
+            make_incident(
+                id=f"INCIDENT{n}",
+                created_at=(start + timedelta(hours=n)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            )
+            for n in range(96)
+        ]
+
+        with FakePagerDutyAPI(incidents) as api:
+            with patch("metrics.pd_api_url", api.url), patch(
+                "metrics.pd_page_size", 10
+            ), patch.object(
+                helpers, "today", return_value=datetime(2022, 2, 24, 0, 0, 0)
+            ):
+                pages = list(stream_incident_pages(2, "token", [], False, 4))
+
+        # Four day-long slices of 24 (or 25, with the boundary) incidents
+        self.assertEqual(len(pages), 12)
+        self.assertTrue(all(len(page) <= 10 for page in pages))
+        self.assertEqual(
+            sorted({i["id"] for page in pages for i in page}),
+            sorted(i["id"] for i in incidents),
+        )
+
+    def test_stream_incident_pages_limit(self):
+        start = datetime(2022, 2, 20, 0, 0, 0)
+        incidents = [
+            make_incident(
+                id=f"INCIDENT{n}",
+                created_at=(start + timedelta(hours=n)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            )
+            for n in range(96)
+        ]
+
+        # A window with more incidents than the API pages through fails,
+        # rather than returning the first of them as if they were all
+        with FakePagerDutyAPI(incidents) as api:
+            with patch("metrics.pd_api_url", api.url), patch(
+                "metrics.pd_page_size", 10
+            ), patch("metrics.pd_iteration_limit", 30), patch.object(
+                helpers, "today", return_value=datetime(2022, 2, 24, 0, 0, 0)
+            ):
+                with self.assertRaises(IncompleteDownloadError):
+                    list(stream_incident_pages(2, "token", [], False, 1))
+
+                # Day-long slices stay within the limit
+                pages = list(stream_incident_pages(2, "token", [], False, 4))
+
+        self.assertEqual(len({i["id"] for page in pages for i in page}), 96)
+
+    def test_stream_incident_pages_error(self):
+        with patch("metrics.new_api_session") as new_api_session:
+            new_api_session.return_value.get.side_effect = RuntimeError("broken")
+            with self.assertRaises(RuntimeError):
+                list(stream_incident_pages(2, "token", [], False, 4))
+
+
+class TestCacheWriter(TestCase):
+    def test_cache_writer(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache_file = Path(d).joinpath("cache.jsonl")
+
+            with cache_writer(cache_file, False) as write:
+                write([make_incident(id="A")])
+                write([make_incident(id="B")])
+            self.assertEqual(
+                [i["id"] for i in read_incidents_from_cache(cache_file, False)],
+                ["A", "B"],
+            )
+
+            # An interrupted write leaves the previous cache in place
+            with self.assertRaises(RuntimeError):
+                with cache_writer(cache_file, False) as write:
+                    write([make_incident(id="C")])
+                    raise RuntimeError("interrupted")
+            self.assertEqual(
+                [i["id"] for i in read_incidents_from_cache(cache_file, False)],
+                ["A", "B"],
+            )
+            self.assertEqual(list(Path(d).iterdir()), [cache_file])
+
+
+class TestShiftWindows(TestCase):
+    def test_shift_windows(self):
+        since, until = datetime(2022, 1, 1, 12, 0), datetime(2022, 1, 3, 0, 0)
+        testcases = [
+            {
+                "name": "test_single_layer",
+                "layers": [4],
+                "expect": [
+                    (datetime(2022, 1, 1, 13, 30), datetime(2022, 1, 1, 18, 0)),
+                    (datetime(2022, 1, 2, 13, 30), datetime(2022, 1, 2, 18, 0)),
+                ],
+            },
+            {
+                "name": "test_adjacent_layers_combined",
+                "layers": [4, 5],
+                "expect": [
+                    (datetime(2022, 1, 1, 13, 30), datetime(2022, 1, 1, 22, 30)),
+                    (datetime(2022, 1, 2, 13, 30), datetime(2022, 1, 2, 22, 30)),
+                ],
+            },
+            {
+                "name": "test_over_midnight_clipped",
+                "layers": [5, 1],
+                "expect": [
+                    (datetime(2022, 1, 1, 18, 0), datetime(2022, 1, 2, 3, 30)),
+                    (datetime(2022, 1, 2, 18, 0), datetime(2022, 1, 3, 0, 0)),
+                ],
+            },
+            {
+                "name": "test_separate_layers",
+                "layers": [1, 3],
+                "expect": [
+                    (datetime(2022, 1, 1, 12, 0), datetime(2022, 1, 1, 13, 30)),
+                    (datetime(2022, 1, 1, 22, 30), datetime(2022, 1, 2, 3, 30)),
+                    (datetime(2022, 1, 2, 8, 30), datetime(2022, 1, 2, 13, 30)),
+                    (datetime(2022, 1, 2, 22, 30), datetime(2022, 1, 3, 0, 0)),
+                ],
+            },
+        ]
+
+        for testcase in testcases:
+            self.assertEqual(
+                shift_windows(since, until, testcase["layers"]),
+                testcase["expect"],
+                "{} should be: {}".format(testcase["name"], testcase["expect"]),
+            )
+
+
+class TestPlanIncidentQueries(TestCase):
+    def test_plan_incident_queries(self):
+        start = datetime(2022, 2, 20, 0, 0, 0)
+        incidents = [
+            make_incident(
+                id=f"INCIDENT{n}",
+                created_at=(start + timedelta(hours=n)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            )
+            for n in range(96)
+        ]
+        since, until = start, datetime(2022, 2, 24, 0, 0, 0)
+
+        testcases = [
+            # 10 pages for one wide query, or 4 single page shift queries
+            {
+                "name": "test_auto_shifts",
+                "plan": "auto",
+                "page_size": 10,
+                "shifts": True,
+            },
+            # 1 page for one wide query
+            {
+                "name": "test_auto_wide",
+                "plan": "auto",
+                "page_size": 100,
+                "shifts": False,
+            },
+            {"name": "test_wide", "plan": "wide", "page_size": 10, "shifts": False},
+            {"name": "test_shifts", "plan": "shifts", "page_size": 100, "shifts": True},
+        ]
+
+        for testcase in testcases:
+            with FakePagerDutyAPI(incidents) as api:
+                with patch("metrics.pd_api_url", api.url), patch(
+                    "metrics.pd_page_size", testcase["page_size"]
+                ):
+                    windows, layers = plan_incident_queries(
+                        "token", [], since, until, [4], testcase["plan"], False
+                    )
+
+            self.assertEqual(
+                windows is not None,
+                testcase["shifts"],
+                "{} should plan shift queries: {}".format(
+                    testcase["name"], testcase["shifts"]
+                ),
+            )
+            self.assertEqual(layers, [4] if testcase["shifts"] else None)
+
+        # A shift download only serves the layers it covered from the cache
+        with FakePagerDutyAPI(incidents) as api, tempfile.TemporaryDirectory() as d:
+            cache_file = Path(d).joinpath("cache.jsonl")
+            with patch("metrics.pd_api_url", api.url), patch(
+                "metrics.pd_page_size", 10
+            ), patch.object(helpers, "today", return_value=until):
+
+                def get(layers):
+                    return get_incidents(
+                        2,
+                        layers,
+                        "token",
+                        [],
+                        False,
+                        cache_file,
+                        False,
+                        query_plan="auto",
+                    )
+
+                self.assertEqual(
+                    [i.id for i in get([4])],
+                    [
+                        "INCIDENT14",
+                        "INCIDENT15",
+                        "INCIDENT16",
+                        "INCIDENT17",
+                        "INCIDENT18",
+                    ]
+                    + [
+                        "INCIDENT38",
+                        "INCIDENT39",
+                        "INCIDENT40",
+                        "INCIDENT41",
+                        "INCIDENT42",
+                    ]
+                    + [
+                        "INCIDENT62",
+                        "INCIDENT63",
+                        "INCIDENT64",
+                        "INCIDENT65",
+                        "INCIDENT66",
+                    ]
+                    + [
+                        "INCIDENT86",
+                        "INCIDENT87",
+                        "INCIDENT88",
+                        "INCIDENT89",
+                        "INCIDENT90",
+                    ],
+                )
+                requests = len(api.requests)
+                get([4])
+                self.assertEqual(len(api.requests), requests)
+                get([1])
+                self.assertGreater(len(api.requests), requests)
+
+
+class TestSplitTimeWindow(TestCase):
+    def test_split_time_window(self):
+        testcases = [
+            {
+                "name": "test_even_split",
+                "since": datetime(2022, 1, 1),
+                "until": datetime(2022, 1, 3),
+                "slice_length": timedelta(days=1),
+                "expect": [
+                    (datetime(2022, 1, 1), datetime(2022, 1, 2)),
+                    (datetime(2022, 1, 2), datetime(2022, 1, 3)),
+                ],
+            },
+            {
+                "name": "test_short_final_slice",
+                "since": datetime(2022, 1, 1),
+                "until": datetime(2022, 1, 2, 12),
+                "slice_length": timedelta(days=1),
+                "expect": [
+                    (datetime(2022, 1, 1), datetime(2022, 1, 2)),
+                    (datetime(2022, 1, 2), datetime(2022, 1, 2, 12)),
+                ],
+            },
+            {
+                "name": "test_empty_window",
+                "since": datetime(2022, 1, 1),
+                "until": datetime(2022, 1, 1),
+                "slice_length": timedelta(days=1),
+                "expect": [],
+            },
+        ]
+
+        for testcase in testcases:
+            self.assertEqual(
+                split_time_window(
+                    testcase["since"], testcase["until"], testcase["slice_length"]
+                ),
+                testcase["expect"],
+                "{} should be: {}".format(testcase["name"], testcase["expect"]),
+            )
+
+
+class TestMergeIncidents(TestCase):
+    def test_merge_incidents(self):
+        first = [
+            {"id": "B", "created_at": "2022-01-02T00:00:00Z", "status": "triggered"},
+            {"id": "A", "created_at": "2022-01-01T00:00:00Z", "status": "triggered"},
+        ]
+        second = [
+            {"id": "B", "created_at": "2022-01-02T00:00:00Z", "status": "resolved"},
+            {"id": "C", "created_at": "2022-01-03T00:00:00Z", "status": "triggered"},
+        ]
+
+        self.assertEqual(
+            merge_incidents(first, second),
+            [first[1], second[0], second[1]],
+        )
 
 
 class TestSplitIncidentsByPeriod(TestCase):
@@ -180,28 +1427,379 @@ class TestSplitIncidentsByPeriod(TestCase):
                 "name": "split_incidents_by_period_0",
                 "incidents": [
                     {
-                        "incident_number": 0,
-                        "title": "IncidentTitle",
+                        "id": "CURRENT",
                         "created_at": "2022-02-22T18:18:46Z",
                     },
                     {
-                        "incident_number": 0,
-                        "title": "IncidentTitle",
-                        "created_at": "2022-02-22T18:18:46Z",
+                        "id": "CUTOFF",
+                        "created_at": "2022-02-22T00:00:00Z",
                     },
                     {
-                        "incident_number": 0,
-                        "title": "IncidentTitle",
-                        "created_at": "2022-02-22T18:18:46Z",
+                        "id": "PREVIOUS",
+                        "created_at": "2022-02-21T18:18:46Z",
                     },
                 ],
                 "days": 1,
-                "expect": {"current": [], "previous": []},
+                "expect": {"current": ["CURRENT"], "previous": ["CUTOFF", "PREVIOUS"]},
             }
         ]
 
-        # NOTE: TODO
-        pass
+        for testcase in testcases:
+            with patch.object(
+                helpers, "today", return_value=datetime(2022, 2, 23, 0, 0, 0)
+            ):
+                current, previous = split_incidents_by_period(
+                    [
+                        Incident.from_pagerduty(make_incident(**i))
+                        for i in testcase["incidents"]
+                    ],
+                    testcase["days"],
+                )
+
+            self.assertEqual(
+                {
+                    "current": [i.id for i in current],
+                    "previous": [i.id for i in previous],
+                },
+                testcase["expect"],
+                "{} should be: {}".format(testcase["name"], testcase["expect"]),
+            )
+
+
+class TestBatchReports(TestCase):
+    def test_batch_reports(self):
+        start = datetime(2022, 2, 9, 0, 30, 0)
+        incidents = [
+            make_incident(
+                id=f"INCIDENT{n}",
+                created_at=(start + timedelta(hours=n)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                teams=[{"id": "TEAM_A" if n % 3 else "TEAM_B"}],
+            )
+            for n in range(14 * 24)
+        ]
+
+        with FakePagerDutyAPI(incidents) as api, tempfile.TemporaryDirectory() as d:
+            manifest = Path(d).joinpath("manifest.yml")
+            manifest.write_text(
+                "reports:\n"
+                "  - name: a\n"
+                "    team_ids: [TEAM_A]\n"
+                "    subcommand: alerts\n"
+                "  - name: both\n"
+                "    team_ids: [TEAM_A, TEAM_B]\n"
+                "    layers: [1]\n"
+                "  - name: b-trend\n"
+                "    team_ids: [TEAM_B]\n"
+                "    subcommand: trend\n"
+                "    days: 1\n"
+                "    periods: 14\n"
+            )
+            args = argparse.Namespace(
+                manifest=manifest,
+                output_dir=Path(d),
+                cache_file=Path(d).joinpath("cache.jsonl"),
+                no_cache=False,
+                sync=False,
+                concurrency=1,
+                slice="day",
+                verbose=False,
+                days=2,
+                layers=[1, 2, 3, 4, 5],
+                count=5,
+            )
+
+            with patch("metrics.pd_api_url", api.url), patch(
+                "metrics.pd_page_size", 1000
+            ), patch.object(
+                helpers, "today", return_value=datetime(2022, 2, 23, 0, 0, 0)
+            ), redirect_stdout(
+                io.StringIO()
+            ):
+                batch_reports(args, "token", [])
+
+            reports = {
+                name: Path(d).joinpath(f"{name}.txt").read_text()
+                for name in ["a", "both", "b-trend"]
+            }
+
+        # Each team is downloaded once, for the longest window it needs
+        self.assertEqual(
+            sorted((r["team_ids[]"][0], r["since"][0][:10]) for r in api.requests),
+            [("TEAM_A", "2022-02-19"), ("TEAM_B", "2022-02-09")],
+        )
+        self.assertIn(
+            "High incidents in the last 2 days before today: 32\n", reports["a"]
+        )
+        self.assertIn("Including incidents from layers: 1\n", reports["both"])
+        self.assertIn(
+            "High incidents in the last 2 days before today: 12\n", reports["both"]
+        )
+        self.assertIn("COUNT\tCHANGE\tPERIOD\n8\t\t2022-02-09\n", reports["b-trend"])
+
+    def test_team_cache_file(self):
+        testcases = [
+            ("/c/incident-cache.jsonl.gz", "T1", "/c/incident-cache_T1.jsonl.gz"),
+            ("/c/incident-cache", "T1", "/c/incident-cache_T1"),
+            ("/c/incident-cache.jsonl", None, "/c/incident-cache.jsonl"),
+        ]
+        for cache_file, team_id, expected in testcases:
+            self.assertEqual(team_cache_file(Path(cache_file), team_id), Path(expected))
+
+
+class TestServe(TestCase):
+    def test_serve(self):
+        incidents = [
+            Incident.from_pagerduty(make_incident(id=id, created_at=created_at))
+            for id, created_at in [
+                ("CURRENT", "2022-02-22T18:18:46Z"),
+                ("PREVIOUS", "2022-02-21T18:18:46Z"),
+                ("TOO_OLD", "2022-02-20T18:18:46Z"),
+            ]
+        ]
+
+        def report(query):
+            return incident_report(incidents, **report_request(query, 7, [3, 4, 5]))
+
+        def run(args):
+            out = io.StringIO()
+            with redirect_stdout(out), patch.object(
+                helpers, "today", return_value=datetime(2022, 2, 23, 0, 0, 0)
+            ):
+                client_report(args)
+            return out.getvalue()
+
+        with tempfile.TemporaryDirectory() as d:
+            socket_path = str(Path(d).joinpath("metrics.sock"))
+            server = report_server(socket_path, report, False)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+            try:
+                args = argparse.Namespace(
+                    server=socket_path,
+                    subcommand="all",
+                    days=1,
+                    layers=[4, 5],
+                    count=5,
+                    breakdown=[("alert", "cluster")],
+                    verbose=False,
+                )
+                served = run(args)
+
+                with self.assertRaises(SystemExit):
+                    run(argparse.Namespace(**dict(vars(args), layers=[1])))
+            finally:
+                server.shutdown()
+                server.server_close()
+
+        expected = io.StringIO()
+        with redirect_stdout(expected):
+            print_period_summary(1, 1, 1, False)
+            print_aggregation(
+                aggregate_incidents(
+                    incidents[:1], [("alert",), ("cluster",), ("alert", "cluster")]
+                ),
+                5,
+            )
+
+        self.assertEqual(served, expected.getvalue())
+
+    def test_serve_memoizes_reports(self):
+        incidents = [
+            Incident.from_pagerduty(
+                make_incident(id="CURRENT", created_at="2022-02-22T18:18:46Z")
+            )
+        ]
+        ticks = iter(range(1000))
+        servers = []
+
+        def start_server(*args):
+            servers.append(report_server(*args))
+            return servers[-1]
+
+        with tempfile.TemporaryDirectory() as d, patch(
+            "metrics.get_incidents", return_value=incidents
+        ), patch("metrics.report_server", side_effect=start_server), patch(
+            "metrics.incident_report", wraps=metrics.incident_report
+        ) as incident_report, patch.object(
+            helpers,
+            "today",
+            # The time of day moves on between requests
+            side_effect=lambda: datetime(2022, 2, 23, 0, 0, 0)
+            + timedelta(microseconds=next(ticks)),
+        ):
+            socket_path = Path(d).joinpath("metrics.sock")
+            args = argparse.Namespace(
+                days=7,
+                layers=[1, 2, 3, 4, 5],
+                verbose=False,
+                cache_file=None,
+                no_cache=True,
+                sync=False,
+                query_plan="wide",
+                concurrency=1,
+                slice="day",
+                columnar=False,
+                refresh=300,
+                port=None,
+                socket=socket_path,
+            )
+            thread = threading.Thread(
+                target=metrics.serve, args=(args, "token", []), daemon=True
+            )
+            with redirect_stdout(io.StringIO()):
+                thread.start()
+                while thread.is_alive() and not servers:
+                    thread.join(0.01)
+
+                try:
+                    client_args = argparse.Namespace(
+                        server=str(socket_path),
+                        subcommand="alerts",
+                        days=1,
+                        layers=[1, 2, 3, 4, 5],
+                        count=5,
+                        breakdown=[],
+                        verbose=False,
+                    )
+                    client_report(client_args)
+                    client_report(client_args)
+                finally:
+                    servers[0].shutdown()
+                    thread.join()
+
+        self.assertEqual(incident_report.call_count, 1)
+
+
+class TestProfile(TestCase):
+    def test_profile(self):
+        @profile_stage("decorated")
+        def decorated():
+            return "result"
+
+        with patch("metrics.profile", None):
+            # Stages are not recorded unless profiling was started
+            with profile_stage("ignored"):
+                pass
+
+            start_profile()
+            with profile_stage("stage"):
+                pass
+            self.assertEqual(decorated(), "result")
+            self.assertEqual(decorated(), "result")
+            profile_request(
+                "incidents",
+                0,
+                MagicMock(status_code=200, content=b"{}"),
+                incidents=3,
+            )
+
+            with tempfile.TemporaryDirectory() as d, redirect_stderr(io.StringIO()):
+                output = Path(d).joinpath("profile.json")
+                print_profile(output)
+                profile = json.loads(output.read_text())
+
+        self.assertEqual(list(profile["stages"]), ["stage", "decorated"])
+        self.assertEqual(profile["stages"]["decorated"]["calls"], 2)
+        self.assertGreater(profile["stages"]["stage"]["peak_bytes"], 0)
+        self.assertEqual(
+            [(r["kind"], r["bytes"], r["incidents"]) for r in profile["requests"]],
+            [("incidents", 2, 3)],
+        )
+
+
+class TestSplitIncidentsIntoPeriods(TestCase):
+    def test_split_incidents_into_periods(self):
+        incidents = [
+            Incident.from_pagerduty(make_incident(id=id, created_at=created_at))
+            for id, created_at in [
+                ("NEWEST", "2022-02-22T18:18:46Z"),
+                ("CUTOFF", "2022-02-22T00:00:00Z"),
+                ("MIDDLE", "2022-02-21T18:18:46Z"),
+                ("TOO_OLD", "2022-02-19T23:59:59Z"),
+                ("OLDEST", "2022-02-20T00:00:01Z"),
+            ]
+        ]
+
+        with patch.object(
+            helpers, "today", return_value=datetime(2022, 2, 23, 0, 0, 0)
+        ):
+            periods = split_incidents_into_periods(incidents, 1, 3)
+
+        self.assertEqual(
+            [(start.day, [i.id for i in p]) for start, p in periods],
+            [(20, ["OLDEST"]), (21, ["MIDDLE", "CUTOFF"]), (22, ["NEWEST"])],
+        )
+
+        # The last two periods split the same way as the current and previous
+        with patch.object(
+            helpers, "today", return_value=datetime(2022, 2, 23, 0, 0, 0)
+        ):
+            current, previous = split_incidents_by_period(incidents, 1)
+        self.assertEqual(periods[-1][1], current)
+        self.assertLessEqual({i.id for i in periods[-2][1]}, {i.id for i in previous})
+
+
+class TestIncident(TestCase):
+    def test_incident(self):
+        incident = Incident.from_pagerduty(
+            make_incident(
+                created_at="2022-02-22T03:30:00Z",
+                summary="[OHSS-1] UpgradeConfigSyncFailureOver4HrSRE CRITICAL (1)",
+                service=dict(test_incidents[0]["service"], summary="osd-cluster.name"),
+            )
+        )
+
+        self.assertEqual(incident.id, "INCIDENTIDNUM")
+        self.assertEqual(incident.created_at, 1645500600)
+        self.assertEqual(incident.last_status_change_at, 1645567426)
+        self.assertEqual(incident.layer, 2)
+        self.assertEqual(incident.alert, "UpgradeConfigSyncFailureOver4HrSRE")
+        self.assertEqual(incident.cluster, "cluster.name")
+        self.assertIs(incident.in_layers([1]), True)
+        self.assertIs(incident.in_layers([3, 4]), False)
+        self.assertFalse(hasattr(incident, "__dict__"))
+
+        excluded = Incident.from_pagerduty(
+            make_incident(
+                service=dict(test_incidents[0]["service"], summary="Zabbix Service")
+            )
+        )
+        self.assertIsNone(excluded.cluster)
+
+
+class TestNormalizeIncidents(TestCase):
+    def test_normalize_incidents(self):
+        services = ["osd-one.example.org", "Zabbix Service", "two-hive-cluster"]
+        incidents = [
+            make_incident(
+                id=f"INCIDENT{n}",
+                created_at=f"2022-02-22T{n % 24:02d}:{n % 60:02d}:00Z",
+                summary=f"[SRE] Alert{n % 7} CRITICAL ({n})",
+                service=dict(test_incidents[0]["service"], summary=services[n % 3]),
+            )
+            for n in range(500)
+        ]
+        incidents[3]["last_status_change_at"] = None
+        self.addCleanup(set_normalization_rules, compile_normalization_rules())
+        set_normalization_rules(
+            compile_normalization_rules({"alerts": [["Alert3", "AlertThree"]]})
+        )
+
+        def fields(records):
+            return [tuple(getattr(i, f) for f in Incident.__slots__) for i in records]
+
+        serial = fields(normalize_incidents(incidents))
+
+        # Split over worker processes, the records come back the same
+        with patch("metrics.parallel_normalization_threshold", 100), patch(
+            "metrics.normalization_chunk_size", 64
+        ), patch("metrics.normalization_workers", return_value=3):
+            parallel = fields(normalize_incidents(incidents))
+
+        self.assertEqual(parallel, serial)
+        self.assertIn(
+            "AlertThree", {i[Incident.__slots__.index("alert")] for i in parallel}
+        )
 
 
 class TestAlerts(TestCase):
@@ -218,6 +1816,254 @@ class TestClusters(TestCase):
         pass
 
 
+class TestAggregateIncidents(TestCase):
+    def test_aggregate_incidents(self):
+        incidents = [
+            Incident.from_pagerduty(make_incident(**fields))
+            for fields in [
+                dict(
+                    created_at="2022-02-21T14:00:00Z",
+                    summary="[SL Sent] one.example.org has gone missing",
+                ),
+                dict(
+                    created_at="2022-02-21T23:00:00Z",
+                    summary="DNSErrors10MinSRE CRITICAL (1)",
+                    service=dict(test_incidents[0]["service"], summary="osd-two"),
+                ),
+                dict(
+                    created_at="2022-02-22T14:00:00Z",
+                    summary="DNSErrors10MinSRE CRITICAL (2)",
+                    service=dict(
+                        test_incidents[0]["service"], summary="Zabbix Service"
+                    ),
+                ),
+            ]
+        ]
+        dimensions = [("alert",), ("cluster",), ("day",), ("alert", "cluster")]
+
+        aggregation = aggregate_incidents(incidents, dimensions)
+
+        self.assertEqual(
+            aggregation[("alert",)],
+            {"DNSErrors10MinSRE": 2, "ClusterHasGoneMissing": 1},
+        )
+        # Services without a cluster are left out of cluster breakdowns
+        self.assertEqual(aggregation[("cluster",)], {"Service Summary": 1, "two": 1})
+        self.assertEqual(aggregation[("day",)], {"2022-02-21": 2, "2022-02-22": 1})
+        self.assertEqual(
+            aggregation[("alert", "cluster")],
+            {
+                ("ClusterHasGoneMissing", "Service Summary"): 1,
+                ("DNSErrors10MinSRE", "two"): 1,
+            },
+        )
+
+        # Aggregating page by page gives the same counts
+        paged = aggregate_incidents(incidents[:1], dimensions)
+        aggregate_incidents(incidents[1:], dimensions, paged)
+        self.assertEqual(paged, aggregation)
+
+    def test_report_dimensions(self):
+        self.assertEqual(
+            report_dimensions("all", [("layer",), ("alert",)]),
+            [("alert",), ("cluster",), ("layer",)],
+        )
+        self.assertEqual(report_dimensions("download"), [])
+        self.assertEqual(parse_dimension("alert:cluster"), ("alert", "cluster"))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_dimension("alert:region")
+
+
+@skipUnless(importlib.util.find_spec("numpy"), "numpy is not installed")
+class TestIncidentFrame(TestCase):
+    # Incidents every 37 minutes and 30 seconds over four days, so some
+    # fall exactly on shift boundaries, with a few alerts, clusters and
+    # statuses, and some services without a cluster
+    def setUp(self):
+        start = datetime(2022, 2, 19, 0, 0, 0)
+        alerts = ["AlertA", "AlertA", "AlertB", "AlertC", "AlertA", "AlertB"]
+        services = ["osd-one", "osd-two", "Zabbix Service", "osd-one"]
+        self.incidents = [
+            Incident.from_pagerduty(
+                make_incident(
+                    id=f"INCIDENT{n}",
+                    created_at=created_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    last_status_change_at=(
+                        created_at + timedelta(minutes=30 * (n % 7))
+                    ).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    status="resolved" if n % 5 else "triggered",
+                    summary=f"{alerts[n % 6]} CRITICAL ({n})",
+                    service=dict(test_incidents[0]["service"], summary=services[n % 4]),
+                )
+            )
+            for n in range(4 * 24 * 60 * 2 // 75)
+            for created_at in [start + timedelta(seconds=n * 2250)]
+        ]
+        self.today = patch.object(
+            helpers, "today", return_value=datetime(2022, 2, 23, 12, 0, 0)
+        )
+        self.today.start()
+        self.addCleanup(self.today.stop)
+
+    def test_count(self):
+        frame = IncidentFrame(self.incidents)
+        dimensions = [
+            ("alert",),
+            ("cluster",),
+            ("service",),
+            ("day",),
+            ("layer",),
+            ("alert", "cluster"),
+        ]
+        current = frame.created_at > datetime(2022, 2, 21, 12, 0, 0).timestamp()
+
+        aggregation = frame.aggregate(dimensions, current)
+        expected = aggregate_incidents(
+            split_incidents_by_period(self.incidents, 2)[0], dimensions
+        )
+
+        self.assertEqual(len(frame), len(self.incidents))
+        for dimension in dimensions:
+            self.assertEqual(aggregation[dimension], expected[dimension])
+            # Ties are listed in the same order
+            self.assertEqual(
+                list(aggregation[dimension].most_common()),
+                list(expected[dimension].most_common()),
+            )
+
+    def test_in_layers(self):
+        frame = IncidentFrame(self.incidents)
+
+        for layers in [[1], [4, 5], [2, 3, 4]]:
+            self.assertEqual(
+                list(frame.in_layers(layers)),
+                [i.in_layers(layers) for i in self.incidents],
+            )
+
+    def test_columnar_report(self):
+        def report(**options):
+            with redirect_stdout(io.StringIO()) as out:
+                print_report(self.incidents, "all", 2, [("day",)], 5, False, **options)
+            return out.getvalue()
+
+        self.assertEqual(report(columnar=True), report())
+
+        # The server filters and counts a frame the same way
+        for query in ["days=2", "days=1&layers=4&layers=5&breakdown=alert:cluster"]:
+            request = report_request(parse_qs(query), 2, [3, 4, 5])
+            self.assertEqual(
+                incident_report(IncidentFrame(self.incidents), **request),
+                incident_report(self.incidents, **request),
+            )
+
+    def test_resolve_times(self):
+        with redirect_stdout(io.StringIO()) as out:
+            print_report(self.incidents, "alerts", 2, [], 2, False, resolve_times=True)
+        lines = out.getvalue().splitlines()
+
+        current, _ = split_incidents_by_period(self.incidents, 2)
+        hours = sorted(
+            (i.last_status_change_at - i.created_at) / 3600
+            for i in current
+            if i.status == "resolved"
+        )
+        table = lines[lines.index("RESOLVED\tMEDIAN_H\tP90_H\tMAX_H\tINCIDENT") :]
+
+        self.assertEqual(
+            table[1].split("\t"),
+            [str(len(hours)), "1.5", "3.0", f"{hours[-1]:.1f}", "(all)"],
+        )
+        self.assertEqual(
+            [row.split("\t")[-1] for row in table[2:]], ["AlertA", "AlertB"]
+        )
+
+
+class TestTopKSketch(TestCase):
+    # A few heavy values over a long tail of values seen once or twice
+    values = [f"HEAVY{n % 3}" for n in range(300)] + [
+        f"TAIL{n % 700}" for n in range(1000)
+    ]
+
+    def assert_bounds(self, sketch, values):
+        exact = Counter(values)
+        for value, count in sketch.items():
+            self.assertLessEqual(exact[value], count, value)
+            self.assertLessEqual(count - sketch.error(value), exact[value], value)
+
+        # Values counted more than the total over the size are always kept
+        for value, count in exact.items():
+            if count > len(values) / sketch.size:
+                self.assertIn(value, sketch)
+
+    def test_top_k_sketch(self):
+        sketch = TopKSketch(20)
+        for value in self.values:
+            sketch[value] += 1
+
+        self.assertEqual(len(sketch), 20)
+        self.assert_bounds(sketch, self.values)
+        self.assertEqual(
+            sorted(k for k, _ in sketch.most_common(3)), ["HEAVY0", "HEAVY1", "HEAVY2"]
+        )
+
+        # With room for every value, counts are exact
+        exact = TopKSketch(1000)
+        for value in self.values:
+            exact.add(value)
+        self.assertEqual(dict(exact), Counter(self.values))
+        self.assertEqual(exact.error("HEAVY0"), 0)
+
+    def test_merge(self):
+        shards = [self.values[0::2], self.values[1::2]]
+        sketches = []
+        for shard in shards:
+            sketches.append(TopKSketch(20))
+            for value in shard:
+                sketches[-1].add(value)
+
+        merged = sketches[0] + sketches[1]
+        self.assertEqual(len(merged), 20)
+        self.assert_bounds(merged, self.values)
+
+    def test_approximate_report(self):
+        incidents = [
+            Incident.from_pagerduty(make_incident(summary=summary))
+            for summary in ["AlertA CRITICAL (1)"] * 3 + ["AlertB", "AlertC"]
+        ]
+
+        with patch("metrics.sketch_size", 2), redirect_stdout(io.StringIO()) as out:
+            print_aggregation(aggregate_incidents(incidents, [("alert",)]), 5)
+
+        self.assertEqual(
+            out.getvalue(), "COUNT\tERROR\tINCIDENT\n3\t0\tAlertA\n2\t1\tAlertC\n"
+        )
+
+        # A served report keeps the error bounds
+        request = report_request(
+            parse_qs("subcommand=alerts&days=2"), 2, [1, 2, 3, 4, 5]
+        )
+        with patch("metrics.sketch_size", 2), patch.object(
+            helpers, "today", return_value=datetime(2022, 2, 23, 0, 0, 0)
+        ):
+            report = json.loads(json.dumps(incident_report(incidents, **request)))
+
+        args = argparse.Namespace(
+            server="metrics.sock",
+            subcommand="alerts",
+            days=2,
+            layers=[1, 2, 3, 4, 5],
+            count=5,
+            breakdown=[],
+            verbose=False,
+        )
+        with patch("metrics.request_report", return_value=report), redirect_stdout(
+            io.StringIO()
+        ) as served:
+            client_report(args)
+
+        self.assertTrue(served.getvalue().endswith(out.getvalue()))
+
+
 class TestParseDescriptionForAlerts(TestCase):
     def test_parse_description_for_alerts(self):
         testcases = [
@@ -314,6 +2160,173 @@ class TestParseDescriptionForClusters(TestCase):
             )
 
 
+# normalization_corpus holds summaries of every family the rules are for,
+# and text made to trip up rules that are skipped
+normalization_corpus = [
+    test_incidents[0]["summary"],
+    test_incidents[0]["service"]["summary"],
+    "[SL Sent] cluster.name.here has gone missing",
+    "[SRE] - KubePodCrashLooping WARNING (2)",
+    "[OHSS-12345] UpgradeConfigSyncFailureOver4HrSRE CRITICAL (1)",
+    "[OHSS-1] [SRE] PrometheusRemoteWriteBehind CRITICAL ()",
+    "DNSErrors10MinSRE CRITICAL (1)",
+    "DNSErrors10MinSRE CRITICAL (1) trailing",
+    "console-ErrorBudgetBurn WARNING(1)",
+    "cluster.name.here has gone missing",
+    "cluster has gone missing again",
+    "docker.ping failed on node-name.here-compute.internal : PROBLEM for "
+    "node-name.here-compute.internal",
+    "dockerXping failed on node-compute",
+    "[FIRING:1] ClusterProvisioningDelay - production CCS - hivex00xx0 hivex00x0 "
+    "some-ns-abcdefg123456789 hive-controllers hive (cluster-name managed-byoc "
+    "ProvisionFailed metrics production openshift-v4.7.13 0.0.0.0:0000 hive aws "
+    "hive-controllers-abcde123455-abcde openshift-customer-monitoring/app-sre "
+    "AuthenticationOperatorDegraded high srep)",
+    "ClusterProvisioningDelayed",
+    "[Heal] Filesystem: /dev/mapper/rootvg-var has less than 10% free disk space "
+    "on clustername-master-abc123: PROBLEM for clustername-master-abc123",
+    "Zabbix agent on host.example.org : is unreachable",
+    "load on : PROBLEM",
+    "osd-cluster.name.here",
+    "cluster.name.here-hive-cluster",
+    "osd-cluster.name.here-hive-cluster",
+    "prod-deadmanssnitch",
+    "Zabbix Service",
+    "app-sre-alertmanager",
+    "[",
+    "]",
+    "",
+]
+
+
+class TestRequiredLiteral(TestCase):
+    def test_required_literal(self):
+        testcases = [
+            (r"\[.*\]\s(-\s)?", "["),
+            (r".*has\sgone\smissing$", "missing"),
+            (r"ab*cd", "cd"),
+            (r"abc?d", "ab"),
+            (r"x{2,3}yz", "yz"),
+            (r"[abc]+def(gh|ij)", "def"),
+            (r"[]x]yz", "yz"),
+            (r"\.example\.org$", ".example.org"),
+            (r"one|two", ""),
+            (r"(?i)Zabbix", ""),
+            (r"\x41BC", ""),
+            (r"(abc)", ""),
+        ]
+
+        for pattern, expect in testcases:
+            self.assertEqual(required_literal(re.compile(pattern)), expect, pattern)
+
+
+class TestNormalizationEquivalence(TestCase):
+    # reference_alerts and reference_cluster run every rule on every
+    # description, as the rules are written
+    def reference_alerts(self, description):
+        for pattern, replacement, _ in normalization_rules["alerts"]:
+            description = pattern.sub(replacement, description)
+        for pattern, _ in normalization_rules["alerts_match"]:
+            match = pattern.match(description)
+            description = match.group() if match else description
+        return description
+
+    def reference_cluster(self, description):
+        for pattern, replacement, _ in normalization_rules["clusters"]:
+            description = pattern.sub(replacement, description)
+        return description
+
+    def assert_equivalent(self):
+        for description in normalization_corpus:
+            self.assertEqual(
+                parse_description_for_alerts(description),
+                self.reference_alerts(description),
+                description,
+            )
+            self.assertEqual(
+                parse_description_for_cluster(description),
+                self.reference_cluster(description),
+                description,
+            )
+
+    def test_normalization_equivalence(self):
+        self.assert_equivalent()
+
+        # Including extra rules, some of which run on what earlier ones left
+        self.addCleanup(set_normalization_rules, compile_normalization_rules())
+        set_normalization_rules(
+            compile_normalization_rules(
+                {
+                    "alerts": [
+                        ["^KubePod.*", "KubePodAlerts"],
+                        ["Missing$", " gone missing"],
+                        ["(?i)zabbix", "Zabbix"],
+                    ],
+                    "alerts_match": ["^etcd[A-Za-z]+", "^Cluster(Has|Provisioning)"],
+                    "clusters": [["\\.example\\.org$", ""], ["-master-\\w+", ""]],
+                }
+            )
+        )
+        self.assert_equivalent()
+
+
+class TestNormalizationRules(TestCase):
+    def test_normalization_rules(self):
+        config = "\n".join(
+            [
+                "authtoken: token",
+                "normalization:",
+                "  alerts:",
+                "    - pattern: '^KubePod.*'",
+                "      replace: 'KubePodAlerts'",
+                "  alerts_match:",
+                "    - '^etcd[A-Za-z]+'",
+                "  clusters:",
+                "    - pattern: '\\.example\\.org$'",
+            ]
+        )
+
+        with tempfile.TemporaryDirectory() as d:
+            config_file = Path(d).joinpath("pd.yml")
+            config_file.write_text(config)
+            rules = retrieve_normalization_rules(False, config_file)
+
+        # Memoized results from the default rules must not leak through
+        self.assertEqual(
+            parse_description_for_alerts("KubePodCrashLooping"), "KubePodCrashLooping"
+        )
+
+        try:
+            set_normalization_rules(compile_normalization_rules(rules))
+
+            self.assertEqual(
+                parse_description_for_alerts("[SL Sent] KubePodCrashLooping"),
+                "KubePodAlerts",
+            )
+            self.assertEqual(
+                parse_description_for_alerts("etcdGRPCRequestsSlow 99th percentile"),
+                "etcdGRPCRequestsSlow",
+            )
+            self.assertEqual(
+                parse_description_for_cluster("osd-cluster.name.example.org"),
+                "cluster.name",
+            )
+            # Default rules still apply first
+            self.assertEqual(
+                parse_description_for_alerts("cluster.name.here has gone missing"),
+                "ClusterHasGoneMissing",
+            )
+            self.assertEqual(
+                parse_description_for_alerts("KubePodCrashLooping"), "KubePodAlerts"
+            )
+        finally:
+            set_normalization_rules(compile_normalization_rules())
+
+        self.assertEqual(
+            parse_description_for_alerts("KubePodCrashLooping"), "KubePodCrashLooping"
+        )
+
+
 class TestIsInLayer(TestCase):
     def test_is_in_layer(self):
         testcases = [
@@ -377,6 +2390,24 @@ class TestIsInLayer(TestCase):
                 "requested_layers": [2, 3],
                 "expect": False,
             },
+            {
+                "name": "test_boundary_end_true",
+                "time_string": "2020-01-01T03:30:00Z",
+                "requested_layers": [1],
+                "expect": True,
+            },
+            {
+                "name": "test_boundary_start_true",
+                "time_string": "2020-01-01T03:30:00Z",
+                "requested_layers": [2],
+                "expect": True,
+            },
+            {
+                "name": "test_boundary_end_false",
+                "time_string": "2020-01-01T03:30:01Z",
+                "requested_layers": [1],
+                "expect": False,
+            },
         ]
 
         for testcase in testcases:
@@ -390,6 +2421,20 @@ class TestIsInLayer(TestCase):
             )
 
 
+class TestBuildLayerTable(TestCase):
+    def test_build_layer_table(self):
+        table, ends = build_layer_table({1: "22:00", 2: "2:00", 3: "12:00"})
+
+        self.assertEqual(len(table), 1440)
+        self.assertEqual(table[0], 1)
+        self.assertEqual(table[2 * 60 - 1], 1)
+        self.assertEqual(table[2 * 60], 2)
+        self.assertEqual(table[12 * 60], 3)
+        self.assertEqual(table[22 * 60 - 1], 3)
+        self.assertEqual(table[22 * 60], 1)
+        self.assertEqual(ends, {2 * 60: 1, 12 * 60: 2, 22 * 60: 3})
+
+
 class TestIsTimeBetween(TestCase):
     def assertIsTrue(self, value):
         self.assertIs(value, True)
@@ -497,6 +2542,34 @@ class TestNextLayer(TestCase):
             )
 
 
+class TestRetrieveConfig(TestCase):
+    def test_retrieve_config(self):
+        with tempfile.TemporaryDirectory() as d, patch(
+            "metrics.default_config_cache_file", Path(d).joinpath("config.json")
+        ), patch("metrics.import_yaml", wraps=metrics.import_yaml) as import_yaml:
+            config_file = Path(d).joinpath("pd.yml")
+            config_file.write_text(
+                "---\nteam_ids: [T1]\nnormalization:\n  alerts:\n"
+                "    - pattern: '^Kube.*'\n      replace: 'Kube'\n"
+            )
+            metrics.read_config.cache_clear()
+
+            first = retrieve_config(False, config_file)
+            cached = retrieve_config(False, config_file)
+            parses = import_yaml.call_count
+
+            # Editing the config parses it again
+            config_file.write_text("---\nteam_ids: [T1, T2]\n")
+            metrics.read_config.cache_clear()
+            edited = retrieve_config(False, config_file)
+
+        self.assertEqual(first, cached)
+        self.assertEqual(first["team_ids"], ["T1"])
+        self.assertEqual(first["normalization"]["alerts"], [["^Kube.*", "Kube"]])
+        self.assertEqual(parses, 1)
+        self.assertEqual(edited["team_ids"], ["T1", "T2"])
+
+
 class TestRetrieveToken(TestCase):
     ## TODO: MOCK ENV/TOKEN STUFF
     pass